@@ -0,0 +1,440 @@
+import atexit
+import contextlib
+import fcntl
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+# Admission control for the inference endpoints, so a burst of large /estimate-a1c
+# histories can't take every gunicorn worker while /predict calls queue behind them
+# until timeouts cascade back to the Node backend. Each endpoint has a limit on the
+# requests and on the cost (see request_cost) it runs at once, and on how many
+# requests may wait for room. A request that would exceed the wait bound, or whose
+# client deadline (the X-Deadline-Ms header, milliseconds the client will wait)
+# can't be met, is turned away at once with a 503 and a Retry-After.
+#
+# The limits live in shared memory created at import, so with gunicorn --preload
+# (as in the Procfile) they hold across all workers. The memory is guarded by an
+# flock, which the kernel drops when its holder dies, and waiting requests poll for
+# room rather than sleep on a shared condition, so a worker killed at any point
+# can't leave the others blocked. A sync worker waiting for room
+# is a worker not serving anything else, which is why the heavy endpoints don't
+# queue by default: by default they leave one worker free for everything else
+ENABLED = os.environ.get("ADMISSION", "1") != "0"
+DEADLINE_HEADER = "X-Deadline-Ms"
+# Longest a request waits for room without a deadline, well inside gunicorn's
+# --timeout 60
+MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "10"))
+
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# Per endpoint: requests and cost units in flight, requests waiting, and the prior
+# for the seconds each cost unit takes until requests have been timed. Overridden
+# per endpoint by ADMISSION_LIMITS, e.g. '{"/estimate-a1c": {"requests": 3}}'
+DEFAULT_LIMITS = {
+    "/predict": {"requests": 64, "cost": 64, "queue": 64, "seconds_per_cost": 0.002},
+    "/predict-batch": {
+        "requests": max(1, WORKERS - 1),
+        "cost": 50000,
+        "queue": 0,
+        "seconds_per_cost": 0.0002,
+    },
+    "/estimate-a1c": {
+        "requests": max(1, WORKERS - 1),
+        "cost": 300000,
+        "queue": 0,
+        "seconds_per_cost": 5e-6,
+    },
+    "/estimate-a1c-batch": {
+        "requests": max(1, WORKERS - 1),
+        "cost": 300000,
+        "queue": 0,
+        "seconds_per_cost": 5e-6,
+    },
+}
+
+# Request cost is estimated from the body size before the body is read: records
+# for /predict-batch, readings for the A1c endpoints. JSON readings are sized for
+# the {"timestamp", "blood_glucose", "patient_id"} objects the Node backend sends;
+# columnar JSON bodies are smaller per reading, so their cost is overestimated
+JSON_BYTES_PER_READING = 85
+BINARY_BYTES_PER_READING = 12
+JSON_BYTES_PER_RECORD = 340
+# Weight of each new timing in the running seconds-per-cost estimate
+COST_SMOOTHING = 0.1
+# Seconds between a waiting request's checks for room
+POLL_INTERVAL = 0.01
+
+
+def request_cost(endpoint, content_length, binary=False):
+    if endpoint in ("/estimate-a1c", "/estimate-a1c-batch"):
+        per_unit = BINARY_BYTES_PER_READING if binary else JSON_BYTES_PER_READING
+        return max(1, (content_length or 0) // per_unit)
+    if endpoint == "/predict-batch":
+        return max(1, (content_length or 0) // JSON_BYTES_PER_RECORD)
+    return 1
+
+
+class Shed(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Request shed: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove_lock_file(path, owner):
+    # Only the process that created the limit removes its file, not forked workers
+    if os.getpid() == owner:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+class AdmissionLimit:
+    # Requests in flight and waiting are kept as (pid, cost) slots rather than
+    # counters, so the slots of a worker killed mid-request (gunicorn's timeout) or
+    # while waiting are reclaimed
+    def __init__(self, name, requests, cost, queue, seconds_per_cost):
+        self.name = name
+        self.max_requests = requests
+        self.max_cost = cost
+        self.max_queue = queue
+        self.pids = multiprocessing.RawArray("i", requests)
+        self.costs = multiprocessing.RawArray("d", requests)
+        self.waiting_pids = multiprocessing.RawArray("i", max(1, queue))
+        self.waiting_costs = multiprocessing.RawArray("d", max(1, queue))
+        self.seconds_per_cost = multiprocessing.RawValue("d", seconds_per_cost)
+
+        fd, self.lock_path = tempfile.mkstemp(prefix="sugarcheck-admission-")
+        os.close(fd)
+        atexit.register(_remove_lock_file, self.lock_path, os.getpid())
+        self.lock_pid = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # flock excludes other processes and a per-process lock other threads. A
+        # forked worker opens the file again: an inherited descriptor would share
+        # its lock with the parent
+        if self.lock_pid != os.getpid():
+            self.thread_lock = threading.Lock()
+            self.lock_fd = os.open(self.lock_path, os.O_RDWR)
+            self.lock_pid = os.getpid()
+        with self.thread_lock:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _running(self):
+        return [i for i, pid in enumerate(self.pids) if pid]
+
+    def _waiting(self):
+        return [i for i, pid in enumerate(self.waiting_pids) if pid]
+
+    def _reclaim(self):
+        for pids, costs in (
+            (self.pids, self.costs),
+            (self.waiting_pids, self.waiting_costs),
+        ):
+            for i, pid in enumerate(pids):
+                if pid and not _alive(pid):
+                    pids[i] = 0
+                    costs[i] = 0.0
+
+    def _fits(self, cost):
+        running = self._running()
+        if len(running) >= self.max_requests:
+            self._reclaim()
+            running = self._running()
+        if len(running) >= self.max_requests:
+            return False
+        # A request costlier than the whole budget still runs, on its own
+        return not running or sum(self.costs) + cost <= self.max_cost
+
+    def _drain_seconds(self, extra_cost=0.0):
+        # Time until the work in flight and queued is done, spread over the slots
+        backlog = sum(self.costs) + sum(self.waiting_costs) + extra_cost
+        return backlog * self.seconds_per_cost.value / self.max_requests
+
+    def estimate(self, cost):
+        return cost * self.seconds_per_cost.value
+
+    def retry_after(self):
+        return max(1, math.ceil(self._drain_seconds()))
+
+    def acquire(self, cost, deadline=None):
+        # Blocks until the request may run and returns the seconds spent waiting,
+        # or raises Shed. deadline is a time.monotonic() value
+        start = time.monotonic()
+        with self._locked():
+            if deadline is not None and start + self.estimate(cost) > deadline:
+                raise Shed("deadline", self.retry_after())
+            if self._waiting():
+                self._reclaim()
+            if not self._waiting() and self._fits(cost):
+                self._occupy(cost)
+                return 0.0
+            if len(self._waiting()) >= self.max_queue:
+                raise Shed("queue_full", self.retry_after())
+            wait_until = start + MAX_WAIT
+            if deadline is not None:
+                if start + self._drain_seconds(cost) > deadline:
+                    raise Shed("deadline", self.retry_after())
+                wait_until = min(wait_until, deadline - self.estimate(cost))
+            slot = self.waiting_pids[:].index(0)
+            self.waiting_pids[slot] = os.getpid()
+            self.waiting_costs[slot] = cost
+
+        try:
+            while True:
+                with self._locked():
+                    if self._fits(cost):
+                        self._occupy(cost)
+                        return time.monotonic() - start
+                    remaining = wait_until - time.monotonic()
+                if remaining <= 0:
+                    reason = "deadline" if deadline is not None else "timeout"
+                    raise Shed(reason, self.retry_after())
+                time.sleep(min(remaining, POLL_INTERVAL))
+        finally:
+            with self._locked():
+                self.waiting_pids[slot] = 0
+                self.waiting_costs[slot] = 0.0
+
+    def _occupy(self, cost):
+        slot = self.pids[:].index(0)
+        self.pids[slot] = os.getpid()
+        self.costs[slot] = cost
+
+    def release(self, cost, seconds=None):
+        with self._locked():
+            pid = os.getpid()
+            for i in self._running():
+                if self.pids[i] == pid and self.costs[i] == cost:
+                    self.pids[i] = 0
+                    self.costs[i] = 0.0
+                    break
+            if seconds is not None and cost > 0:
+                self.seconds_per_cost.value += COST_SMOOTHING * (
+                    seconds / cost - self.seconds_per_cost.value
+                )
+
+    def stats(self):
+        with self._locked():
+            running = self._running()
+            return {
+                "running": len(running),
+                "running_cost": float(sum(self.costs)),
+                "waiting": len(self._waiting()),
+                "seconds_per_cost": self.seconds_per_cost.value,
+            }
+
+
+def limits_from_env():
+    if not ENABLED:
+        return {}
+    overrides = json.loads(os.environ.get("ADMISSION_LIMITS", "{}"))
+    return {
+        endpoint: AdmissionLimit(
+            endpoint, **dict(config, **overrides.get(endpoint, {}))
+        )
+        for endpoint, config in DEFAULT_LIMITS.items()
+    }
+
+
+def request_deadline(headers, received):
+    # The client's deadline as a time.monotonic() value, from when the request was
+    # received; None without the header
+    value = headers.get(DEADLINE_HEADER)
+    if value is None:
+        return None
+    try:
+        return received + float(value) / 1e3
+    except ValueError:
+        return None
+
+
+# TESTING
+class TestAdmissionLimit(unittest.TestCase):
+    def limit(self, **config):
+        return AdmissionLimit(
+            "test",
+            **dict(
+                {"requests": 1, "cost": 100, "queue": 0, "seconds_per_cost": 0.01},
+                **config,
+            ),
+        )
+
+    def test_limits_and_queue_bound(self):
+        limit = self.limit()
+        self.assertEqual(limit.acquire(10), 0.0)
+        with self.assertRaises(Shed) as shed:
+            limit.acquire(10)
+        self.assertEqual(shed.exception.reason, "queue_full")
+        self.assertGreaterEqual(shed.exception.retry_after, 1)
+        limit.release(10, seconds=0.2)
+        self.assertAlmostEqual(limit.seconds_per_cost.value, 0.011)
+        self.assertEqual(limit.acquire(10), 0.0)
+        limit.release(10)
+
+        # The cost budget applies alongside the request limit, but a request over
+        # the whole budget still runs when nothing else does
+        limit = self.limit(requests=4)
+        limit.acquire(60)
+        with self.assertRaises(Shed):
+            limit.acquire(60)
+        limit.acquire(40)
+        limit.release(60)
+        limit.release(40)
+        limit.acquire(500)
+        self.assertEqual(limit.stats()["running_cost"], 500)
+
+    def test_deadlines(self):
+        limit = self.limit(queue=4)
+        now = time.monotonic()
+        # 100 units at 10 ms each can't finish within 0.5 s
+        with self.assertRaises(Shed) as shed:
+            limit.acquire(100, deadline=now + 0.5)
+        self.assertEqual(shed.exception.reason, "deadline")
+
+        # Waiting gives up when what's left of the deadline no longer covers the
+        # request itself
+        limit.acquire(1)
+        start = time.monotonic()
+        with self.assertRaises(Shed) as shed:
+            limit.acquire(5, deadline=start + 0.2)
+        self.assertEqual(shed.exception.reason, "deadline")
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(limit.stats()["waiting"], 0)
+
+    def test_waiting_request_runs_after_release(self):
+        import threading
+
+        limit = self.limit(queue=1)
+        limit.acquire(1)
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(limit.acquire(1)))
+        thread.start()
+        time.sleep(0.1)
+        limit.release(1)
+        thread.join()
+        self.assertGreater(waited[0], 0.05)
+
+    def test_shared_across_processes_and_reclaimed(self):
+        limit = self.limit()
+        ready = multiprocessing.Event()
+        done = multiprocessing.Event()
+
+        def hold():
+            limit.acquire(1)
+            ready.set()
+            done.wait(5)
+
+        # A forked worker holds the only slot, then dies without releasing it
+        worker = multiprocessing.get_context("fork").Process(target=hold)
+        worker.start()
+        ready.wait(5)
+        with self.assertRaises(Shed):
+            limit.acquire(1)
+        done.set()
+        worker.join()
+        self.assertEqual(limit.acquire(1), 0.0)
+
+    def test_killed_waiter_or_lock_holder_blocks_nobody(self):
+        import signal
+        import threading
+
+        fork = multiprocessing.get_context("fork")
+        limit = self.limit(queue=1)
+        limit.acquire(1)
+
+        def returns(call):
+            # call must finish within a second, rather than hang the test
+            thread = threading.Thread(target=call, daemon=True)
+            thread.start()
+            thread.join(1)
+            return not thread.is_alive()
+
+        # A forked worker killed while it waits for the slot
+        waiter = fork.Process(target=lambda: limit.acquire(1))
+        waiter.start()
+        deadline = time.monotonic() + 5
+        while limit.stats()["waiting"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(limit.stats()["waiting"], 1)
+        os.kill(waiter.pid, signal.SIGKILL)
+        waiter.join()
+        self.assertTrue(returns(lambda: limit.release(1)))
+        # Its place in the queue is reclaimed too
+        self.assertTrue(returns(lambda: limit.acquire(1)))
+        self.assertEqual(limit.stats()["waiting"], 0)
+
+        # A forked worker killed while it holds the lock
+        ready = fork.Event()
+
+        def hold_lock():
+            with limit._locked():
+                ready.set()
+                time.sleep(30)
+
+        holder = fork.Process(target=hold_lock)
+        holder.start()
+        ready.wait(5)
+        os.kill(holder.pid, signal.SIGKILL)
+        holder.join()
+        self.assertTrue(returns(lambda: limit.release(1)))
+        self.assertTrue(returns(lambda: limit.acquire(1)))
+        limit.release(1)
+
+    def test_service_sheds_with_retry_after(self):
+        import flaskApp
+        import metrics
+        from inferenceService import WARMUP_READINGS
+
+        client = flaskApp.app.test_client()
+        limit = flaskApp.admission_limits["/estimate-a1c"]
+        cost = limit.max_cost
+        limit.acquire(cost)
+        try:
+            response = client.post("/estimate-a1c", json={"readings": WARMUP_READINGS})
+        finally:
+            limit.release(cost)
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+        self.assertEqual(response.get_json()["reason"], "queue_full")
+
+        response = client.post(
+            "/estimate-a1c",
+            json={"readings": WARMUP_READINGS * 1000},
+            headers={DEADLINE_HEADER: "1"},
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.get_json()["reason"], "deadline")
+        if metrics.ENABLED:
+            self.assertIn(
+                'sugarcheck_shed_requests_total{endpoint="/estimate-a1c",'
+                'reason="deadline"}',
+                metrics.render(),
+            )
+
+        response = client.post("/estimate-a1c", json={"readings": WARMUP_READINGS})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(limit.stats()["running"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
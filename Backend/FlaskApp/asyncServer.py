@@ -0,0 +1,549 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from glucosePayload import BINARY_CONTENT_TYPE, to_binary
+from inferenceService import (
+    WARMUP_QUESTIONNAIRE,
+    WARMUP_READINGS,
+    a1c_features,
+    a1c_shards,
+    estimate_a1c_batch,
+    estimate_a1c_many,
+    models,
+    predict_questionnaires,
+    questionnaire_encoder,
+    start_model_watcher,
+)
+
+# ASGI serving mode for /predict and /estimate-a1c. Requests for each model go on a
+# queue, and a dispatcher turns whatever arrived within the batch window into one
+# vectorized call: a single model prediction for /predict, and a single
+# preprocessing pass plus prediction for /estimate-a1c. Run it with
+# `python asyncServer.py` or any ASGI server, e.g. `uvicorn asyncServer:app`
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "64"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "0"))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "2"))
+
+
+class MicroBatcher:
+    # Each request submits one item and gets back its own result. The dispatcher
+    # takes the first waiting request and keeps collecting until max_size (in
+    # rows, as given by each submit) or max_wait seconds, then hands the whole list
+    # of items to process in the executor. process returns one result per item;
+    # an exception instance fails just that request. If process raises, the items
+    # are run again one at a time, so one malformed request can't fail the others
+    # batched with it. With max_wait 0 a batch is whatever queued up while the
+    # previous one was running
+    def __init__(self, process, max_size=64, max_wait=0.0, executor=None):
+        self.process = process
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.executor = executor
+        self.queue = None
+        self.task = None
+        self.requests = 0
+        self.batches = 0
+        self.rows = 0
+        self.split_batches = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def submit(self, item, size=1):
+        if self.task is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((item, size, future))
+        result = await future
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        size = batch[0][1]
+        deadline = loop.time() + self.max_wait
+        while size < self.max_size:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                entry = self.queue.get_nowait()
+            batch.append(entry)
+            size += entry[1]
+        return batch
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Requests cancelled while waiting are dropped from the batch
+            batch = [entry for entry in batch if not entry[2].done()]
+            if not batch:
+                continue
+            items = [item for item, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.process, items)
+            except Exception as e:
+                if len(items) == 1:
+                    results = [e]
+                else:
+                    self.split_batches += 1
+                    results = await loop.run_in_executor(
+                        self.executor, self._process_each, items
+                    )
+
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            self.requests += len(batch)
+            self.batches += 1
+            self.rows += sum(size for _, size, _ in batch)
+
+    def _process_each(self, items):
+        results = []
+        for item in items:
+            try:
+                results.extend(self.process([item]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "split_batches": self.split_batches,
+            "rows": self.rows,
+            "mean_batch_rows": self.rows / self.batches if self.batches else 0.0,
+        }
+
+
+def predict_blocks(blocks):
+    # One prediction for every questionnaire in the batch, split back per request
+    predictions = predict_questionnaires(np.vstack(blocks))
+    return np.split(predictions, np.cumsum([len(block) for block in blocks])[:-1])
+
+
+batchers = {}
+inference_executor = None
+
+
+def get_batchers():
+    # Created on first use, on the server's event loop
+    global inference_executor
+    if not batchers:
+        inference_executor = ThreadPoolExecutor(BATCH_WORKERS)
+        settings = {
+            "max_size": BATCH_MAX_SIZE,
+            "max_wait": BATCH_MAX_WAIT_MS / 1e3,
+            "executor": inference_executor,
+        }
+        batchers["diabetes"] = MicroBatcher(predict_blocks, **settings)
+        batchers["a1c"] = MicroBatcher(estimate_a1c_many, **settings)
+    return batchers
+
+
+def warm_up():
+    start = time.perf_counter()
+    predict_questionnaires(questionnaire_encoder().encode(WARMUP_QUESTIONNAIRE))
+    estimate_a1c_many([WARMUP_READINGS])
+    print(f"Warm-up done in {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_response(send, status, payload, content_type="application/json"):
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(body)).encode()),
+                # Same open CORS policy as flask_cors in flaskApp
+                (b"access-control-allow-origin", b"*"),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def handle_predict(data):
+    if not data:
+        return 400, b"No data provided"
+    try:
+        features = questionnaire_encoder().encode(data)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    prediction = await get_batchers()["diabetes"].submit(features, len(features))
+    return 200, prediction.tolist()
+
+
+async def handle_estimate_a1c(data):
+    if isinstance(data, dict) and data.get("incremental"):
+        # The per-patient state lives in the Flask worker processes
+        return 400, {"error": "Incremental mode is only served by flaskApp"}
+    try:
+        # Preprocessing is batched too: one pass over every queued request, which
+        # also parses each payload (see glucosePayload.py) off the event loop
+        hba1c = await get_batchers()["a1c"].submit(data)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    return 200, {"HbA1c": hba1c}
+
+
+async def handle_estimate_a1c_batch(data):
+    # Every patient goes on the A1c queue as its own request, so patients from
+    # concurrent batch and single requests share preprocessing passes
+    patients = data.get("patients") if isinstance(data, dict) else data
+    if not isinstance(patients, list):
+        return 400, {"error": "Expected a JSON object with a 'patients' list"}
+    batcher = get_batchers()["a1c"]
+    estimates = await asyncio.gather(
+        *[batcher.submit(patient) for patient in patients if isinstance(patient, dict)],
+        return_exceptions=True,
+    )
+    for estimate in estimates:
+        # Only ValueErrors are about a patient's readings; anything else fails
+        if isinstance(estimate, Exception) and not isinstance(estimate, ValueError):
+            raise estimate
+    estimates = iter(estimates)
+    results = []
+    for i, patient in enumerate(patients):
+        result = {"index": i}
+        if not isinstance(patient, dict):
+            result["error"] = "Patient must be a JSON object"
+            results.append(result)
+            continue
+        if "patient_id" in patient:
+            result["patient_id"] = patient["patient_id"]
+        estimate = next(estimates)
+        if isinstance(estimate, Exception):
+            result["error"] = str(estimate)
+        else:
+            result["HbA1c"] = estimate
+        results.append(result)
+    return 200, results
+
+
+async def handle_batch_stats(data):
+    return 200, {name: batcher.stats() for name, batcher in get_batchers().items()}
+
+
+ROUTES = {
+    ("POST", "/predict"): handle_predict,
+    ("POST", "/estimate-a1c"): handle_estimate_a1c,
+    ("POST", "/estimate-a1c-batch"): handle_estimate_a1c_batch,
+    ("GET", "/batch-stats"): handle_batch_stats,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            start_model_watcher()
+            if os.environ.get("WARMUP") == "1":
+                await asyncio.get_running_loop().run_in_executor(None, warm_up)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for batcher in batchers.values():
+                await batcher.stop()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    body = await read_body(receive)
+    if scope["method"] == "OPTIONS":
+        return await send_response(send, 204, b"", "text/plain")
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        return await send_response(send, 404, {"error": "Not found"})
+
+    headers = dict(scope.get("headers", []))
+    body_type = headers.get(b"content-type", b"").split(b";")[0].decode()
+    try:
+        if body_type == BINARY_CONTENT_TYPE:
+            data = body
+        else:
+            data = json.loads(body) if body else {}
+    except ValueError as e:
+        return await send_response(send, 400, {"error": f"Invalid JSON: {e}"})
+    try:
+        status, payload = await handler(data)
+    except Exception as e:
+        status, payload = 500, {"error": str(e)}
+    content_type = "text/plain" if isinstance(payload, bytes) else "application/json"
+    await send_response(send, status, payload, content_type)
+
+
+def main():
+    global BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, BATCH_WORKERS
+
+    parser = argparse.ArgumentParser(description="Micro-batching inference server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--max-batch-size", type=int, default=BATCH_MAX_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=BATCH_MAX_WAIT_MS)
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    args = parser.parse_args()
+    BATCH_MAX_SIZE = args.max_batch_size
+    BATCH_MAX_WAIT_MS = args.max_wait_ms
+    BATCH_WORKERS = args.workers
+
+    import uvicorn
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+# TESTING
+class TestMicroBatcher(unittest.TestCase):
+    def test_concurrent_requests_share_a_batch(self):
+        calls = []
+
+        def process(items):
+            calls.append(len(items))
+            return [item * 2 for item in items]
+
+        async def run():
+            batcher = MicroBatcher(process, max_size=64, max_wait=0.05)
+            results = await asyncio.gather(*[batcher.submit(i) for i in range(20)])
+            await batcher.stop()
+            return results
+
+        self.assertEqual(asyncio.run(run()), [2 * i for i in range(20)])
+        self.assertEqual(calls, [20])
+
+    def test_batches_are_bounded(self):
+        calls = []
+
+        def process(items):
+            calls.append(sum(len(item) for item in items))
+            return predict_blocks(items)
+
+        async def run():
+            batcher = MicroBatcher(process, max_size=8, max_wait=0.05)
+            row = questionnaire_encoder().encode(WARMUP_QUESTIONNAIRE)
+            blocks = [np.vstack([row] * (1 + i % 2)) for i in range(12)]
+            results = await asyncio.gather(
+                *[batcher.submit(block, len(block)) for block in blocks]
+            )
+            await batcher.stop()
+            return blocks, results
+
+        blocks, results = asyncio.run(run())
+        for block, result in zip(blocks, results):
+            np.testing.assert_array_equal(result, predict_questionnaires(block))
+        # A batch closes once it reaches 8 rows, without splitting a request
+        self.assertEqual(calls, [9, 9])
+
+    def test_errors_are_per_request(self):
+        def process(items):
+            if items == ["fail all"]:
+                raise RuntimeError("model failed")
+            return [ValueError(item) if item == "bad" else item for item in items]
+
+        async def run():
+            batcher = MicroBatcher(process, max_wait=0.01)
+            results = await asyncio.gather(
+                batcher.submit("good"),
+                batcher.submit("bad"),
+                return_exceptions=True,
+            )
+            failed = await asyncio.gather(
+                batcher.submit("fail all"), return_exceptions=True
+            )
+            await batcher.stop()
+            return results + failed
+
+        good, bad, failed = asyncio.run(run())
+        self.assertEqual(good, "good")
+        self.assertIsInstance(bad, ValueError)
+        self.assertIsInstance(failed, RuntimeError)
+
+    def test_failed_batch_is_retried_per_request(self):
+        calls = []
+
+        # Like a preprocessing pass that raises on one malformed payload
+        def process(items):
+            calls.append(len(items))
+            if "malformed" in items:
+                raise ValueError("Per-column arrays must each be 1-dimensional")
+            return [item.upper() for item in items]
+
+        async def run():
+            batcher = MicroBatcher(process, max_wait=0.05)
+            results = await asyncio.gather(
+                *[batcher.submit(item) for item in ["a", "malformed", "b"]],
+                return_exceptions=True,
+            )
+            await batcher.stop()
+            return results, batcher.stats()
+
+        (first, malformed, last), stats = asyncio.run(run())
+        self.assertEqual((first, last), ("A", "B"))
+        self.assertIsInstance(malformed, ValueError)
+        self.assertEqual(calls, [3, 1, 1, 1])
+        self.assertEqual((stats["batches"], stats["split_batches"]), (1, 1))
+
+    def test_batched_a1c_matches_single_requests(self):
+        import pandas as pd
+
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        data = pd.read_csv(
+            os.path.join(dir_path, "../../Dataset/synthetic_diabetes_data_v6.csv")
+        )
+        requests = [
+            [
+                {"timestamp": t, "blood_glucose": g}
+                for t, g in zip(group["Timestamp"], group["Blood_Glucose"])
+            ]
+            for _, group in data[data["Patient_ID"] <= 5].groupby("Patient_ID")
+        ]
+        requests += [WARMUP_READINGS[:1], [{"blood_glucose": 100}]]
+        results = estimate_a1c_many(requests)
+        for readings, result in zip(requests[:-2], results):
+            expected = np.mean(models.get("a1c").predict(a1c_features(readings)))
+            self.assertAlmostEqual(result, expected, places=10)
+        self.assertIsInstance(results[-2], ValueError)
+        self.assertIsInstance(results[-1], ValueError)
+
+    def test_sharded_a1c_batch_matches_one_pass(self):
+        patients = [
+            {"patient_id": f"p{i}", "readings": WARMUP_READINGS[i % 3 :]}
+            for i in range(10)
+        ]
+        patients.insert(4, {"patient_id": "short", "readings": WARMUP_READINGS[:1]})
+        shards = a1c_shards(patients, 60)
+        self.assertGreater(len(shards), 1)
+        self.assertEqual([end for _, end in shards][-1], len(patients))
+
+        import inferenceService
+
+        expected = estimate_a1c_many(patients)
+        workers = inferenceService.A1C_SHARD_WORKERS
+        inferenceService.A1C_SHARD_WORKERS = 2
+        try:
+            sharded = estimate_a1c_batch(patients, max_readings=60)
+        finally:
+            inferenceService.A1C_SHARD_WORKERS = workers
+        self.assertIsNotNone(inferenceService.shard_executor)
+        self.assertIsInstance(sharded[4], ValueError)
+        for result, one_pass in zip(sharded, expected):
+            if isinstance(one_pass, ValueError):
+                self.assertIsInstance(result, ValueError)
+            else:
+                self.assertAlmostEqual(result, one_pass, places=10)
+
+    def test_predict_endpoint(self):
+        async def request(path, payload):
+            messages = []
+            headers = []
+            if isinstance(payload, bytes):
+                body = payload
+                headers.append((b"content-type", BINARY_CONTENT_TYPE.encode()))
+            else:
+                body = json.dumps(payload).encode()
+
+            async def receive():
+                return {"type": "http.request", "body": body}
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {"type": "http", "method": "POST", "path": path, "headers": headers}
+            await app(scope, receive, send)
+            return messages[0]["status"], json.loads(messages[1]["body"])
+
+        seconds = [
+            int(np.datetime64(reading["timestamp"], "s").astype(np.int64))
+            for reading in WARMUP_READINGS
+        ]
+        glucose = [reading["blood_glucose"] for reading in WARMUP_READINGS]
+
+        async def run():
+            results = await asyncio.gather(
+                request("/predict", WARMUP_QUESTIONNAIRE),
+                request("/predict", dict(WARMUP_QUESTIONNAIRE, gender="Robot")),
+                request("/estimate-a1c", {"readings": WARMUP_READINGS}),
+                request(
+                    "/estimate-a1c", {"timestamps": seconds, "blood_glucose": glucose}
+                ),
+                request("/estimate-a1c", to_binary(seconds, glucose)),
+                request(
+                    "/estimate-a1c-batch",
+                    {
+                        "patients": [
+                            {"patient_id": 7, "readings": WARMUP_READINGS},
+                            {"patient_id": 8, "readings": WARMUP_READINGS[:1]},
+                            "not a patient",
+                        ]
+                    },
+                ),
+            )
+            for batcher in batchers.values():
+                await batcher.stop()
+            batchers.clear()
+            return results
+
+        predict, invalid, a1c, columnar, binary, batch = asyncio.run(run())
+        expected = predict_questionnaires(
+            questionnaire_encoder().encode(WARMUP_QUESTIONNAIRE)
+        )
+        self.assertEqual(predict, (200, expected.tolist()))
+        self.assertEqual(invalid[0], 400)
+        self.assertEqual(a1c[0], 200)
+        self.assertAlmostEqual(
+            a1c[1]["HbA1c"],
+            float(np.mean(models.get("a1c").predict(a1c_features(WARMUP_READINGS)))),
+        )
+        self.assertEqual(columnar, a1c)
+        self.assertEqual(binary, a1c)
+        self.assertEqual(batch[0], 200)
+        self.assertEqual(
+            batch[1][0], {"index": 0, "patient_id": 7, "HbA1c": a1c[1]["HbA1c"]}
+        )
+        self.assertEqual(set(batch[1][1]), {"index", "patient_id", "error"})
+        self.assertEqual(set(batch[1][2]), {"index", "error"})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,539 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from modelData import a1c_split, diabetes_split
+
+# Benchmarks for the serving endpoints and the ML pipelines. `run` writes the results
+# with a description of the machine and commit to a JSON file, and `compare` flags
+# the metrics that got worse between two such files. Metrics ending in _per_s are
+# throughputs (higher is better); every other metric is a time (lower is better)
+dir_path = os.path.dirname(os.path.realpath(__file__))
+ml_models_path = os.path.join(dir_path, "../ML-Models")
+
+# Serving is measured without the result cache and without request logs, so every
+# request goes through the model
+os.environ.setdefault("PREDICT_CACHE_SIZE", "0")
+os.environ.setdefault("LOG_SAMPLE_RATE", "0")
+
+
+def environment():
+    import pandas as pd
+    import sklearn
+
+    def git(*args):
+        result = subprocess.run(
+            ["git", *args], cwd=dir_path, capture_output=True, text=True
+        )
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+    }
+
+
+def latency_metrics(seconds):
+    ms = np.asarray(seconds) * 1e3
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+    }
+
+
+def time_calls(call, repeat):
+    call()  # Warm-up
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def flask_client():
+    import flaskApp
+
+    return flaskApp.app.test_client()
+
+
+def checked_post(client, path, payload):
+    response = client.post(path, json=payload)
+    if response.status_code != 200:
+        raise RuntimeError(f"{path} returned {response.status_code}: {response.data}")
+    return response
+
+
+def glucose_readings(days, readings_per_day=3, seed=0):
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2024-01-01T00:00")
+    step = np.timedelta64(24 * 60 // readings_per_day, "m")
+    return [
+        {
+            "timestamp": str(start + i * step),
+            "blood_glucose": round(float(rng.normal(140, 25)), 1),
+        }
+        for i in range(days * readings_per_day)
+    ]
+
+
+def bench_predict(repeat, quick):
+    from inferenceService import WARMUP_QUESTIONNAIRE
+
+    client = flask_client()
+    seconds = time_calls(
+        lambda: checked_post(client, "/predict", WARMUP_QUESTIONNAIRE), repeat
+    )
+    yield {}, latency_metrics(seconds)
+
+
+def bench_predict_batch(repeat, quick):
+    from inferenceService import WARMUP_QUESTIONNAIRE
+
+    client = flask_client()
+    for size in (10, 100) if quick else (10, 100, 1000):
+        records = [dict(WARMUP_QUESTIONNAIRE, age=20 + i % 60) for i in range(size)]
+        seconds = time_calls(
+            lambda: checked_post(client, "/predict-batch", records),
+            max(3, repeat // 10),
+        )
+        metrics = latency_metrics(seconds)
+        metrics["records_per_s"] = size / float(np.median(seconds))
+        yield {"records": size}, metrics
+
+
+def bench_estimate_a1c(repeat, quick):
+    client = flask_client()
+    # One week to one year of history, three readings a day
+    for days in (7, 30, 90) if quick else (7, 30, 90, 180, 365):
+        payload = {"readings": glucose_readings(days)}
+        seconds = time_calls(
+            lambda: checked_post(client, "/estimate-a1c", payload),
+            max(3, repeat // 10),
+        )
+        metrics = latency_metrics(seconds)
+        metrics["readings_per_s"] = len(payload["readings"]) / float(np.median(seconds))
+        yield {"days": days}, metrics
+
+
+def bench_a1c_payload(repeat, quick):
+    from glucosePayload import BINARY_CONTENT_TYPE, to_binary
+
+    client = flask_client()
+    # A year of fingersticks, and a year of CGM readings every 15 minutes
+    for readings_per_day in (3,) if quick else (3, 96):
+        readings = glucose_readings(365, readings_per_day)
+        seconds = [
+            int(np.datetime64(reading["timestamp"], "s").astype(np.int64))
+            for reading in readings
+        ]
+        glucose = [reading["blood_glucose"] for reading in readings]
+        requests = {
+            "json": {"json": {"readings": readings}},
+            "columns": {"json": {"timestamps": seconds, "blood_glucose": glucose}},
+            "binary": {
+                "data": to_binary(seconds, glucose),
+                "content_type": BINARY_CONTENT_TYPE,
+            },
+        }
+        for payload_format, kwargs in requests.items():
+
+            def post():
+                response = client.post("/estimate-a1c", **kwargs)
+                if response.status_code != 200:
+                    raise RuntimeError(f"/estimate-a1c returned {response.data}")
+
+            seconds_taken = time_calls(post, max(3, repeat // 20))
+            metrics = latency_metrics(seconds_taken)
+            metrics["readings_per_s"] = len(readings) / float(np.median(seconds_taken))
+            yield {
+                "format": payload_format,
+                "readings": len(readings),
+            }, metrics
+
+
+def bench_a1c_batch(repeat, quick):
+    client = flask_client()
+    # Patients with 90 days of readings each, one request per patient against one
+    # /estimate-a1c-batch request for all of them
+    for count in (10, 100) if quick else (10, 100, 1000):
+        patients = [
+            {"patient_id": i, "readings": glucose_readings(90, seed=i)}
+            for i in range(count)
+        ]
+        modes = {
+            "single": lambda: [
+                checked_post(client, "/estimate-a1c", patient) for patient in patients
+            ],
+            "batch": lambda: checked_post(
+                client, "/estimate-a1c-batch", {"patients": patients}
+            ),
+        }
+        for mode, call in modes.items():
+            median = float(np.median(time_calls(call, 3)))
+            yield {"mode": mode, "patients": count}, {
+                "median_s": median,
+                "patients_per_s": count / median,
+            }
+
+
+def bench_timestamp_parse(repeat, quick):
+    import pandas as pd
+    from glucosePayload import parse_timestamps, timestamp_parsers
+
+    for readings_per_day in (3,) if quick else (3, 96):
+        timestamps = [
+            reading["timestamp"] for reading in glucose_readings(365, readings_per_day)
+        ]
+        parsers = {
+            # What /estimate-a1c did before: format inference on every request
+            "pandas": lambda: pd.to_datetime(pd.Series(timestamps)),
+            "cached": lambda: parse_timestamps(timestamps),
+        }
+        timestamp_parsers.clear()
+        for parser, call in parsers.items():
+            median = float(np.median(time_calls(call, max(3, repeat // 20))))
+            yield {"parser": parser, "readings": len(timestamps)}, {
+                "median_ms": median * 1e3,
+                "readings_per_s": len(timestamps) / median,
+            }
+
+
+def synthetic_cohort(patients, days=90, readings_per_day=3, seed=0):
+    import pandas as pd
+
+    sys.path.insert(0, os.path.join(ml_models_path, "A1c-Estimation"))
+    from SyntheticDataset import generate_block, reading_timestamps
+
+    shard = generate_block(seed, 1, patients, days, readings_per_day, (0.2, 0.3, 0.5))
+    timestamps = reading_timestamps(days, readings_per_day)
+    return pd.DataFrame(
+        {
+            "Patient_ID": shard["Patient_ID"],
+            "Timestamp": np.tile(timestamps.to_numpy(), patients),
+            "Blood_Glucose": shard["Blood_Glucose"],
+            "HbA1c": shard["HbA1c"],
+        }
+    )
+
+
+def bench_preprocessor(repeat, quick):
+    from glucosePreprocessor import GlucoseDataPreprocessor
+
+    for patients in (10, 100) if quick else (10, 100, 1000):
+        data = synthetic_cohort(patients)
+        preprocessor = GlucoseDataPreprocessor()
+        seconds = time_calls(
+            lambda: preprocessor.transform(data), 3 if patients >= 1000 else 5
+        )
+        median = float(np.median(seconds))
+        yield {"patients": patients}, {
+            "median_s": median,
+            "readings_per_s": len(data) / median,
+        }
+
+
+def bench_synthetic_dataset(repeat, quick):
+    sys.path.insert(0, os.path.join(ml_models_path, "A1c-Estimation"))
+    from SyntheticDataset import generate_dataset
+
+    patients = 200 if quick else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        for output_format in ("csv", "cols"):
+            output = os.path.join(tmp, f"cohort.{output_format}")
+            seconds = time_calls(
+                lambda: generate_dataset(
+                    output,
+                    num_patients=patients,
+                    shard_size=500,
+                    output_format=output_format,
+                ),
+                3,
+            )
+            median = float(np.median(seconds))
+            yield {"format": output_format, "patients": patients}, {
+                "median_s": median,
+                "readings_per_s": patients * 90 * 3 / median,
+            }
+
+
+def diabetes_training_data():
+    X_train, _, y_train, _ = diabetes_split()
+    return X_train, y_train
+
+
+def a1c_training_data():
+    X_train, _, y_train, _ = a1c_split()
+    return X_train, y_train
+
+
+def bench_training(repeat, quick):
+    # The searches of both training scripts, timed without the fold cache and
+    # without writing any model
+    from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+    from sklearn.model_selection import KFold
+
+    sys.path.insert(0, ml_models_path)
+    from trainingDriver import ForestSearch
+
+    n_estimators = [50] if quick else [50, 100, 200]
+    searches = {
+        "diabetes": (
+            diabetes_training_data,
+            lambda: ForestSearch(
+                RandomForestClassifier(random_state=0),
+                {"n_estimators": n_estimators, "max_depth": [10, 20, 30]},
+                cv=5,
+                scoring="accuracy",
+                cache_dir=None,
+                verbose=False,
+            ),
+        ),
+        "a1c": (
+            a1c_training_data,
+            lambda: ForestSearch(
+                RandomForestRegressor(random_state=42),
+                {"n_estimators": n_estimators, "max_depth": [None, 10, 20, 30]},
+                cv=KFold(n_splits=5, shuffle=True, random_state=42),
+                scoring="r2",
+                cache_dir=None,
+                verbose=False,
+            ),
+        ),
+    }
+    for model, (load, make_search) in searches.items():
+        search = make_search().fit(*load())
+        yield {"model": model, "n_estimators": n_estimators}, {
+            "grid_search_s": search.stats_["search_s"],
+            "refit_s": search.stats_["refit_s"],
+        }
+
+
+BENCHMARKS = {
+    "predict": bench_predict,
+    "predict-batch": bench_predict_batch,
+    "estimate-a1c": bench_estimate_a1c,
+    "a1c-payload": bench_a1c_payload,
+    "a1c-batch": bench_a1c_batch,
+    "timestamp-parse": bench_timestamp_parse,
+    "preprocessor": bench_preprocessor,
+    "synthetic-dataset": bench_synthetic_dataset,
+    "training": bench_training,
+}
+
+
+def run_benchmarks(names, repeat=200, quick=False, report=print):
+    # The Flask app loads its models relative to this directory
+    cwd = os.getcwd()
+    os.chdir(dir_path)
+    try:
+        results = []
+        for name in names:
+            for params, metrics in BENCHMARKS[name](repeat, quick):
+                results.append({"name": name, "params": params, "metrics": metrics})
+                report(format_result(results[-1]))
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+def format_result(result):
+    params = " ".join(f"{key}={value}" for key, value in result["params"].items())
+    metrics = ", ".join(
+        f"{key} {value:,.3f}" for key, value in result["metrics"].items()
+    )
+    return f"{result['name']:>18} {params:<28} {metrics}"
+
+
+def result_key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare_results(base, new, threshold=0.1, tail=False):
+    # Relative change of every metric present in both runs; a regression is a
+    # change for the worse beyond threshold. p99 latencies over a few dozen requests
+    # are too noisy to gate on, so they are only flagged with tail=True
+    base_results = {result_key(result): result for result in base["benchmarks"]}
+    rows = []
+    for result in new["benchmarks"]:
+        previous = base_results.get(result_key(result))
+        if previous is None:
+            continue
+        for metric, value in result["metrics"].items():
+            old = previous["metrics"].get(metric)
+            if not old:
+                continue
+            change = value / old - 1
+            worse = -change if metric.endswith("_per_s") else change
+            rows.append(
+                {
+                    "name": result["name"],
+                    "params": result["params"],
+                    "metric": metric,
+                    "base": old,
+                    "new": value,
+                    "change": change,
+                    "regression": worse > threshold
+                    and (tail or not metric.startswith("p99")),
+                }
+            )
+    return rows
+
+
+def environment_differences(base, new):
+    ignored = {"timestamp", "commit", "dirty"}
+    keys = set(base) | set(new)
+    return {
+        key: (base.get(key), new.get(key))
+        for key in sorted(keys - ignored)
+        if base.get(key) != new.get(key)
+    }
+
+
+def compare_files(base_path, new_path, threshold, tail=False):
+    with open(base_path) as file:
+        base = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+
+    print(
+        f"Base {base['environment']['commit']} ({base['environment']['timestamp']}),"
+        f" new {new['environment']['commit']} ({new['environment']['timestamp']})"
+    )
+    for key, (old, value) in environment_differences(
+        base["environment"], new["environment"]
+    ).items():
+        print(f"  environment differs: {key} {old} -> {value}")
+    if base.get("quick") != new.get("quick"):
+        print("  only one of the runs used --quick")
+
+    rows = compare_results(base, new, threshold, tail)
+    for row in rows:
+        params = " ".join(f"{key}={value}" for key, value in row["params"].items())
+        flag = "REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['name']:>18} {params:<28} {row['metric']:<15} "
+            f"{row['base']:>12,.3f} {row['new']:>12,.3f} {row['change']:>+8.1%} {flag}"
+        )
+    regressions = sum(row["regression"] for row in rows)
+    print(f"{regressions} regressions over {threshold:.0%} in {len(rows)} metrics")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serving and ML pipeline benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run benchmarks and write a JSON report")
+    run.add_argument(
+        "--only", action="append", choices=list(BENCHMARKS), help="Default: all"
+    )
+    run.add_argument("--repeat", type=int, default=200, help="Requests per latency")
+    run.add_argument(
+        "--quick", action="store_true", help="Smaller sizes and a reduced grid"
+    )
+    run.add_argument("--output", default="benchmark-results.json")
+
+    compare = commands.add_parser("compare", help="Flag regressions between runs")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument(
+        "--threshold", type=float, default=0.1, help="Allowed relative change"
+    )
+    compare.add_argument(
+        "--tail", action="store_true", help="Also flag p99 latency regressions"
+    )
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        return compare_files(args.base, args.new, args.threshold, args.tail)
+
+    report = {
+        "environment": environment(),
+        "quick": args.quick,
+        "benchmarks": run_benchmarks(
+            args.only or list(BENCHMARKS), args.repeat, args.quick
+        ),
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+    return 0
+
+
+# TESTING
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_compare_flags_regressions(self):
+        base = {
+            "benchmarks": [
+                {
+                    "name": "predict",
+                    "params": {},
+                    "metrics": {
+                        "p50_ms": 1.0,
+                        "p99_ms": 2.0,
+                        "records_per_s": 1000.0,
+                    },
+                },
+                {"name": "training", "params": {"model": "a1c"}, "metrics": {}},
+            ]
+        }
+        new = {
+            "benchmarks": [
+                {
+                    "name": "predict",
+                    "params": {},
+                    "metrics": {
+                        "p50_ms": 1.05,
+                        "p99_ms": 3.0,
+                        "records_per_s": 800.0,
+                    },
+                },
+                {"name": "removed", "params": {}, "metrics": {"p50_ms": 1.0}},
+            ]
+        }
+        rows = compare_results(base, new, threshold=0.1)
+        self.assertEqual(
+            [(row["metric"], row["regression"]) for row in rows],
+            [("p50_ms", False), ("p99_ms", False), ("records_per_s", True)],
+        )
+        rows = compare_results(base, new, threshold=0.1, tail=True)
+        self.assertTrue(rows[1]["regression"])
+
+    def test_quick_serving_run(self):
+        results = run_benchmarks(
+            ["predict", "estimate-a1c"], repeat=5, quick=True, report=lambda line: None
+        )
+        self.assertEqual(
+            [result["params"] for result in results],
+            [{}, {"days": 7}, {"days": 30}, {"days": 90}],
+        )
+        for result in results:
+            self.assertGreater(result["metrics"]["p50_ms"], 0)
+
+    def test_environment(self):
+        info = environment()
+        self.assertEqual(info["numpy"], np.__version__)
+        self.assertEqual(environment_differences(info, dict(info, commit="x")), {})
+
+
+if __name__ == "__main__":
+    sys.exit(main())
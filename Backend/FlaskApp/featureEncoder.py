@@ -0,0 +1,200 @@
+import math
+import os
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+
+class QuestionnaireEncoder:
+    # Precompiled replacement for the pandas preprocessing of a single questionnaire,
+    # built once from the fitted LabelEncoders and MinMaxScaler
+    def __init__(self, encoders, minmax, feature_columns):
+        self.feature_columns = [str(col) for col in feature_columns]
+        self.n_features = len(self.feature_columns)
+
+        # Class name -> code lookups, in the column order the model was fitted with
+        self.lookups = [
+            (
+                self.feature_columns.index(col),
+                col,
+                {str(cls): float(code) for code, cls in enumerate(encoder.classes_)},
+            )
+            for col, encoder in encoders.items()
+        ]
+
+        # MinMaxScaler.transform is X * scale_ + min_
+        self.age_index = self.feature_columns.index("age")
+        self.age_scale = float(minmax.scale_[0])
+        self.age_offset = float(minmax.min_[0])
+
+    def to_spec(self):
+        # Plain JSON description of the encoder, so serving can rebuild it without
+        # unpickling the sklearn encoders
+        return {
+            "feature_columns": self.feature_columns,
+            "classes": {
+                col: sorted(lookup, key=lookup.get) for _, col, lookup in self.lookups
+            },
+            "age_scale": self.age_scale,
+            "age_offset": self.age_offset,
+        }
+
+    @classmethod
+    def from_spec(cls, spec):
+        encoders = {
+            col: SimpleNamespace(classes_=classes)
+            for col, classes in spec["classes"].items()
+        }
+        minmax = SimpleNamespace(scale_=[spec["age_scale"]], min_=[spec["age_offset"]])
+        return cls(encoders, minmax, spec["feature_columns"])
+
+    def encode(self, data, out=None):
+        if not isinstance(data, dict):
+            raise ValueError("Record must be a JSON object")
+
+        # Lower case keys and title case string values, as the pandas path did
+        values = {str(key).lower(): value for key, value in data.items()}
+
+        row = np.empty((1, self.n_features)) if out is None else out
+        flat = row.reshape(-1)
+
+        for index, col, lookup in self.lookups:
+            value = values.get(col)
+            if type(value) == str:
+                value = value.title()
+            try:
+                flat[index] = lookup[value]
+            except (KeyError, TypeError):
+                raise ValueError(f"Invalid value for '{col}': {value!r}")
+
+        age = values.get("age")
+        try:
+            age = float(age)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid value for 'age': {age!r}")
+        # float() also accepts "nan" and "inf", which the model can't score
+        if not math.isfinite(age):
+            raise ValueError(f"Invalid value for 'age': {values.get('age')!r}")
+        flat[self.age_index] = age * self.age_scale + self.age_offset
+
+        return row
+
+    def encode_many(self, records):
+        # Encode a list of records into one matrix, collecting per-record errors
+        matrix = np.empty((len(records), self.n_features))
+        errors = [None] * len(records)
+        for i, record in enumerate(records):
+            try:
+                self.encode(record, out=matrix[i])
+            except ValueError as e:
+                errors[i] = str(e)
+        return matrix, errors
+
+
+# TESTING
+def pandas_preprocess(data, encoders, minmax):
+    # The original /predict preprocessing, kept as the reference implementation
+    import pandas as pd
+
+    input_df = pd.DataFrame(data, index=[0])
+    input_df = input_df.applymap(lambda s: s.title() if type(s) == str else s)
+    input_df.columns = input_df.columns.str.lower()
+    for col, encoder in encoders.items():
+        if col in input_df:
+            input_df[col] = input_df[col].replace("", np.nan)
+            input_df[col] = encoder.transform(input_df[col])
+    if "age" in input_df:
+        input_df["age"] = minmax.transform(input_df[["age"]])
+    return input_df
+
+
+def fitted_from_spec(spec):
+    # Rebuild the LabelEncoders and MinMaxScaler of an encoder spec as sklearn
+    # objects, for the pandas paths, without unpickling anything
+    from sklearn.preprocessing import LabelEncoder, MinMaxScaler
+
+    encoders = {}
+    for col, classes in spec["classes"].items():
+        encoder = LabelEncoder()
+        encoder.classes_ = np.array(classes, dtype=object)
+        encoders[col] = encoder
+
+    minmax = MinMaxScaler()
+    minmax.scale_ = np.array([spec["age_scale"]])
+    minmax.min_ = np.array([spec["age_offset"]])
+    minmax.n_features_in_ = 1
+    minmax.feature_names_in_ = np.array(["age"], dtype=object)
+    return encoders, minmax
+
+
+class TestQuestionnaireEncoder(unittest.TestCase):
+    def setUp(self):
+        import pickle
+        import pandas as pd
+
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(dir_path, "final_predict_model.pkl"), "rb") as file:
+            self.model = pickle.load(file)
+        with open(os.path.join(dir_path, "encoders.pkl"), "rb") as file:
+            self.encoders = pickle.load(file)
+        with open(os.path.join(dir_path, "minmax.pkl"), "rb") as file:
+            self.minmax = pickle.load(file)
+
+        df = pd.read_csv(
+            os.path.join(dir_path, "../../Dataset/balanced_diabetes_data.csv")
+        )
+        self.records = df.drop("class", axis=1).to_dict("records")
+        self.encoder = QuestionnaireEncoder(
+            self.encoders, self.minmax, self.model.feature_names_in_
+        )
+
+    def test_parity_with_pandas_path(self):
+        for record in self.records:
+            expected = pandas_preprocess(record, self.encoders, self.minmax)
+            expected = expected[self.encoder.feature_columns].to_numpy(dtype=float)
+            np.testing.assert_array_equal(self.encoder.encode(record), expected)
+
+    def test_predictions_match(self):
+        import pandas as pd
+
+        matrix, errors = self.encoder.encode_many(self.records)
+        self.assertEqual(errors, [None] * len(self.records))
+
+        expected = pd.concat(
+            [
+                pandas_preprocess(record, self.encoders, self.minmax)
+                for record in self.records
+            ]
+        )[self.encoder.feature_columns]
+        X = pd.DataFrame(matrix, columns=self.encoder.feature_columns)
+        np.testing.assert_array_equal(
+            self.model.predict(X), self.model.predict(expected)
+        )
+
+    def test_invalid_values(self):
+        record = dict(self.records[0], Gender="Robot")
+        with self.assertRaises(ValueError):
+            self.encoder.encode(record)
+        for age in ("", "nan", "inf", float("-inf")):
+            with self.assertRaises(ValueError):
+                self.encoder.encode(dict(self.records[0], Age=age))
+
+    def test_spec_round_trip(self):
+        import json
+
+        spec = json.loads(json.dumps(self.encoder.to_spec()))
+        rebuilt = QuestionnaireEncoder.from_spec(spec)
+        matrix, _ = self.encoder.encode_many(self.records)
+        np.testing.assert_array_equal(rebuilt.encode_many(self.records)[0], matrix)
+
+        encoders, minmax = fitted_from_spec(spec)
+        for record in self.records[:20]:
+            np.testing.assert_array_equal(
+                pandas_preprocess(record, encoders, minmax).to_numpy(),
+                pandas_preprocess(record, self.encoders, self.minmax).to_numpy(),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,106 +1,608 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-import pickle
-import pandas as pd
-import numpy as np
-from glucosePreprocessor import GlucoseDataPreprocessor
+import atexit
+import json
+import os
+import threading
+import time
+import unittest
+from inferenceService import (
+    WARMUP_QUESTIONNAIRE,
+    WARMUP_READINGS,
+    a1c_features,
+    estimate_a1c_batch,
+    fitted_encoders,
+    models,
+    predict_a1c,
+    predict_questionnaires,
+    questionnaire_encoder,
+    start_model_watcher,
+)
+from glucosePayload import (
+    BINARY_CONTENT_TYPE,
+    payload_length,
+    to_columns,
+)
+from predictionCache import make_cache
+from admissionControl import Shed, limits_from_env, request_cost, request_deadline
+import metrics
+from metrics import stage
+
+# pandas, sklearn and the glucose preprocessor are imported inside the endpoints
+# that need them, so the service starts without paying for them
 
 app = Flask(__name__)
 CORS(app)
 
+# Cache of /predict results, cleared when the diabetes model is reloaded.
+# PREDICT_CACHE_SIZE=0 turns it off; PREDICT_CACHE_PATH keeps it in a SQLite file
+# shared by all workers instead of in each worker's memory
+PREDICT_CACHE_SIZE = int(os.environ.get("PREDICT_CACHE_SIZE", "4096"))
+prediction_cache = None
+if PREDICT_CACHE_SIZE > 0:
+    prediction_cache = make_cache(
+        lambda: models.version("diabetes"),
+        PREDICT_CACHE_SIZE,
+        os.environ.get("PREDICT_CACHE_PATH"),
+    )
+
+
+# Per-endpoint limits on the work in flight, shared by all workers when the app is
+# preloaded (see admissionControl.py). ADMISSION=0 turns them off
+admission_limits = limits_from_env()
+
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    g.log_fields = {}
+    g.endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.current_endpoint.set(g.endpoint)
+    start_model_watcher()
+    return admit_request()
+
+
+def admit_request():
+    limit = admission_limits.get(g.endpoint)
+    if limit is None:
+        return None
+    cost = request_cost(
+        g.endpoint, request.content_length, request.mimetype == BINARY_CONTENT_TYPE
+    )
+    try:
+        waited = limit.acquire(
+            cost, request_deadline(request.headers, time.monotonic())
+        )
+    except Shed as e:
+        if metrics.ENABLED:
+            metrics.SHED_REQUESTS.labels(g.endpoint, e.reason).inc()
+        g.log_fields["shed"] = e.reason
+        response = jsonify({"error": "Server is overloaded", "reason": e.reason})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+    metrics.observe(metrics.ADMISSION_WAIT_SECONDS, waited, g.endpoint)
+    g.admission = (limit, cost, time.perf_counter())
+    return None
+
+
+@app.teardown_request
+def release_admission(exc):
+    # Runs however the request ended, so a failed request gives its room back too
+    admission = g.pop("admission", None)
+    if admission is not None:
+        limit, cost, start = admission
+        limit.release(cost, time.perf_counter() - start)
 
-# Load the diabetes model from disk
-with open("final_predict_model.pkl", "rb") as file:
-    diabetes_model = pickle.load(file)
-# Load the encoders and scaler from disk
-with open("encoders.pkl", "rb") as file:
-    encoders = pickle.load(file)
-with open("minmax.pkl", "rb") as file:
-    minmax = pickle.load(file)
+
+@app.after_request
+def finish_request(response):
+    elapsed = time.perf_counter() - g.request_start
+    if metrics.ENABLED:
+        metrics.REQUESTS.labels(g.endpoint, response.status_code).inc()
+        metrics.REQUEST_SECONDS.labels(g.endpoint).observe(elapsed)
+    metrics.log_request(
+        endpoint=g.endpoint,
+        status=response.status_code,
+        ms=round(elapsed * 1e3, 3),
+        **g.log_fields,
+    )
+    return response
 
 
 @app.route("/predict", methods=["POST"])
 def predict():
-    data = request.get_json()
+    with stage("parse"):
+        data = request.get_json()
     if not data:
         return "No data provided", 400
 
-    # Create a DataFrame from the input data
-    input_df = pd.DataFrame(data, index=[0])
+    # The whole request uses one model even if a reload swaps it meanwhile
+    forest = models.get("diabetes")
+    try:
+        with stage("encode"):
+            features = questionnaire_encoder(forest).encode(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if prediction_cache is not None:
+        with stage("cache"):
+            cached = prediction_cache.get(features, forest.version)
+        if cached is not None:
+            g.log_fields.update(prediction=cached, cached=True)
+            return jsonify([cached])
+
+    with stage("predict"):
+        prediction = predict_questionnaires(features, forest).tolist()
+    g.log_fields.update(prediction=prediction[0], cached=False)
+    if prediction_cache is not None:
+        prediction_cache.put(features, prediction[0], forest.version)
+    with stage("serialize"):
+        return jsonify(prediction)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not metrics.ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    for stats in models.report():
+        metrics.MODEL_LOAD_SECONDS.labels(stats["name"], stats["cached"]).set(
+            stats["load_ms"] / 1e3
+        )
+    for endpoint, limit in admission_limits.items():
+        stats = limit.stats()
+        metrics.ADMISSION_REQUESTS.labels(endpoint, "running").set(stats["running"])
+        metrics.ADMISSION_REQUESTS.labels(endpoint, "waiting").set(stats["waiting"])
+    if prediction_cache is not None:
+        stats = prediction_cache.stats()
+        metrics.PREDICT_CACHE_LOOKUPS.labels("hit").set(stats["hits"])
+        metrics.PREDICT_CACHE_LOOKUPS.labels("miss").set(stats["misses"])
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/predict-cache", methods=["GET"])
+def predict_cache_stats():
+    # Counters are per worker process; size is shared with the SQLite backend
+    if prediction_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(prediction_cache.stats(), enabled=True))
+
+
+def read_batch_records():
+    # Newline-delimited JSON is parsed line by line so a bad line only fails that record
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        records = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError as e:
+                records.append(ValueError(f"Invalid JSON: {e}"))
+        return records
 
-    # Convert all values to title case
-    input_df = input_df.applymap(lambda s: s.title() if type(s) == str else s)
+    data = request.get_json(force=True, silent=True)
+    if isinstance(data, dict):
+        data = data.get("records")
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array of records or NDJSON body")
+    return data
 
-    # Convert column names to lower case
-    input_df.columns = input_df.columns.str.lower()
 
-    # Apply label encoding
+def encode_batch(records, forest=None):
+    import numpy as np
+    import pandas as pd
+
+    encoders, minmax = fitted_encoders(forest)
+    feature_columns = questionnaire_encoder(forest).feature_columns
+    errors = [[] for _ in records]
+
+    rows = {}
+    for i, record in enumerate(records):
+        if isinstance(record, Exception):
+            errors[i].append(str(record))
+        elif not isinstance(record, dict):
+            errors[i].append("Record must be a JSON object")
+        else:
+            rows[i] = {str(key).lower(): value for key, value in record.items()}
+
+    # Build one DataFrame for the whole batch, in the column order used at fit time
+    input_df = pd.DataFrame.from_dict(rows, orient="index").reindex(
+        index=list(rows), columns=feature_columns
+    )
+
+    missing = {}
+    for col in feature_columns:
+        missing[col] = input_df[col].isna() | input_df[col].eq("")
+        for i in input_df.index[missing[col]]:
+            errors[i].append(f"Missing value for '{col}'")
+
+    # Title case string values, leaving other types untouched
     for col, encoder in encoders.items():
-        if col in input_df:
-            # Replace empty strings with NaN
-            input_df[col] = input_df[col].replace("", np.nan)
+        if input_df[col].dtype == object:
+            titled = input_df[col].str.title()
+            input_df[col] = titled.where(titled.notna(), input_df[col])
 
-            input_df[col] = encoder.transform(input_df[col])
+        # Missing values are already reported, so each field gets one error
+        unknown = ~input_df[col].isin(encoder.classes_) & ~missing[col]
+        for i in input_df.index[unknown]:
+            errors[i].append(f"Unknown value for '{col}': {input_df.at[i, col]!r}")
 
-    # Apply MinMax scaling to 'age'
-    if "age" in input_df:
+    ages = pd.to_numeric(input_df["age"], errors="coerce")
+    for i in input_df.index[~np.isfinite(ages) & ~missing["age"]]:
+        errors[i].append(f"Invalid value for 'age': {input_df.at[i, 'age']!r}")
+    input_df["age"] = ages
+
+    valid = [i for i in input_df.index if not errors[i]]
+    input_df = input_df.loc[valid]
+
+    # Apply label encoding and MinMax scaling to every valid record at once
+    if len(input_df):
+        for col, encoder in encoders.items():
+            input_df[col] = encoder.transform(input_df[col])
         input_df["age"] = minmax.transform(input_df[["age"]])
 
-    prediction = diabetes_model.predict(input_df)
-    print("\nPrediction", prediction)
-    return jsonify(prediction.tolist())
+    return input_df, errors
 
 
-# Load the a1c model, and preprocessor
-with open("A1cModel.pkl", "rb") as file:
-    model_data = pickle.load(file)
+@app.route("/predict-batch", methods=["POST"])
+def predict_batch():
+    try:
+        with stage("parse"):
+            records = read_batch_records()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not records:
+        return jsonify([])
+    metrics.observe(metrics.BATCH_RECORDS, len(records))
+    g.log_fields["records"] = len(records)
 
-a1c_model = model_data["model"]
-preprocessor = model_data["preprocessor"]
+    forest = models.get("diabetes")
+    with stage("encode"):
+        input_df, errors = encode_batch(records, forest)
 
+    predictions = {}
+    if len(input_df):
+        with stage("predict"):
+            batch_predictions = predict_questionnaires(input_df.to_numpy(), forest)
+        predictions = dict(zip(input_df.index, batch_predictions.tolist()))
 
-@app.route("/estimate-a1c", methods=["POST"])
-def estimate_a1c():
+    # Results are returned in input order, with an error in place of failed records
+    results = []
+    for i in range(len(records)):
+        if errors[i]:
+            results.append({"index": i, "error": "; ".join(errors[i])})
+        else:
+            results.append({"index": i, "prediction": predictions[i]})
+    with stage("serialize"):
+        return jsonify(results)
+
+
+# Per-patient rolling state for incremental /estimate-a1c calls, optionally
+# snapshotted to a local file so a restarted worker resumes where it left off.
+# The state is per worker, and a snapshot holds only the patients its worker
+# served, so every request carries previous_readings, the number of readings
+# already sent for the patient. A worker whose state doesn't have exactly that
+# many answers 409, and the client sends the full history with previous_readings
+# 0. With several workers that happens whenever a patient moves between them, so
+# incremental mode is meant for a single worker or sticky routing
+A1C_STATE_PATH = os.environ.get("A1C_STATE_PATH")
+A1C_STATE_SNAPSHOT_EVERY = int(os.environ.get("A1C_STATE_SNAPSHOT_EVERY", "100"))
+a1c_state = None
+a1c_state_lock = threading.Lock()
+a1c_state_updates = 0
+
+
+def load_a1c_state():
+    # Called with a1c_state_lock held, on the first incremental request
+    from glucosePreprocessor import IncrementalGlucoseState
+
+    if A1C_STATE_PATH and os.path.exists(A1C_STATE_PATH):
+        return IncrementalGlucoseState.restore(A1C_STATE_PATH)
+    return IncrementalGlucoseState()
+
+
+def snapshot_a1c_state():
+    if A1C_STATE_PATH:
+        with a1c_state_lock:
+            if a1c_state is not None:
+                a1c_state.snapshot(A1C_STATE_PATH)
+
+
+atexit.register(snapshot_a1c_state)
+
+
+def estimate_a1c_incremental(data):
+    global a1c_state, a1c_state_updates
+    from glucosePreprocessor import StaleReadings
+
+    patient_id = data.get("patient_id")
+    if patient_id is None:
+        return jsonify({"error": "patient_id is required in incremental mode"}), 400
+    previous = data.get("previous_readings")
+    if type(previous) != int or previous < 0:
+        return (
+            jsonify({"error": "previous_readings is required in incremental mode"}),
+            400,
+        )
     try:
-        data = request.get_json(force=True)
-        readings = data.get("readings", [])
-        input_data = pd.DataFrame(readings)
-
-        preprocessor = GlucoseDataPreprocessor()
-
-        # Assign a default 'Patient_ID', 'Blood_Glucose' and 'HbA1c'
-        input_data["Patient_ID"] = "default"
-        input_data["Blood_Glucose"] = input_data.get("blood_glucose", 0)
-        input_data["HbA1c"] = input_data.get("HbA1c", 0)
-
-        # Convert 'timestamp' to datetime
-        input_data["Timestamp"] = pd.to_datetime(input_data["timestamp"])
-
-        # Check for required columns
-        expected_cols = {"Patient_ID", "Timestamp", "Blood_Glucose", "HbA1c"}
-        if not expected_cols.issubset(set(input_data.columns)):
-            return (
-                jsonify(
-                    {"error": f"Missing columns, required columns are: {expected_cols}"}
-                ),
-                400,
+        if "timestamps" not in data:
+            readings = data.get("readings", [])
+            # Every reading advances the patient's state, so each needs a timestamp
+            if not isinstance(readings, list) or not all(
+                isinstance(reading, dict) and "timestamp" in reading
+                for reading in readings
+            ):
+                raise ValueError("Readings must be JSON objects with a 'timestamp'")
+        # Checked here, so the state update below can only fail on old readings
+        timestamps, glucose, _ = to_columns(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    metrics.observe(metrics.A1C_READINGS, len(timestamps), "incremental")
+    a1c_forest = models.get("a1c")
+
+    with stage("state_update"), a1c_state_lock:
+        if a1c_state is None:
+            a1c_state = load_a1c_state()
+        try:
+            finalized, current = a1c_state.update(
+                str(patient_id), timestamps, glucose, previous=previous
             )
+        except StaleReadings as e:
+            # The client has to resend the full history to rebuild the state
+            return jsonify({"error": str(e)}), 409
+        if len(finalized):
+            a1c_state.record_outputs(str(patient_id), a1c_forest.predict(finalized))
+        total, count = a1c_state.output_totals(str(patient_id))
+        received = a1c_state.received(str(patient_id))
 
-        # Preprocess the data
-        processed_data = preprocessor.transform(input_data)
+        a1c_state_updates += 1
+        if A1C_STATE_PATH and a1c_state_updates % A1C_STATE_SNAPSHOT_EVERY == 0:
+            a1c_state.snapshot(A1C_STATE_PATH)
 
-        # Make a prediction
-        prediction = a1c_model.predict(
-            processed_data[["rolling_mean", "rolling_median", "rolling_std"]]
+    # The current day is still open, so its prediction is not accumulated yet
+    if current is not None:
+        with stage("predict"):
+            total += float(a1c_forest.predict(current)[0])
+        count += 1
+    if count == 0:
+        return (
+            jsonify(
+                {"error": "Not enough readings to estimate HbA1c", "readings": received}
+            ),
+            400,
         )
 
-        # Calculate the mean of the predictions
-        average_prediction = np.mean(prediction)
+    return jsonify({"HbA1c": total / count, "readings": received})
+
+
+@app.route("/estimate-a1c", methods=["POST"])
+def estimate_a1c():
+    try:
+        with stage("parse"):
+            if request.mimetype == BINARY_CONTENT_TYPE:
+                data = request.get_data()
+            else:
+                data = request.get_json(force=True)
+
+        # Incremental mode only sends the readings added since the last call
+        if isinstance(data, dict) and data.get("incremental"):
+            return estimate_a1c_incremental(data)
 
-        return jsonify({"HbA1c": average_prediction})
+        forest = models.get("a1c")
+        try:
+            columns = to_columns(data)
+            metrics.observe(metrics.A1C_READINGS, len(columns[0]), "full")
+            g.log_fields["readings"] = len(columns[0])
+            features = a1c_features(columns, forest)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        with stage("predict"):
+            hba1c = predict_a1c(features, forest)
+        g.log_fields["hba1c"] = hba1c
+        with stage("serialize"):
+            return jsonify({"HbA1c": hba1c})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/estimate-a1c-batch", methods=["POST"])
+def estimate_a1c_patients():
+    # {"patients": [{"patient_id": ..., "readings": [...]}, ...]}, each patient in
+    # any /estimate-a1c payload format. Patients that can't be estimated get an
+    # error in place of their HbA1c without failing the batch
+    with stage("parse"):
+        data = request.get_json(force=True, silent=True)
+    patients = data.get("patients") if isinstance(data, dict) else data
+    if not isinstance(patients, list):
+        return jsonify({"error": "Expected a JSON object with a 'patients' list"}), 400
+
+    valid = [i for i, patient in enumerate(patients) if isinstance(patient, dict)]
+    with stage("estimate"):
+        estimates = estimate_a1c_batch([patients[i] for i in valid])
+    results = {i: estimate for i, estimate in zip(valid, estimates)}
+    readings = sum(payload_length(patients[i]) for i in valid)
+    metrics.observe(metrics.A1C_READINGS, readings, "batch")
+    g.log_fields.update(patients=len(patients), readings=readings)
+
+    response = []
+    for i, patient in enumerate(patients):
+        result = {"index": i}
+        if i not in results:
+            result["error"] = "Patient must be a JSON object"
+        else:
+            if "patient_id" in patient:
+                result["patient_id"] = patient["patient_id"]
+            if isinstance(results[i], Exception):
+                result["error"] = str(results[i])
+            else:
+                result["HbA1c"] = results[i]
+        response.append(result)
+    with stage("serialize"):
+        return jsonify(response)
+
+
+# Requests sent through the app at boot with WARMUP=1, so lazy imports and model
+# loads happen before the first real request rather than during it
+WARMUP_REQUESTS = [
+    ("/predict", WARMUP_QUESTIONNAIRE),
+    ("/predict-batch", [WARMUP_QUESTIONNAIRE]),
+    ("/estimate-a1c", {"readings": WARMUP_READINGS}),
+]
+
+
+def warm_up():
+    client = app.test_client()
+    for path, payload in WARMUP_REQUESTS:
+        start = time.perf_counter()
+        response = client.post(path, json=payload)
+        print(
+            f"Warm-up {path}: {response.status_code} "
+            f"in {(time.perf_counter() - start) * 1e3:.1f} ms"
+        )
+
+
+# PROFILE_DIR turns on per-request profiling (see requestProfiler.py). Without it
+# the app is left unwrapped, so unprofiled requests run exactly as before
+if os.environ.get("PROFILE_DIR"):
+    from requestProfiler import profiler_from_env
+
+    app.wsgi_app = profiler_from_env().wrap(app.wsgi_app)
+
+if os.environ.get("MODEL_PRELOAD") == "1":
+    models.preload()
+    questionnaire_encoder()
+if os.environ.get("WARMUP") == "1":
+    warm_up()
+
+
+# TESTING
+class TestServiceEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_predict_batch_order_and_errors(self):
+        positive = dict(WARMUP_QUESTIONNAIRE, polyuria="Yes", polydipsia="Yes")
+        records = [
+            WARMUP_QUESTIONNAIRE,
+            dict(WARMUP_QUESTIONNAIRE, gender=""),
+            "not a record",
+            dict(WARMUP_QUESTIONNAIRE, age="old", itching="Maybe"),
+            positive,
+            dict(WARMUP_QUESTIONNAIRE, age="nan"),
+        ]
+        results = self.client.post("/predict-batch", json=records).get_json()
+        self.assertEqual([result["index"] for result in results], list(range(6)))
+
+        # Valid records get the /predict answer, in input order
+        for i, record in ((0, WARMUP_QUESTIONNAIRE), (4, positive)):
+            single = self.client.post("/predict", json=record).get_json()
+            self.assertEqual(results[i], {"index": i, "prediction": single[0]})
+
+        # Each bad field is reported once, and only on its own record
+        self.assertEqual(results[1]["error"], "Missing value for 'gender'")
+        self.assertEqual(results[2]["error"], "Record must be a JSON object")
+        self.assertEqual(
+            results[3]["error"],
+            "Unknown value for 'itching': 'Maybe'; Invalid value for 'age': 'old'",
+        )
+        self.assertEqual(results[5]["error"], "Invalid value for 'age': 'nan'")
+
+        # Non-finite ages are rejected by /predict too
+        for age in ("nan", "inf"):
+            response = self.client.post(
+                "/predict", json=dict(WARMUP_QUESTIONNAIRE, age=age)
+            )
+            self.assertEqual(response.status_code, 400)
+
+        ndjson = "\n".join([json.dumps(WARMUP_QUESTIONNAIRE), "{bad", ""])
+        results = self.client.post(
+            "/predict-batch", data=ndjson, content_type="application/x-ndjson"
+        ).get_json()
+        self.assertIn("prediction", results[0])
+        self.assertTrue(results[1]["error"].startswith("Invalid JSON"))
+
+    def send_incremental(self, patient_id, readings, previous):
+        return self.client.post(
+            "/estimate-a1c",
+            json={
+                "patient_id": patient_id,
+                "incremental": True,
+                "previous_readings": previous,
+                "readings": readings,
+            },
+        )
+
+    def test_incremental_a1c_rejects_malformed_readings(self):
+        send = self.send_incremental
+        for readings in (
+            [{"blood_glucose": 120}],
+            [WARMUP_READINGS[0], "not a reading"],
+            "not a list",
+        ):
+            response = send("p1", readings, 0)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("timestamp", response.get_json()["error"])
+
+        # Bad values are a 400 too, for a new patient as for one with state
+        sent = len(WARMUP_READINGS) - 3
+        self.assertEqual(send("p2", WARMUP_READINGS[3:], 0).status_code, 200)
+        for value in ("high", [1], {"mg/dl": 120}):
+            bad = [dict(WARMUP_READINGS[-1], blood_glucose=value)]
+            self.assertEqual(send("p2", bad, sent).status_code, 400)
+            self.assertEqual(send("p3", bad, 0).status_code, 400)
+        for previous in (None, -1, "3", True):
+            self.assertEqual(send("p2", [], previous).status_code, 400)
+        # Only readings before the patient's current day need the full history
+        self.assertEqual(send("p2", WARMUP_READINGS[:1], sent).status_code, 409)
+
+    def test_incremental_a1c_detects_state_from_another_worker(self):
+        global a1c_state
+
+        send = self.send_incremental
+        full = self.client.post("/estimate-a1c", json={"readings": WARMUP_READINGS})
+        half = len(WARMUP_READINGS) // 2
+        first = send("p4", WARMUP_READINGS[:half], 0).get_json()
+        self.assertEqual(first["readings"], half)
+        saved = a1c_state
+        try:
+            # A worker that didn't serve the first half, or restored a snapshot
+            # written before it, must not answer from part of the history
+            a1c_state = None
+            response = send("p4", WARMUP_READINGS[half:], half)
+            self.assertEqual(response.status_code, 409)
+            response = send("p4", WARMUP_READINGS, 0)
+            self.assertEqual(response.get_json()["readings"], len(WARMUP_READINGS))
+            self.assertAlmostEqual(
+                response.get_json()["HbA1c"], full.get_json()["HbA1c"]
+            )
+        finally:
+            a1c_state = saved
+        response = send("p4", WARMUP_READINGS[half:], half)
+        self.assertAlmostEqual(response.get_json()["HbA1c"], full.get_json()["HbA1c"])
+
+    def test_a1c_batch_reports_malformed_patient_alone(self):
+        nested = [dict(WARMUP_READINGS[0], blood_glucose=[1])] + WARMUP_READINGS[1:]
+        patients = [
+            {"patient_id": "good", "readings": WARMUP_READINGS},
+            {"patient_id": "nested", "readings": nested},
+            {"patient_id": "columns", "timestamps": [[1, 2]], "blood_glucose": [[1]]},
+            {"patient_id": "again", "readings": WARMUP_READINGS},
+        ]
+        response = self.client.post("/estimate-a1c-batch", json={"patients": patients})
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()
+        single = self.client.post(
+            "/estimate-a1c", json={"readings": WARMUP_READINGS}
+        ).get_json()
+        for i in (0, 3):
+            self.assertAlmostEqual(results[i]["HbA1c"], single["HbA1c"])
+        for i in (1, 2):
+            self.assertNotIn("HbA1c", results[i])
+            self.assertEqual(results[i]["patient_id"], patients[i]["patient_id"])
+            self.assertIn("error", results[i])
+
+
 if __name__ == "__main__":
     app.run(port=3000, debug=True, host="0.0.0.0")
@@ -0,0 +1,272 @@
+import os
+import time
+import unittest
+
+import numpy as np
+
+
+def export_forest(model):
+    # Flatten every tree_ of a fitted RandomForest into contiguous node arrays.
+    # Child indices are global, and leaves point back to themselves so traversal
+    # can run a fixed number of steps without checking for leaves
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    is_classifier = hasattr(model, "classes_")
+
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        nodes = np.arange(n_nodes)
+        leaf = tree.children_left == -1
+
+        features.append(np.where(leaf, 0, tree.feature).astype(np.int32))
+        thresholds.append(np.where(leaf, np.inf, tree.threshold))
+        lefts.append(
+            np.where(leaf, nodes, tree.children_left).astype(np.int32) + offset
+        )
+        rights.append(
+            np.where(leaf, nodes, tree.children_right).astype(np.int32) + offset
+        )
+
+        value = tree.value[:, 0, :]
+        if is_classifier:
+            # DecisionTreeClassifier.predict_proba normalises the leaf counts
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            value = value / normalizer
+        else:
+            value = value[:, 0]
+        values.append(value)
+
+        roots.append(offset)
+        offset += n_nodes
+        max_depth = max(max_depth, tree.max_depth)
+
+    arrays = {
+        "feature": np.concatenate(features),
+        "threshold": np.concatenate(thresholds),
+        "left": np.concatenate(lefts),
+        "right": np.concatenate(rights),
+        "value": np.concatenate(values),
+        "roots": np.array(roots, dtype=np.int32),
+    }
+    meta = {
+        "kind": "classifier" if is_classifier else "regressor",
+        "n_features": int(model.n_features_in_),
+        "max_depth": int(max_depth),
+        "feature_names": [
+            str(name) for name in getattr(model, "feature_names_in_", [])
+        ],
+        "classes": np.asarray(model.classes_).tolist() if is_classifier else None,
+    }
+    return arrays, meta
+
+
+class CompiledForest:
+    # Array-based evaluator for an exported RandomForest that traverses every tree
+    # for a batch of rows at once, without sklearn's predict machinery. It wins on
+    # small inputs; batches above max_rows go to the fallback estimator if given,
+    # since sklearn's Cython traversal is faster there. fallback_loader lets the
+    # estimator be loaded only once a large batch actually needs it
+    def __init__(
+        self,
+        arrays,
+        meta,
+        chunk_size=4096,
+        fallback=None,
+        max_rows=128,
+        fallback_loader=None,
+    ):
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"]
+        self.left = arrays["left"]
+        self.right = arrays["right"]
+        self.value = arrays["value"]
+        self.roots = arrays["roots"]
+        self.meta = meta
+        self.kind = meta["kind"]
+        self.n_features = meta["n_features"]
+        self.max_depth = meta["max_depth"]
+        self.feature_names = meta["feature_names"]
+        self.classes = None if meta["classes"] is None else np.asarray(meta["classes"])
+        self.chunk_size = chunk_size
+        self._fallback = fallback
+        self.fallback_loader = fallback_loader
+        self.max_rows = max_rows
+
+    @classmethod
+    def from_sklearn(cls, model, keep_fallback=False, **kwargs):
+        arrays, meta = export_forest(model)
+        if keep_fallback:
+            kwargs["fallback"] = model
+        return cls(arrays, meta, **kwargs)
+
+    @property
+    def fallback(self):
+        if self._fallback is None and self.fallback_loader is not None:
+            self._fallback = self.fallback_loader()
+        return self._fallback
+
+    def _use_fallback(self, X):
+        has_fallback = self._fallback is not None or self.fallback_loader is not None
+        return has_fallback and len(X) > self.max_rows
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def _check_input(self, X):
+        # sklearn casts inputs to float32 before comparing against the float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features:
+            raise ValueError(
+                f"X has {X.shape[1]} features, but the forest expects {self.n_features}"
+            )
+        # NaN would take the right branch at every split; sklearn rejects it, and
+        # infinity, with the same errors
+        if not np.isfinite(X).all():
+            if np.isnan(X).any():
+                raise ValueError("Input X contains NaN.")
+            raise ValueError(
+                "Input X contains infinity or a value too large for dtype('float32')."
+            )
+        return X
+
+    def apply(self, X):
+        # Leaf index reached in every tree, shape (n_samples, n_trees)
+        X = self._check_input(X)
+        rows = np.arange(len(X))[:, np.newaxis]
+        nodes = np.broadcast_to(self.roots, (len(X), self.n_trees))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            next_nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+            # Stop early once every row has reached a leaf in every tree
+            if np.array_equal(next_nodes, nodes):
+                break
+            nodes = next_nodes
+        return nodes
+
+    def _accumulate(self, X):
+        # Sum the leaf values tree by tree, in the same order as sklearn
+        out = np.zeros((len(X),) + self.value.shape[1:])
+        for start in range(0, len(X), self.chunk_size):
+            leaves = self.apply(X[start : start + self.chunk_size])
+            chunk = out[start : start + self.chunk_size]
+            for t in range(self.n_trees):
+                chunk += self.value[leaves[:, t]]
+        out /= self.n_trees
+        return out
+
+    def predict_proba(self, X):
+        if self.kind != "classifier":
+            raise AttributeError("predict_proba is only available for classifiers")
+        X = self._check_input(X)
+        if self._use_fallback(X):
+            return self.fallback.predict_proba(X)
+        return self._accumulate(X)
+
+    def predict(self, X):
+        X = self._check_input(X)
+        if self._use_fallback(X):
+            return self.fallback.predict(X)
+        if self.kind == "classifier":
+            return self.classes.take(np.argmax(self._accumulate(X), axis=1), axis=0)
+        return self._accumulate(X)
+
+
+# TESTING
+class TestCompiledForest(unittest.TestCase):
+    def setUp(self):
+        import pickle
+
+        self.dir_path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(self.dir_path, "final_predict_model.pkl"), "rb") as file:
+            self.classifier = pickle.load(file)
+        with open(os.path.join(self.dir_path, "A1cModel.pkl"), "rb") as file:
+            self.regressor = pickle.load(file)["model"]
+        self.rng = np.random.default_rng(0)
+
+    def test_classifier_parity(self):
+        import pandas as pd
+        from featureEncoder import QuestionnaireEncoder
+        import pickle
+
+        with open(os.path.join(self.dir_path, "encoders.pkl"), "rb") as file:
+            encoders = pickle.load(file)
+        with open(os.path.join(self.dir_path, "minmax.pkl"), "rb") as file:
+            minmax = pickle.load(file)
+        encoder = QuestionnaireEncoder(
+            encoders, minmax, self.classifier.feature_names_in_
+        )
+        df = pd.read_csv(
+            os.path.join(self.dir_path, "../../Dataset/balanced_diabetes_data.csv")
+        )
+        X, _ = encoder.encode_many(df.drop("class", axis=1).to_dict("records"))
+
+        # Random answers with ages spread beyond the training range
+        random_X = self.rng.integers(0, 2, size=(5000, X.shape[1])).astype(float)
+        random_X[:, encoder.age_index] = self.rng.uniform(-0.5, 1.5, size=5000)
+        X = np.vstack([X, random_X])
+
+        forest = CompiledForest.from_sklearn(self.classifier, chunk_size=1000)
+        np.testing.assert_array_equal(
+            forest.predict_proba(X), self.classifier.predict_proba(X)
+        )
+        np.testing.assert_array_equal(forest.predict(X), self.classifier.predict(X))
+
+    def test_regressor_parity(self):
+        import pandas as pd
+        from glucosePreprocessor import GlucoseDataPreprocessor
+
+        data = pd.read_csv(
+            os.path.join(self.dir_path, "../../Dataset/synthetic_diabetes_data_v6.csv")
+        )
+        features = GlucoseDataPreprocessor().transform(data)
+        X = features[list(self.regressor.feature_names_in_)].to_numpy()
+        random_X = self.rng.uniform(0, 300, size=(5000, X.shape[1]))
+        X = np.vstack([X, random_X])
+
+        forest = CompiledForest.from_sklearn(self.regressor)
+        np.testing.assert_array_equal(forest.predict(X), self.regressor.predict(X))
+
+    def test_rejects_non_finite_rows(self):
+        forest = CompiledForest.from_sklearn(self.classifier)
+        X = np.zeros((3, forest.n_features))
+        for value in (np.nan, np.inf, 1e39):
+            X[1, 0] = value
+            with self.assertRaises(ValueError) as expected:
+                self.classifier.predict(X)
+            with self.assertRaises(ValueError) as raised:
+                forest.predict(X)
+            self.assertEqual(
+                str(raised.exception).splitlines()[0],
+                str(expected.exception).splitlines()[0],
+            )
+
+    def test_single_row_faster_than_sklearn(self):
+        forest = CompiledForest.from_sklearn(self.classifier)
+        rows = self.rng.integers(0, 2, size=(20, forest.n_features)).astype(float)
+        timings = {}
+        for name, predict in [
+            ("sklearn", self.classifier.predict),
+            ("compiled", forest.predict),
+        ]:
+            # Best of several single-row calls, so a slow machine can't flip it
+            best = float("inf")
+            for i in range(len(rows)):
+                start = time.perf_counter()
+                prediction = predict(rows[i : i + 1])
+                best = min(best, time.perf_counter() - start)
+                if name == "compiled":
+                    np.testing.assert_array_equal(
+                        prediction, self.classifier.predict(rows[i : i + 1])
+                    )
+            timings[name] = best
+        self.assertLess(timings["compiled"], timings["sklearn"])
+
+
+if __name__ == "__main__":
+    unittest.main()
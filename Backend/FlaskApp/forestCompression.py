@@ -0,0 +1,440 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from forestCompiler import CompiledForest, export_forest
+from modelData import a1c_split, diabetes_split
+from modelExport import ENCODER_FILE, MODELS, directory_size, load_exported
+from modelRegistry import _unpickle, write_forest_arrays
+from predictionTable import file_hash
+
+# Smaller variants of the served forests, built on their exported node arrays (see
+# forestCompiler.export_forest) so they can be served from MODEL_EXPORT_DIR. A
+# variant is a comma separated list of steps, applied in this order:
+#   trees=N   keep N trees, chosen by greedy forward selection on the training split
+#   depth=D   turn every node at depth D into a leaf with that node's value
+#   float32   store thresholds and values as float32
+#   merge     collapse subtrees whose leaves all give the same output
+# e.g. "trees=25,depth=8,float32,merge". Thresholds are rounded down to float32,
+# which keeps every split exact since inputs are compared as float32 anyway
+DEFAULT_VARIANTS = {
+    "diabetes": ["float32", "merge", "depth=8", "trees=25", "trees=10,float32"],
+    "a1c": [
+        "float32",
+        "merge",
+        "depth=8",
+        "trees=50",
+        "trees=25",
+        "trees=25,depth=8,float32",
+    ],
+}
+
+
+def parse_variant(spec):
+    steps = {}
+    for step in filter(None, spec.split(",")):
+        name, _, value = step.partition("=")
+        if name in ("trees", "depth"):
+            steps[name] = int(value)
+        elif name in ("float32", "merge") and not value:
+            steps[name] = True
+        else:
+            raise ValueError(f"Unknown compression step {step!r}")
+    return steps
+
+
+def tree_of_nodes(arrays):
+    # Index of the tree every node belongs to; trees are stored contiguously
+    n_nodes = len(arrays["feature"])
+    return np.searchsorted(arrays["roots"], np.arange(n_nodes), side="right") - 1
+
+
+def is_leaf(arrays):
+    return arrays["left"] == np.arange(len(arrays["left"]))
+
+
+def node_depths(arrays):
+    depths = np.full(len(arrays["feature"]), -1)
+    leaf = is_leaf(arrays)
+    frontier = np.asarray(arrays["roots"], dtype=np.int64)
+    depth = 0
+    while len(frontier):
+        depths[frontier] = depth
+        frontier = frontier[~leaf[frontier]]
+        frontier = np.concatenate([arrays["left"][frontier], arrays["right"][frontier]])
+        depth += 1
+    return depths
+
+
+def compact(arrays, roots):
+    # Keep the nodes reachable from roots, renumbered with each tree contiguous
+    depths = node_depths(dict(arrays, roots=roots))
+    kept = np.flatnonzero(depths >= 0)
+    # Trees follow the order of roots, nodes keep their order inside each tree
+    rank = np.full(len(arrays["roots"]), -1)
+    rank[tree_of_nodes(arrays)[roots]] = np.arange(len(roots))
+    kept = kept[np.lexsort((kept, rank[tree_of_nodes(arrays)[kept]]))]
+    new_index = np.full(len(arrays["feature"]), -1, dtype=np.int64)
+    new_index[kept] = np.arange(len(kept))
+    return (
+        {
+            "feature": arrays["feature"][kept],
+            "threshold": arrays["threshold"][kept],
+            "left": new_index[arrays["left"][kept]].astype(np.int32),
+            "right": new_index[arrays["right"][kept]].astype(np.int32),
+            "value": arrays["value"][kept],
+            "roots": new_index[roots].astype(np.int32),
+        },
+        int(depths[kept].max()) if len(kept) else 0,
+    )
+
+
+def tree_outputs(arrays, meta, X):
+    # Per-tree predictions, shape (n_samples, n_trees) or (n_samples, n_trees, k)
+    forest = CompiledForest(arrays, meta)
+    return arrays["value"][forest.apply(X)]
+
+
+def select_trees(arrays, meta, X, y, n_trees):
+    # Greedy forward selection: repeatedly add the tree that most lowers the squared
+    # error of the ensemble average (Brier score for classifiers)
+    outputs = tree_outputs(arrays, meta, X)
+    if meta["kind"] == "classifier":
+        classes = np.asarray(meta["classes"])
+        target = (np.asarray(y)[:, np.newaxis] == classes).astype(float)
+        target = target[:, np.newaxis, :]
+    else:
+        outputs = outputs[:, :, np.newaxis]
+        target = np.asarray(y, dtype=float)[:, np.newaxis, np.newaxis]
+
+    selected = []
+    total = np.zeros((len(outputs), 1, outputs.shape[2]))
+    remaining = np.arange(outputs.shape[1])
+    for count in range(1, min(n_trees, outputs.shape[1]) + 1):
+        candidates = (total + outputs[:, remaining]) / count
+        loss = ((candidates - target) ** 2).sum(axis=2).mean(axis=0)
+        best = int(np.argmin(loss))
+        selected.append(remaining[best])
+        total += outputs[:, remaining[best] : remaining[best] + 1]
+        remaining = np.delete(remaining, best)
+    return np.sort(selected)
+
+
+def cap_depth(arrays, max_depth):
+    depths = node_depths(arrays)
+    cut = (depths == max_depth) & ~is_leaf(arrays)
+    return _make_leaves(arrays, cut)
+
+
+def _make_leaves(arrays, nodes):
+    arrays = dict(arrays)
+    index = np.arange(len(arrays["left"]))
+    arrays["left"] = np.where(nodes, index, arrays["left"]).astype(np.int32)
+    arrays["right"] = np.where(nodes, index, arrays["right"]).astype(np.int32)
+    arrays["feature"] = np.where(nodes, 0, arrays["feature"])
+    arrays["threshold"] = np.where(nodes, np.inf, arrays["threshold"])
+    return arrays
+
+
+def merge_leaves(arrays):
+    # Bottom up: a split whose children are leaves with identical values becomes a
+    # leaf with that value, so subtrees with a single output collapse to one leaf
+    while True:
+        leaf = is_leaf(arrays)
+        left, right, value = arrays["left"], arrays["right"], arrays["value"]
+        same = value[left] == value[right]
+        if same.ndim > 1:
+            same = same.all(axis=1)
+        mergeable = ~leaf & leaf[left] & leaf[right] & same
+        if not mergeable.any():
+            return arrays
+        arrays = _make_leaves(arrays, mergeable)
+        arrays["value"] = value.copy()
+        arrays["value"][mergeable] = value[left[mergeable]]
+
+
+def to_float32(arrays):
+    arrays = dict(arrays)
+    threshold = arrays["threshold"]
+    rounded = threshold.astype(np.float32)
+    # Round down, so x <= threshold gives the same answer for every float32 x
+    above = rounded > threshold
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    arrays["threshold"] = rounded
+    arrays["value"] = arrays["value"].astype(np.float32)
+    return arrays
+
+
+def compress(arrays, meta, steps, X_train=None, y_train=None):
+    roots = arrays["roots"]
+    if "trees" in steps:
+        roots = roots[select_trees(arrays, meta, X_train, y_train, steps["trees"])]
+    arrays, _ = compact(arrays, roots)
+    if "depth" in steps:
+        arrays = cap_depth(arrays, steps["depth"])
+    if steps.get("float32"):
+        arrays = to_float32(arrays)
+    if steps.get("merge"):
+        arrays = merge_leaves(arrays)
+    arrays, max_depth = compact(arrays, arrays["roots"])
+    if meta["n_features"] <= np.iinfo(np.uint8).max:
+        arrays["feature"] = arrays["feature"].astype(np.uint8)
+
+    spec = ",".join(
+        f"{name}={value}" if value is not True else name
+        for name, value in steps.items()
+    )
+    digest = hashlib.sha256(f"{meta.get('source_sha256')}:{spec}".encode())
+    meta = dict(
+        meta,
+        max_depth=max_depth,
+        # A variant is a different model to the prediction cache and table
+        source_sha256=digest.hexdigest(),
+        compressed_from=meta.get("source_sha256"),
+        compression=spec,
+    )
+    return arrays, meta
+
+
+def evaluate(forest, X_test, y_test, repeat=200):
+    X_test = np.asarray(X_test, dtype=float)
+    y_test = np.asarray(y_test)
+    predictions = forest.predict(X_test)
+    if forest.kind == "classifier":
+        quality = {"accuracy": float(np.mean(predictions == y_test))}
+    else:
+        residual = ((y_test - predictions) ** 2).sum()
+        quality = {
+            "r2": float(1 - residual / ((y_test - y_test.mean()) ** 2).sum()),
+            "mae": float(np.abs(y_test - predictions).mean()),
+        }
+
+    row = X_test[:1]
+    forest.predict(row)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        forest.predict(row)
+        seconds.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    forest.predict(X_test)
+    batch_s = time.perf_counter() - start
+    return dict(
+        quality,
+        predict_p50_us=float(np.median(seconds)) * 1e6,
+        batch_ms=batch_s * 1e3,
+    )
+
+
+def write_variant(arrays, meta, out_dir, encoder_spec=None):
+    write_forest_arrays(arrays, meta, out_dir)
+    if encoder_spec is not None:
+        with open(os.path.join(out_dir, ENCODER_FILE), "w") as file:
+            json.dump(encoder_spec, file, indent=2)
+
+
+def report(name, variants, out_root=None):
+    # One row per variant: size, load time, latency and held-out quality, with the
+    # quality deltas against the uncompressed model
+    from featureEncoder import QuestionnaireEncoder
+
+    model_path, key, encoders_path, minmax_path = MODELS[name]
+    model = _unpickle(model_path, key)
+    arrays, meta = export_forest(model)
+    meta["source_sha256"] = file_hash(model_path)
+    encoder_spec = None
+    if encoders_path is not None:
+        encoder_spec = QuestionnaireEncoder(
+            _unpickle(encoders_path), _unpickle(minmax_path), meta["feature_names"]
+        ).to_spec()
+    X_train, X_test, y_train, y_test = (
+        diabetes_split() if name == "diabetes" else a1c_split()
+    )
+    X_train = np.asarray(X_train, dtype=float)
+
+    rows = []
+    tmp_root = tempfile.mkdtemp()
+    try:
+        for variant in ["original"] + list(variants):
+            steps = {} if variant == "original" else parse_variant(variant)
+            variant_arrays, variant_meta = (
+                (arrays, meta)
+                if variant == "original"
+                else compress(arrays, meta, steps, X_train, y_train)
+            )
+            out_dir = os.path.join(out_root or tmp_root, variant, name)
+            shutil.rmtree(out_dir, ignore_errors=True)
+            write_variant(variant_arrays, variant_meta, out_dir, encoder_spec)
+
+            start = time.perf_counter()
+            forest = load_exported(out_dir, mmap_mode=None)
+            load_ms = (time.perf_counter() - start) * 1e3
+            rows.append(
+                dict(
+                    evaluate(forest, X_test, y_test),
+                    variant=variant,
+                    trees=forest.n_trees,
+                    nodes=len(forest.feature),
+                    size_kb=directory_size(out_dir) / 1e3,
+                    load_ms=load_ms,
+                )
+            )
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+    for row in rows:
+        for metric in ("accuracy", "r2", "mae"):
+            if metric in row:
+                row[f"{metric}_delta"] = row[metric] - rows[0][metric]
+    return rows
+
+
+def format_rows(rows):
+    quality = [m for m in ("accuracy", "r2", "mae") if m in rows[0]]
+    lines = [
+        f"{'variant':<28}{'trees':>6}{'nodes':>8}{'KB':>8}{'load ms':>9}"
+        f"{'p50 us':>8}{'batch ms':>9}"
+        + "".join(f"{metric:>10}{'delta':>9}" for metric in quality)
+    ]
+    for row in rows:
+        lines.append(
+            f"{row['variant']:<28}{row['trees']:>6}{row['nodes']:>8}"
+            f"{row['size_kb']:>8.0f}{row['load_ms']:>9.2f}"
+            f"{row['predict_p50_us']:>8.0f}{row['batch_ms']:>9.1f}"
+            + "".join(
+                f"{row[metric]:>10.4f}{row[f'{metric}_delta']:>+9.4f}"
+                for metric in quality
+            )
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build compressed variants of the served forests and compare them"
+    )
+    parser.add_argument("--model", choices=list(MODELS), action="append")
+    parser.add_argument(
+        "--variant", action="append", help="e.g. trees=25,depth=8,float32,merge"
+    )
+    parser.add_argument(
+        "--write",
+        metavar="DIR",
+        help="Keep the variants as DIR/<variant>/<model>, servable with "
+        "MODEL_EXPORT_DIR=DIR/<variant>",
+    )
+    parser.add_argument("--json", help="Also write the rows to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.model or list(MODELS):
+        rows = report(name, args.variant or DEFAULT_VARIANTS[name], args.write)
+        results[name] = rows
+        print(f"\n{name}")
+        print(format_rows(rows))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+# TESTING
+class TestForestCompression(unittest.TestCase):
+    def setUp(self):
+        from sklearn.datasets import make_classification, make_regression
+        from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+
+        X, y = make_classification(400, 6, random_state=0)
+        self.classification = (
+            RandomForestClassifier(20, random_state=0).fit(X, y),
+            X.astype(np.float32),
+            y,
+        )
+        X, y = make_regression(400, 3, noise=5.0, random_state=0)
+        self.regression = (
+            RandomForestRegressor(20, max_depth=8, random_state=0).fit(X, y),
+            X.astype(np.float32),
+            y,
+        )
+
+    def compressed(self, model, X, y, spec):
+        arrays, meta = export_forest(model)
+        arrays, meta = compress(arrays, meta, parse_variant(spec), X, y)
+        return CompiledForest(arrays, meta)
+
+    def test_float32_keeps_predictions(self):
+        for model, X, y in [self.classification, self.regression]:
+            arrays, meta = export_forest(model)
+            small, small_meta = compress(arrays, meta, {"float32": True})
+            self.assertEqual(small["threshold"].dtype, np.float32)
+            self.assertLess(
+                sum(a.nbytes for a in small.values()),
+                sum(a.nbytes for a in arrays.values()),
+            )
+            self.assertNotEqual(small_meta["source_sha256"], meta.get("source_sha256"))
+
+            forest = CompiledForest(small, small_meta)
+            if forest.kind == "classifier":
+                np.testing.assert_array_equal(forest.predict(X), model.predict(X))
+                np.testing.assert_allclose(
+                    forest.predict_proba(X), model.predict_proba(X), rtol=1e-6
+                )
+            else:
+                np.testing.assert_allclose(
+                    forest.predict(X), model.predict(X), rtol=1e-6
+                )
+            # Rounding thresholds down keeps the leaf every row reaches
+            np.testing.assert_array_equal(
+                forest.apply(X), CompiledForest(arrays, meta).apply(X)
+            )
+
+    def test_trees_and_depth(self):
+        model, X, y = self.regression
+        arrays, meta = export_forest(model)
+        small, small_meta = compress(
+            arrays, meta, parse_variant("trees=5,depth=3"), X, y
+        )
+        self.assertEqual(len(small["roots"]), 5)
+        self.assertEqual(small_meta["max_depth"], 3)
+        self.assertEqual(node_depths(small).max(), 3)
+        self.assertTrue(
+            (tree_of_nodes(small)[small["left"]] == tree_of_nodes(small)).all()
+        )
+
+        # Capping the depth alone predicts the value of the node each row reaches
+        # at depth 3
+        capped = CompiledForest(*compress(arrays, meta, {"depth": 3}))
+        tree = model.estimators_[0]
+        for row in X[:20]:
+            path = tree.decision_path(row[np.newaxis]).indices
+            node = path[min(3, len(path) - 1)]
+            self.assertEqual(
+                capped.value[capped.apply(row)[0, 0]], tree.tree_.value[node, 0, 0]
+            )
+
+        # A split into two leaves with the same value collapses, then its parent
+        tree = {
+            "feature": np.zeros(5, dtype=np.int32),
+            "threshold": np.array([0.0, 1.0, np.inf, np.inf, np.inf]),
+            "left": np.array([1, 2, 2, 3, 4], dtype=np.int32),
+            "right": np.array([4, 3, 2, 3, 4], dtype=np.int32),
+            "value": np.array([0.0, 0.0, 2.0, 2.0, 2.0]),
+            "roots": np.array([0], dtype=np.int32),
+        }
+        merged, depth = compact(merge_leaves(tree), tree["roots"])
+        self.assertEqual((len(merged["feature"]), depth), (1, 0))
+        self.assertEqual(merged["value"][0], 2.0)
+
+        # Greedy selection of every tree gives back the full forest
+        full = self.compressed(model, X, y, "trees=20")
+        np.testing.assert_allclose(full.predict(X), model.predict(X))
+
+
+if __name__ == "__main__":
+    main()
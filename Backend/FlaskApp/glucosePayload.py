@@ -0,0 +1,279 @@
+import re
+import threading
+import unittest
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+# Glucose readings sent to /estimate-a1c, turned into NumPy columns (timestamps as
+# datetime64[ns], glucose, HbA1c) without building a DataFrame from dicts. Three
+# payloads are accepted:
+#   {"readings": [{"timestamp": "2024-01-01T08:00:00", "blood_glucose": 120}, ...]}
+#   {"timestamps": [epoch seconds, ...], "blood_glucose": [...]}
+#   a BINARY_CONTENT_TYPE body: n little-endian int64 epoch seconds, then n
+#   little-endian float32 glucose values
+# Epoch seconds fall into UTC days, the same days as ISO timestamps ending in "Z"
+BINARY_CONTENT_TYPE = "application/x-glucose-columns"
+
+# Timestamps without a UTC offset that NumPy parses natively, many times faster than
+# pandas' per-request format inference
+NAIVE_ISO = re.compile(r"\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d{1,9})?)?)?")
+DIGITS = str.maketrans("0123456789", "0000000000")
+
+# Parser chosen for each timestamp layout ("2024-01-01T08:00:00" and
+# "2025-12-31T23:59:59" share "0000-00-00T00:00:00"): "numpy", a strftime format for
+# pandas, or None to let pandas infer it. Layouts come from clients, so only the
+# most recently used TIMESTAMP_LAYOUTS are kept, and samples longer than any real
+# timestamp aren't cached at all
+TIMESTAMP_LAYOUTS = 256
+MAX_LAYOUT_LENGTH = 64
+timestamp_parsers = OrderedDict()
+timestamp_parsers_lock = threading.Lock()
+
+
+def _guess_parser(sample):
+    if NAIVE_ISO.fullmatch(sample):
+        return "numpy"
+    from pandas.tseries.api import guess_datetime_format
+
+    return guess_datetime_format(sample)
+
+
+def _timestamp_parser(sample):
+    if len(sample) > MAX_LAYOUT_LENGTH:
+        return None
+    layout = sample.translate(DIGITS)
+    with timestamp_parsers_lock:
+        parser = timestamp_parsers.get(layout, False)
+        if parser is not False:
+            timestamp_parsers.move_to_end(layout)
+            return parser
+    parser = _guess_parser(sample)
+    with timestamp_parsers_lock:
+        timestamp_parsers[layout] = parser
+        while len(timestamp_parsers) > TIMESTAMP_LAYOUTS:
+            timestamp_parsers.popitem(last=False)
+    return parser
+
+
+def parse_timestamps(values):
+    # Wall-clock datetime64[ns] for a list of timestamps, like pd.to_datetime
+    # followed by dropping any UTC offset. The layout of the first timestamp picks
+    # the parser; values that don't fit it go through pandas' inference
+    import pandas as pd
+
+    sample = next((value for value in values if isinstance(value, str)), None)
+    parser = _timestamp_parser(sample) if sample is not None else None
+    if parser == "numpy":
+        try:
+            with warnings.catch_warnings():
+                # NumPy converts offsets to UTC instead of keeping the wall clock
+                warnings.simplefilter("error", DeprecationWarning)
+                return np.array(values, dtype="datetime64[ns]")
+        except (ValueError, TypeError, DeprecationWarning):
+            parser = None
+
+    parsed = None
+    if parser is not None:
+        try:
+            parsed = pd.to_datetime(values, format=parser)
+        except (ValueError, TypeError):
+            pass
+    if parsed is None:
+        parsed = pd.DatetimeIndex(pd.to_datetime(pd.Series(values)))
+    if parsed.tz is not None:
+        parsed = parsed.tz_localize(None)
+    return parsed.to_numpy(dtype="datetime64[ns]")
+
+
+def _reading_values(readings, key, default):
+    # Like DataFrame(readings).get(key, default): readings without the key are NaN,
+    # unless none of them has it. Each value must be a single number
+    if not any(key in reading for reading in readings):
+        return np.full(len(readings), default, dtype=float)
+    try:
+        values = np.asarray(
+            [reading.get(key, np.nan) for reading in readings], dtype=float
+        )
+    except (ValueError, TypeError):
+        values = None
+    if values is None or values.ndim != 1:
+        raise ValueError(f"Each reading's '{key}' must be a number")
+    return values
+
+
+def from_readings(readings):
+    if not isinstance(readings, list) or not all(
+        isinstance(reading, dict) for reading in readings
+    ):
+        raise ValueError("Readings must be a list of JSON objects")
+    if not any("timestamp" in reading for reading in readings):
+        raise ValueError("Readings must have a 'timestamp'")
+    timestamps = parse_timestamps([reading.get("timestamp") for reading in readings])
+    return (
+        timestamps,
+        _reading_values(readings, "blood_glucose", 0),
+        _reading_values(readings, "HbA1c", 0),
+    )
+
+
+def from_epoch_seconds(seconds, glucose):
+    seconds = np.asarray(seconds)
+    glucose = np.asarray(glucose, dtype=float)
+    if seconds.ndim != 1 or seconds.shape != glucose.shape:
+        raise ValueError("'timestamps' and 'blood_glucose' must have the same length")
+    if not np.issubdtype(seconds.dtype, np.number):
+        raise ValueError("'timestamps' must be epoch seconds")
+    timestamps = (seconds * 10**9).astype(np.int64).view("datetime64[ns]")
+    return timestamps, glucose, np.zeros(len(glucose))
+
+
+def from_columns(data):
+    if "blood_glucose" not in data:
+        raise ValueError("Columnar payloads need 'timestamps' and 'blood_glucose'")
+    return from_epoch_seconds(data["timestamps"], data["blood_glucose"])
+
+
+def from_binary(body):
+    if len(body) % 12:
+        raise ValueError("Binary payload must be n int64 timestamps and n float32")
+    n = len(body) // 12
+    seconds = np.frombuffer(body, dtype="<i8", count=n)
+    glucose = np.frombuffer(body, dtype="<f4", count=n, offset=8 * n)
+    return from_epoch_seconds(seconds, glucose)
+
+
+def to_binary(seconds, glucose):
+    return np.asarray(seconds, dtype="<i8").tobytes() + (
+        np.asarray(glucose, dtype="<f4").tobytes()
+    )
+
+
+def _check_columns(columns):
+    # Batches concatenate every payload's columns, so one payload that isn't three
+    # 1-D numeric columns of the same length must fail here, on its own
+    timestamps, glucose, hba1c = (np.asarray(column) for column in columns)
+    if not (timestamps.ndim == glucose.ndim == hba1c.ndim == 1):
+        raise ValueError("Readings must be a flat list of values")
+    if not len(timestamps) == len(glucose) == len(hba1c):
+        raise ValueError("'timestamps' and 'blood_glucose' must have the same length")
+    if timestamps.dtype.kind != "M" or not all(
+        column.dtype.kind in "fiu" for column in (glucose, hba1c)
+    ):
+        raise ValueError("Readings must be timestamps and numbers")
+    return timestamps, glucose, hba1c
+
+
+def to_columns(payload):
+    # Columns for any accepted payload: a request body dict, a binary body, a list
+    # of readings, or columns already
+    if isinstance(payload, tuple):
+        return _check_columns(payload)
+    if isinstance(payload, (bytes, bytearray)):
+        return _check_columns(from_binary(payload))
+    if isinstance(payload, dict):
+        if "timestamps" in payload:
+            return _check_columns(from_columns(payload))
+        payload = payload.get("readings", [])
+    return _check_columns(from_readings(payload))
+
+
+def payload_length(payload):
+    # Number of readings in a payload, without parsing it
+    if isinstance(payload, tuple):
+        return len(payload[0])
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload) // 12
+    if isinstance(payload, dict):
+        payload = payload.get("timestamps", payload.get("readings", []))
+    return len(payload) if isinstance(payload, list) else 0
+
+
+# TESTING
+class TestGlucosePayload(unittest.TestCase):
+    def test_timestamps_match_pandas(self):
+        import pandas as pd
+
+        cases = [
+            ["2024-01-01T08:00:00.125", "2024-01-02T20:30:15.250"],
+            ["2024-01-01 08:00:00", "2024-01-02 20:30:00"],
+            ["2024-01-01T08:00:00+02:00", "2024-01-01T23:30:00+02:00"],
+            ["2024-01-01T08:00:00Z", "2024-01-02T09:00:00Z"],
+            ["01/02/2024 08:00", "01/03/2024 09:15"],
+            ["2024-01-01T08:00:00", None],
+        ]
+        for values in cases:
+            expected = pd.to_datetime(pd.Series(values))
+            if expected.dt.tz is not None:
+                expected = expected.dt.tz_localize(None)
+            np.testing.assert_array_equal(
+                parse_timestamps(values), expected.to_numpy(dtype="datetime64[ns]")
+            )
+        # NumPy would convert a later timestamp with an offset to UTC; pandas
+        # rejects the mix of layouts as before
+        with self.assertRaises(ValueError):
+            parse_timestamps(["2024-01-01T08:00:00", "2024-01-01T09:00:00+02:00"])
+
+    def test_payload_formats_agree(self):
+        seconds = 1704067200 + np.arange(30) * 8 * 3600
+        glucose = np.linspace(90, 180, 30).astype(np.float32)
+        readings = [
+            {"timestamp": str(np.datetime64(int(t), "s")), "blood_glucose": float(g)}
+            for t, g in zip(seconds, glucose)
+        ]
+        expected = to_columns({"readings": readings})
+        for payload in [
+            {"timestamps": seconds.tolist(), "blood_glucose": glucose.tolist()},
+            to_binary(seconds, glucose),
+        ]:
+            for column, value in zip(expected, to_columns(payload)):
+                np.testing.assert_array_equal(column, value)
+
+        with self.assertRaises(ValueError):
+            to_columns({"timestamps": [1, 2], "blood_glucose": [100.0]})
+        with self.assertRaises(ValueError):
+            to_columns(b"\x00" * 13)
+        with self.assertRaises(ValueError):
+            to_columns({"readings": [{"blood_glucose": 100}]})
+        # Glucose values must be numbers, not lists
+        for values in ([[1]], [100, [1]], [[1, 2], [3, 4]]):
+            readings = [
+                {"timestamp": "2024-01-01T08:00:00", "blood_glucose": value}
+                for value in values
+            ]
+            with self.assertRaises(ValueError):
+                to_columns({"readings": readings})
+        # Columns passed in directly are checked the same way
+        timestamps = expected[0]
+        for columns in (
+            (timestamps, glucose[:, None], np.zeros(30)),
+            (timestamps, glucose[:-1], np.zeros(30)),
+            (timestamps, glucose.astype(object), np.zeros(30)),
+            (seconds, glucose, np.zeros(30)),
+        ):
+            with self.assertRaises(ValueError):
+                to_columns(columns)
+
+    def test_layout_cache_is_bounded(self):
+        def junk(i):
+            # A distinct layout for every i, as a client could send
+            return "".join(chr(ord("a") + int(digit)) for digit in str(i))
+
+        timestamp_parsers.clear()
+        for i in range(TIMESTAMP_LAYOUTS + 50):
+            parse_timestamps(["2024-01-01T08:00:00"])
+            _timestamp_parser(junk(i))
+        self.assertEqual(len(timestamp_parsers), TIMESTAMP_LAYOUTS)
+        # The most recently used layouts are the ones kept
+        self.assertIn(junk(TIMESTAMP_LAYOUTS + 49), timestamp_parsers)
+        self.assertNotIn(junk(0), timestamp_parsers)
+        self.assertEqual(timestamp_parsers["0000-00-00T00:00:00"], "numpy")
+
+        long_sample = "2024-01-01T08:00:00" + " " * MAX_LAYOUT_LENGTH
+        self.assertIsNone(_timestamp_parser(long_sample))
+        self.assertNotIn(long_sample.translate(DIGITS), timestamp_parsers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,144 @@
 import pandas as pd
 import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.model_selection import train_test_split, KFold, GridSearchCV
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import mean_squared_error, r2_score, mean_absolute_error
+import bisect
+import math
 import os
 import pickle
+import tempfile
+import unittest
+import warnings
+from collections import deque
+
+NS_PER_DAY = 86_400 * 10**9
+
+# Daily glucose statistics, in the order the rolling features are built from
+DAILY_STATS = ["mean", "median", "std", "max", "min"]
+
+
+def _segment_starts(*keys):
+    # Start index of every run of equal keys in sorted arrays
+    change = np.zeros(len(keys[0]), dtype=bool)
+    if len(change):
+        change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+
+def daily_statistics(data):
+    # Per (patient, day) glucose statistics computed with one sort and segment
+    # reductions; returns sorted patient codes, day numbers, the patient labels,
+    # a (n_days, 5) array in DAILY_STATS order and the first HbA1c of each day
+    timestamps = pd.to_datetime(data["Timestamp"])
+    if getattr(timestamps.dt, "tz", None) is not None:
+        # Days follow the local wall clock, like Timestamp.dt.date
+        timestamps = timestamps.dt.tz_localize(None)
+    ns = timestamps.to_numpy(dtype="datetime64[ns]").view(np.int64)
+    codes, patients = pd.factorize(data["Patient_ID"], sort=True)
+    glucose = np.asarray(data["Blood_Glucose"], dtype=float)
+    hba1c = np.asarray(data["HbA1c"])
+
+    # Rows with a missing patient or timestamp are dropped, as groupby does
+    valid = (codes >= 0) & ~np.isnat(timestamps.to_numpy(dtype="datetime64[ns]"))
+    rows = np.flatnonzero(valid)
+    days = ns[rows] // NS_PER_DAY
+
+    # One stable sort by patient, day and glucose; NaN readings sort last in a day
+    order = np.lexsort((glucose[rows], days, codes[rows]))
+    rows = rows[order]
+    codes, days, glucose = codes[rows], days[order], glucose[rows]
+
+    starts = _segment_starts(codes, days)
+    if not len(starts):
+        return codes, days, patients, np.empty((0, 5)), hba1c[:0]
+    day_of_row = np.repeat(np.arange(len(starts)), np.diff(starts, append=len(rows)))
+
+    present = ~np.isnan(glucose)
+    filled = np.where(present, glucose, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count = np.add.reduceat(present, starts)
+        mean = np.add.reduceat(filled, starts) / count
+        deviation = np.where(present, glucose - mean[day_of_row], 0.0)
+        std = np.sqrt(np.add.reduceat(deviation**2, starts) / (count - 1))
+    std[count < 2] = np.nan
+
+    # Readings are sorted within each day, so the median is the middle element(s)
+    low = starts + np.maximum(count - 1, 0) // 2
+    high = starts + count // 2
+    median = np.where(count > 0, (glucose[low] + glucose[high]) / 2, np.nan)
+    stats = np.column_stack(
+        [
+            mean,
+            median,
+            std,
+            np.fmax.reduceat(glucose, starts),
+            np.fmin.reduceat(glucose, starts),
+        ]
+    )
+
+    # First non-missing HbA1c of each day in the original row order
+    sentinel = len(hba1c)
+    first_row = np.minimum.reduceat(
+        np.where(pd.isna(hba1c[rows]), sentinel, rows), starts
+    )
+    found = first_row < sentinel
+    daily_hba1c = hba1c[np.where(found, first_row, 0)]
+    if not found.all():
+        daily_hba1c = np.where(found, daily_hba1c, np.nan)
+
+    return codes[starts], days[starts], patients, stats, daily_hba1c
+
+
+def window_statistics(windows):
+    # NaN-skipping mean and sample std over axis 1 of a (n, window, k) array,
+    # matching pandas rolling(min_periods=1) semantics
+    present = ~np.isnan(windows)
+    count = present.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(present, windows, 0.0).sum(axis=1) / count
+        deviation = np.where(present, windows - mean[:, np.newaxis, :], 0.0)
+        std = np.sqrt((deviation**2).sum(axis=1) / (count - 1))
+    std[count < 2] = np.nan
+    return mean, std
+
+
+def summary_features(rolling_means, rolling_stds):
+    # Row-wise reductions across the five daily statistics, skipping NaN
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        rolling_mean = np.nanmean(rolling_means, axis=1)
+        rolling_median = np.nanmedian(rolling_means, axis=1)
+        rolling_std = np.nanstd(rolling_stds, axis=1, ddof=1)
+    rolling_std[(~np.isnan(rolling_stds)).sum(axis=1) < 2] = np.nan
+    return rolling_mean, rolling_median, rolling_std
+
+
+def rolling_features(codes, stats, window):
+    # Rolling mean/std of every daily statistic over the previous `window` days of
+    # the same patient, gathered as a (n_days, window, 5) array
+    n_days = len(stats)
+    new_patient = np.ones(n_days, dtype=bool)
+    new_patient[1:] = codes[1:] != codes[:-1]
+    patient_start = np.maximum.accumulate(np.where(new_patient, np.arange(n_days), 0))
+
+    index = np.arange(n_days)[:, np.newaxis] - np.arange(window)[np.newaxis, :]
+    windows = stats[np.maximum(index, 0)]
+    windows[index < patient_start[:, np.newaxis]] = np.nan
+    return window_statistics(windows)
+
+
+def complete_rows(stats, hba1c, rolling_means, rolling_stds, summaries):
+    # Days with every statistic available, like dropna() on the full daily frame
+    incomplete = (
+        np.isnan(stats).any(axis=1)
+        | pd.isna(hba1c)
+        | np.isnan(rolling_means).any(axis=1)
+        | np.isnan(rolling_stds).any(axis=1)
+    )
+    for summary in summaries:
+        incomplete |= np.isnan(summary)
+    return ~incomplete
 
 
 class GlucoseDataPreprocessor(BaseEstimator, TransformerMixin):
@@ -18,6 +151,43 @@ class GlucoseDataPreprocessor(BaseEstimator, TransformerMixin):
         return self  # Fitting does nothing as no parameters to learn for preprocessing
 
     def transform(self, data):
+        return self._transform(data)[0]
+
+    def transform_by_patient(self, data):
+        # Same features, with the Patient_ID of every row, for scoring several
+        # patients in one pass
+        features, patients = self._transform(data)
+        return features.assign(Patient_ID=patients)
+
+    def _transform(self, data):
+        codes, _, patients, stats, hba1c = daily_statistics(data)
+        rolling_means, rolling_stds = rolling_features(codes, stats, self.window)
+        rolling_mean, rolling_median, rolling_std = summary_features(
+            rolling_means, rolling_stds
+        )
+
+        keep = complete_rows(
+            stats,
+            hba1c,
+            rolling_means,
+            rolling_stds,
+            (rolling_mean, rolling_median, rolling_std),
+        )
+        features = pd.DataFrame(
+            {
+                "rolling_mean": rolling_mean[keep],
+                "rolling_median": rolling_median[keep],
+                "rolling_std": rolling_std[keep],
+                "HbA1c": hba1c[keep],
+            },
+            index=np.flatnonzero(keep),
+        )
+        if pd.api.types.is_integer_dtype(data["HbA1c"]):
+            features["HbA1c"] = features["HbA1c"].astype(data["HbA1c"].dtype)
+        return features, np.asarray(patients)[codes[keep]]
+
+    def transform_groupby(self, data):
+        # Original groupby/rolling implementation, kept as the reference for tests
         data["Timestamp"] = pd.to_datetime(data["Timestamp"])
         data["Date"] = data["Timestamp"].dt.date
         grouped = data.groupby(["Patient_ID", "Date"])
@@ -60,3 +230,301 @@ class GlucoseDataPreprocessor(BaseEstimator, TransformerMixin):
         return daily_data.dropna()[
             ["rolling_mean", "rolling_median", "rolling_std", "HbA1c"]
         ]
+
+
+class StaleReadings(ValueError):
+    # Readings older than a patient's current day, which the incremental state
+    # can't go back to
+    pass
+
+
+class _PatientWindow:
+    # Rolling state for one patient: accumulators for the current day and the
+    # statistics of the previous window - 1 days
+    def __init__(self, window):
+        self.window = window
+        self.day = None
+        self.readings = []  # Current day's glucose readings, kept sorted
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Welford sum of squared deviations
+        self.hba1c = np.nan
+        self.history = deque(maxlen=window - 1)
+        self.output_sum = 0.0
+        self.output_count = 0
+        self.received = 0  # Readings sent for the patient so far
+
+    def start_day(self, day):
+        if self.day is not None:
+            self.history.append(self.day_stats())
+        self.day = day
+        self.readings = []
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.hba1c = np.nan
+
+    def add(self, glucose, hba1c):
+        if not math.isnan(glucose):
+            bisect.insort(self.readings, glucose)
+            self.count += 1
+            delta = glucose - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (glucose - self.mean)
+        if math.isnan(self.hba1c):
+            self.hba1c = hba1c
+
+    def day_stats(self):
+        n = self.count
+        if n == 0:
+            return np.full(len(DAILY_STATS), np.nan)
+        median = (self.readings[(n - 1) // 2] + self.readings[n // 2]) / 2
+        std = math.sqrt(self.m2 / (n - 1)) if n > 1 else np.nan
+        return np.array([self.mean, median, std, self.readings[-1], self.readings[0]])
+
+    def features(self):
+        # Feature row for the current day, or None if it would be dropped
+        windows = np.full((1, self.window, len(DAILY_STATS)), np.nan)
+        windows[0, 0] = stats = self.day_stats()
+        if self.history:
+            windows[0, 1 : 1 + len(self.history)] = self.history
+        rolling_means, rolling_stds = window_statistics(windows)
+        summaries = summary_features(rolling_means, rolling_stds)
+        keep = complete_rows(
+            stats[np.newaxis],
+            np.array([self.hba1c]),
+            rolling_means,
+            rolling_stds,
+            summaries,
+        )
+        if not keep[0]:
+            return None
+        return np.array([summary[0] for summary in summaries])
+
+
+class IncrementalGlucoseState:
+    # Incremental version of GlucoseDataPreprocessor for patients whose readings
+    # arrive over time: only new readings are passed in, and each update costs
+    # O(window) instead of recomputing the whole history
+    def __init__(self, window=21):
+        self.window = window // 3  # Same 3 readings per day as the preprocessor
+        self.patients = {}
+
+    def update(self, patient_id, timestamps, glucose, hba1c=None, previous=None):
+        # Add new readings for one patient. Returns the feature rows of days that
+        # were completed by this update and the provisional row of the current
+        # day (None if it has no complete features yet). previous is the number
+        # of readings the caller has already sent for the patient: 0 starts the
+        # patient over, and any other count must match the state's
+        timestamps = pd.to_datetime(pd.Series(timestamps))
+        if getattr(timestamps.dt, "tz", None) is not None:
+            timestamps = timestamps.dt.tz_localize(None)
+        timestamps = timestamps.to_numpy(dtype="datetime64[ns]")
+        glucose = np.asarray(glucose, dtype=float)
+        hba1c = (
+            np.zeros(len(glucose)) if hba1c is None else np.asarray(hba1c, dtype=float)
+        )
+
+        # Readings without a timestamp are dropped, as in daily_statistics. Missing
+        # glucose values are kept: they open their day without being counted
+        known = ~np.isnat(timestamps)
+        ns = timestamps[known].view(np.int64)
+        glucose, hba1c = glucose[known], hba1c[known]
+
+        order = np.argsort(ns, kind="stable")
+        days = ns[order] // NS_PER_DAY
+
+        state = self.patients.get(patient_id)
+        if state is None or previous == 0:
+            state = _PatientWindow(self.window)
+        if previous is not None and previous != state.received:
+            raise StaleReadings(
+                f"State for patient {patient_id!r} has {state.received} readings, "
+                f"not {previous}"
+            )
+        self.patients[patient_id] = state
+        if len(days) and state.day is not None and days[0] < state.day:
+            raise StaleReadings(
+                f"Readings for patient {patient_id!r} are older than its current day"
+            )
+
+        state.received += len(known)
+        finalized = []
+        for day, value, a1c in zip(days, glucose[order], hba1c[order]):
+            if day != state.day:
+                if state.day is not None:
+                    row = state.features()
+                    if row is not None:
+                        finalized.append(row)
+                state.start_day(day)
+            state.add(value, a1c)
+
+        current = state.features() if state.day is not None else None
+        return np.array(finalized).reshape(-1, 3), current
+
+    def record_outputs(self, patient_id, outputs):
+        # Accumulate model outputs for completed days so averages over the full
+        # history don't need the old feature rows
+        state = self.patients[patient_id]
+        state.output_sum += float(np.sum(outputs))
+        state.output_count += len(outputs)
+
+    def received(self, patient_id):
+        return self.patients[patient_id].received
+
+    def output_totals(self, patient_id):
+        state = self.patients[patient_id]
+        return state.output_sum, state.output_count
+
+    def snapshot(self, path):
+        # Write atomically so a crash mid-write never leaves a truncated state file.
+        # The temporary name is unique, so concurrent writers each replace the
+        # file whole
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or ".", prefix=".tmp-"
+        )
+        try:
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump({"window": self.window, "patients": self.patients}, file)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def restore(cls, path):
+        with open(path, "rb") as file:
+            data = pickle.load(file)
+        state = cls()
+        state.window = data["window"]
+        state.patients = data["patients"]
+        return state
+
+
+# TESTING
+class TestGlucoseDataPreprocessor(unittest.TestCase):
+    def setUp(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.data = pd.read_csv(
+            os.path.join(dir_path, "../../Dataset/synthetic_diabetes_data_v6.csv")
+        )
+        self.preprocessor = GlucoseDataPreprocessor()
+
+    def assert_matches_groupby(self, data):
+        expected = self.preprocessor.transform_groupby(data.copy())
+        result = self.preprocessor.transform(data.copy())
+        pd.testing.assert_frame_equal(
+            result, expected, check_exact=False, rtol=1e-9, atol=1e-9
+        )
+
+    def test_parity_on_synthetic_dataset(self):
+        self.assert_matches_groupby(self.data)
+
+    def test_parity_on_irregular_input(self):
+        rng = np.random.default_rng(0)
+        data = self.data.sample(frac=0.3, random_state=0).copy()
+        data["Patient_ID"] = "p" + (data["Patient_ID"] % 7).astype(str)
+        data.loc[data.sample(frac=0.05, random_state=1).index, "Blood_Glucose"] = np.nan
+        data.loc[data.sample(frac=0.3, random_state=2).index, "HbA1c"] = np.nan
+        data["Timestamp"] = pd.to_datetime(data["Timestamp"]) + pd.to_timedelta(
+            rng.integers(0, 86_400, len(data)), unit="s"
+        )
+        self.assert_matches_groupby(data)
+
+    def test_incremental_matches_transform(self):
+        expected = self.preprocessor.transform(self.data.copy())
+        expected = expected[["rolling_mean", "rolling_median", "rolling_std"]]
+
+        rows = []
+        state = IncrementalGlucoseState()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "state.pkl")
+            for patient_id, readings in self.data.groupby("Patient_ID", sort=True):
+                # Feed readings a few at a time, restarting from a snapshot midway
+                for i, chunk in enumerate(np.array_split(readings, 40)):
+                    finalized, current = state.update(
+                        patient_id,
+                        chunk["Timestamp"],
+                        chunk["Blood_Glucose"],
+                        chunk["HbA1c"],
+                    )
+                    rows.extend(finalized)
+                    if i == 20:
+                        state.snapshot(path)
+                        state = IncrementalGlucoseState.restore(path)
+                if current is not None:
+                    rows.append(current)
+
+        np.testing.assert_allclose(np.array(rows), expected.to_numpy(), rtol=1e-9)
+
+    def test_incremental_skips_missing_timestamps(self):
+        data = self.data[self.data["Patient_ID"] == 1].copy()
+        data["Timestamp"] = pd.to_datetime(data["Timestamp"]).astype(object)
+        data.iloc[[5, 40], data.columns.get_loc("Timestamp")] = None
+        data.iloc[[6, 90], data.columns.get_loc("Blood_Glucose")] = np.nan
+        expected = self.preprocessor.transform(data.copy())
+        expected = expected[["rolling_mean", "rolling_median", "rolling_std"]]
+
+        rows = []
+        state = IncrementalGlucoseState()
+        for chunk in np.array_split(data, 30):
+            finalized, current = state.update(
+                "a", chunk["Timestamp"], chunk["Blood_Glucose"], chunk["HbA1c"]
+            )
+            rows.extend(finalized)
+        rows.append(current)
+        np.testing.assert_allclose(np.array(rows), expected.to_numpy(), rtol=1e-9)
+
+        # A reading without a timestamp neither opens a day nor is too old
+        state = IncrementalGlucoseState()
+        finalized, current = state.update("b", [None], [100.0])
+        self.assertIsNone(state.patients["b"].day)
+        state.update("b", ["2024-01-02 08:00"], [100.0])
+        state.update("b", [None, "2024-01-02 09:00"], [90.0, 110.0])
+        self.assertEqual(state.patients["b"].count, 2)
+
+    def test_incremental_rejects_old_readings(self):
+        state = IncrementalGlucoseState()
+        state.update("a", ["2024-01-02 08:00"], [100.0])
+        with self.assertRaises(ValueError):
+            state.update("a", ["2024-01-01 08:00"], [100.0])
+
+    def test_incremental_checks_reading_count(self):
+        state = IncrementalGlucoseState()
+        state.update("a", ["2024-01-02 08:00", None], [100.0, 90.0], previous=0)
+        self.assertEqual(state.received("a"), 2)
+        state.update("a", ["2024-01-02 09:00"], [110.0], previous=2)
+        # A state that missed readings, or never saw the patient, can't go on
+        for patient_id, previous in (("a", 2), ("a", 5), ("b", 3)):
+            with self.assertRaises(StaleReadings):
+                state.update(
+                    patient_id, ["2024-01-02 10:00"], [100.0], previous=previous
+                )
+        self.assertEqual(state.received("a"), 3)
+        self.assertNotIn("b", state.patients)
+        # Sending the history again from 0 starts the patient over
+        state.update("a", ["2024-01-01 08:00"], [100.0], previous=0)
+        self.assertEqual(state.received("a"), 1)
+        self.assertEqual(state.patients["a"].count, 1)
+
+    def test_single_day(self):
+        data = self.data[self.data["Patient_ID"] == 1].head(3)
+        self.assertTrue(self.preprocessor.transform(data.copy()).empty)
+        self.assert_matches_groupby(data)
+
+    def test_transform_by_patient(self):
+        features = self.preprocessor.transform_by_patient(self.data.copy())
+        for patient in [1, 17, 49]:
+            expected = self.preprocessor.transform(
+                self.data[self.data["Patient_ID"] == patient].copy()
+            )
+            rows = features[features["Patient_ID"] == patient]
+            np.testing.assert_allclose(
+                rows[expected.columns].to_numpy(dtype=float),
+                expected.to_numpy(dtype=float),
+                rtol=1e-12,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
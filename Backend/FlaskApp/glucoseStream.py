@@ -0,0 +1,251 @@
+import argparse
+import os
+import pickle
+import resource
+import sys
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from glucosePreprocessor import (
+    NS_PER_DAY,
+    GlucoseDataPreprocessor,
+    complete_rows,
+    daily_statistics,
+    rolling_features,
+    summary_features,
+)
+
+# Only the columns the preprocessor needs are read, with explicit types so pandas
+# doesn't have to infer them chunk by chunk
+USECOLS = ["Patient_ID", "Timestamp", "Blood_Glucose", "HbA1c"]
+DTYPES = {"Blood_Glucose": "float64", "HbA1c": "float64"}
+FEATURE_COLUMNS = ["rolling_mean", "rolling_median", "rolling_std"]
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def read_glucose_chunks(path, chunksize):
+    for chunk in pd.read_csv(path, usecols=USECOLS, dtype=DTYPES, chunksize=chunksize):
+        chunk["Timestamp"] = pd.to_datetime(chunk["Timestamp"])
+        yield chunk
+
+
+def _days(block):
+    timestamps = block["Timestamp"]
+    if getattr(timestamps.dt, "tz", None) is not None:
+        timestamps = timestamps.dt.tz_localize(None)
+    return timestamps.to_numpy(dtype="datetime64[ns]").view(np.int64) // NS_PER_DAY
+
+
+class GlucoseFeatureStream:
+    # Runs the preprocessor over a CSV sorted by patient and time, one chunk at a
+    # time. The last (patient, day) of each chunk is held back until its readings
+    # are complete, and the previous window - 1 daily statistics of the patient
+    # spanning the chunk boundary are carried over so rolling features are
+    # identical to transforming the whole file at once
+    def __init__(self, window=21):
+        self.window = window // 3  # Same 3 readings per day as the preprocessor
+        self.context = None  # (patient, last day, recent daily stats)
+        self.finished = set()
+        self.offset = 0
+
+    def _check_order(self, patients, codes, days):
+        for patient in patients:
+            if patient in self.finished:
+                raise ValueError(
+                    f"Patient {patient!r} appears again after later patients, "
+                    "the file must be sorted by patient"
+                )
+        if self.context is not None:
+            patient, last_day, _ = self.context
+            continuing = np.flatnonzero(patients == patient)
+            if len(continuing) and days[codes == continuing[0]].min() <= last_day:
+                raise ValueError(
+                    f"Readings for patient {patient!r} are not sorted by time"
+                )
+
+    def process_block(self, block):
+        codes, days, patients, stats, hba1c = daily_statistics(block)
+        patients = np.asarray(patients, dtype=object)
+        if not len(stats):
+            return None
+        self._check_order(patients, codes, days)
+
+        # Insert the carried daily rows right before the continuing patient's days
+        is_context = np.zeros(len(stats), dtype=bool)
+        if self.context is not None:
+            patient, _, context_stats = self.context
+            continuing = np.flatnonzero(patients == patient)
+            if len(continuing):
+                position = int(np.searchsorted(codes, continuing[0]))
+                n_context = len(context_stats)
+                codes = np.insert(codes, position, [continuing[0]] * n_context)
+                days = np.insert(days, position, [0] * n_context)
+                stats = np.insert(stats, position, context_stats, axis=0)
+                hba1c = np.insert(hba1c, position, [np.nan] * n_context)
+                is_context = np.insert(is_context, position, [True] * n_context)
+            else:
+                self.finished.add(patient)
+
+        rolling_means, rolling_stds = rolling_features(codes, stats, self.window)
+        summaries = summary_features(rolling_means, rolling_stds)
+        keep = complete_rows(stats, hba1c, rolling_means, rolling_stds, summaries)
+        keep &= ~is_context
+
+        index = self.offset + np.cumsum(~is_context) - 1
+        self.offset += int(np.count_nonzero(~is_context))
+
+        # Carry the most recent days of the last patient in the file order
+        last_patient = block["Patient_ID"].iloc[-1]
+        last_code = int(np.flatnonzero(patients == last_patient)[0])
+        rows = np.flatnonzero((codes == last_code) & ~is_context)
+        patient_stats = stats[codes == last_code]
+        carried = patient_stats[max(0, len(patient_stats) - self.window + 1) :]
+        self.context = (last_patient, days[rows[-1]], carried)
+        for patient in patients:
+            if patient != last_patient:
+                self.finished.add(patient)
+
+        features = pd.DataFrame(
+            {
+                "Patient_ID": patients[codes[keep]],
+                "rolling_mean": summaries[0][keep],
+                "rolling_median": summaries[1][keep],
+                "rolling_std": summaries[2][keep],
+                "HbA1c": hba1c[keep],
+            },
+            index=index[keep],
+        )
+        return features
+
+    def stream(self, chunks):
+        carry = None
+        for chunk in chunks:
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+
+            # Hold back the last patient's latest day, it may continue in the next chunk
+            days = _days(chunk)
+            last_patient = chunk["Patient_ID"].iloc[-1]
+            same_patient = (chunk["Patient_ID"] == last_patient).to_numpy()
+            tail = same_patient & (days == days[same_patient].max())
+            carry = chunk[tail]
+            block = chunk[~tail]
+
+            if len(block):
+                features = self.process_block(block)
+                if features is not None and len(features):
+                    yield features
+
+        if carry is not None and len(carry):
+            features = self.process_block(carry)
+            if features is not None and len(features):
+                yield features
+
+
+def stream_features(path, window=21, chunksize=500_000):
+    # Feature batches for a glucose CSV, with bounded memory
+    stream = GlucoseFeatureStream(window)
+    return stream.stream(read_glucose_chunks(path, chunksize))
+
+
+def score_stream(batches, model, feature_names):
+    # Average A1c prediction per patient, emitted once a patient is complete
+    current, total, count = None, 0.0, 0
+    for features in batches:
+        predictions = model.predict(features[feature_names])
+        for patient, group in pd.Series(predictions).groupby(
+            features["Patient_ID"].to_numpy(), sort=False
+        ):
+            if patient != current:
+                if current is not None:
+                    yield current, total / count, count
+                current, total, count = patient, 0.0, 0
+            total += float(group.sum())
+            count += len(group)
+    if current is not None:
+        yield current, total / count, count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stream glucose readings through the A1c preprocessor in chunks"
+    )
+    parser.add_argument("command", choices=["features", "score"])
+    parser.add_argument("csv", help="Glucose CSV sorted by patient and timestamp")
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    parser.add_argument("--model", default="A1cModel.pkl")
+    parser.add_argument("--out", help="Write results to this CSV")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    batches = stream_features(args.csv, chunksize=args.chunksize)
+    out = open(args.out, "w") if args.out else None
+    n_rows = 0
+
+    if args.command == "features":
+        for features in batches:
+            n_rows += len(features)
+            if out:
+                features.to_csv(out, header=out.tell() == 0, index_label="day")
+    else:
+        with open(args.model, "rb") as file:
+            model_data = pickle.load(file)
+        # sklearn's Cython traversal is faster than the compiled forest for large batches
+        model = model_data["model"] if isinstance(model_data, dict) else model_data
+        if out:
+            out.write("Patient_ID,HbA1c,days\n")
+        for patient, hba1c, days in score_stream(
+            batches, model, list(model.feature_names_in_)
+        ):
+            n_rows += 1
+            if out:
+                out.write(f"{patient},{hba1c},{days}\n")
+
+    if out:
+        out.close()
+    print(
+        f"{n_rows} rows in {time.perf_counter() - start:.1f}s, "
+        f"peak RSS {peak_rss_mb():.0f} MB"
+    )
+
+
+# TESTING
+class TestGlucoseFeatureStream(unittest.TestCase):
+    def setUp(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.path = os.path.join(
+            dir_path, "../../Dataset/synthetic_diabetes_data_v6.csv"
+        )
+        data = pd.read_csv(self.path)
+        self.expected = GlucoseDataPreprocessor().transform(data)
+
+    def test_matches_transform_for_any_chunk_size(self):
+        for chunksize in [100, 271, 1000, 20_000]:
+            result = pd.concat(stream_features(self.path, chunksize=chunksize))
+            pd.testing.assert_frame_equal(
+                result.drop(columns="Patient_ID"),
+                self.expected,
+                check_exact=False,
+                rtol=1e-9,
+            )
+
+    def test_unsorted_patients_are_rejected(self):
+        data = pd.read_csv(self.path)
+        chunks = np.array_split(pd.concat([data, data.head(500)]), 30)
+        with self.assertRaises(ValueError):
+            for chunk in GlucoseFeatureStream().stream(
+                c.assign(Timestamp=pd.to_datetime(c["Timestamp"])) for c in chunks
+            ):
+                pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+import os
+import pickle
+import time
+import warnings
+
+import numpy as np
+
+from glucosePayload import payload_length, to_columns
+from metrics import stage
+from modelArtifacts import BundleWatcher, current_bundle
+from modelExport import is_exported, load_exported_encoder, load_exported_fitted
+from modelRegistry import ModelRegistry, load_questionnaire_encoder
+from predictionTable import load_table
+
+# Model state and inference shared by the Flask app and the async server. Like the
+# rest of the service, pandas, sklearn and the glucose preprocessor are only
+# imported once an endpoint needs them
+
+# Legacy pickle in this directory and the key of the estimator inside it, per model
+MODEL_FILES = {
+    "diabetes": ("final_predict_model.pkl", None),
+    "a1c": ("A1cModel.pkl", "model"),
+}
+# With MODEL_ARTIFACTS set, models come from the bundles published there instead
+# (see modelArtifacts.py), and every MODEL_RELOAD_INTERVAL seconds each worker checks
+# for a newly published bundle and swaps it in without a restart
+ARTIFACTS_DIR = os.environ.get("MODEL_ARTIFACTS")
+MODEL_RELOAD_INTERVAL = float(os.environ.get("MODEL_RELOAD_INTERVAL", "5"))
+BUNDLE_MODEL_FILE = "model.pkl"
+# MODEL_EXPORT_DIR serves the pickle-free exports written by modelExport.py instead
+# of the legacy pickles; published bundles still take precedence
+EXPORT_DIR = os.environ.get("MODEL_EXPORT_DIR")
+
+# Models are loaded on first use as compiled forests memory-mapped from a cache of
+# their node arrays, shared between workers. MODEL_PRELOAD=1 loads them at startup,
+# in the gunicorn master when running with --preload
+models = ModelRegistry(os.environ.get("MODEL_CACHE_DIR", "model_cache"))
+# Preprocessing config of each bundle, by the path of its model file
+bundle_configs = {}
+for name, (path, key) in MODEL_FILES.items():
+    bundle = current_bundle(ARTIFACTS_DIR, name) if ARTIFACTS_DIR else None
+    if bundle is not None:
+        path = bundle.file(BUNDLE_MODEL_FILE)
+        bundle_configs[path] = bundle.config
+    elif EXPORT_DIR:
+        path = os.path.join(EXPORT_DIR, name)
+    models.register(name, path, key=key)
+
+
+def _beside(forest, file_name):
+    # Encoders and scaler sit next to the model file, in the bundle or this directory
+    return os.path.join(os.path.dirname(forest.source), file_name)
+
+
+def fitted_encoders(forest=None):
+    # The LabelEncoders and MinMaxScaler that go with a diabetes forest, kept on the
+    # forest so a reload swaps them together
+    forest = forest or models.get("diabetes")
+    if getattr(forest, "fitted_encoders", None) is None:
+        if is_exported(forest.source):
+            forest.fitted_encoders = load_exported_fitted(forest.source)
+        else:
+            with open(_beside(forest, "encoders.pkl"), "rb") as file:
+                encoders = pickle.load(file)
+            with open(_beside(forest, "minmax.pkl"), "rb") as file:
+                minmax = pickle.load(file)
+            forest.fitted_encoders = encoders, minmax
+    return forest.fitted_encoders
+
+
+def questionnaire_encoder(forest=None):
+    # Compile the encoders and scaler into plain lookups for the /predict hot path
+    forest = forest or models.get("diabetes")
+    if getattr(forest, "questionnaire_encoder", None) is None:
+        if is_exported(forest.source):
+            forest.questionnaire_encoder = load_exported_encoder(forest.source)
+        else:
+            forest.questionnaire_encoder = load_questionnaire_encoder(
+                models.cache_dir,
+                _beside(forest, "encoders.pkl"),
+                _beside(forest, "minmax.pkl"),
+                forest.feature_names,
+            )
+    return forest.questionnaire_encoder
+
+
+def preprocessor_config(forest):
+    return bundle_configs.get(forest.source, {})
+
+
+# The encoder produces rows in the fitted column order, so feature names are not needed
+warnings.filterwarnings("ignore", message="X does not have valid feature names")
+
+# Optional table mode: answer /predict from a precomputed lookup table of the whole
+# input space, built offline with predictionTable.py or at startup
+prediction_table = None
+if os.environ.get("PREDICT_TABLE"):
+    prediction_table = load_table(
+        os.environ["PREDICT_TABLE"],
+        *fitted_encoders(),
+        models.sources["diabetes"][0],
+        questionnaire_encoder().feature_columns,
+        build=os.environ.get("PREDICT_TABLE_BUILD") == "1",
+    )
+
+
+# Sample requests for warm-up at boot and for load tests
+WARMUP_QUESTIONNAIRE = {
+    "age": 45,
+    "gender": "Male",
+    "polyuria": "No",
+    "polydipsia": "No",
+    "sudden weight loss": "No",
+    "weakness": "Yes",
+    "polyphagia": "No",
+    "genital thrush": "No",
+    "visual blurring": "No",
+    "itching": "No",
+    "irritability": "No",
+    "delayed healing": "No",
+    "partial paresis": "No",
+    "muscle stiffness": "No",
+    "alopecia": "No",
+    "obesity": "No",
+}
+WARMUP_READINGS = [
+    {"timestamp": f"2024-01-{day:02d}T{hour:02d}:00:00", "blood_glucose": 100 + hour}
+    for day in range(1, 10)
+    for hour in (0, 8, 16)
+]
+
+
+def predict_questionnaires(X, forest=None):
+    # Predictions for encoded questionnaire rows. In table mode only rows outside
+    # the table's age range go to the model, until a reload replaces the model the
+    # table was built from
+    diabetes_forest = forest or models.get("diabetes")
+    if (
+        prediction_table is None
+        or prediction_table.meta["model_sha256"] != diabetes_forest.version
+    ):
+        return diabetes_forest.predict(X)
+    predictions, _, hit = prediction_table.lookup(X)
+    if not hit.all():
+        predictions[~hit] = diabetes_forest.predict(X[~hit])
+    return predictions
+
+
+def a1c_features(readings, forest=None):
+    # Feature rows for one /estimate-a1c request, in the order the A1c model expects.
+    # readings is any payload glucosePayload.to_columns accepts. Raises ValueError
+    # when the readings can't produce any
+    import pandas as pd
+    from glucosePreprocessor import GlucoseDataPreprocessor
+
+    a1c_forest = forest or models.get("a1c")
+    with stage("dataframe"):
+        timestamps, glucose, hba1c = to_columns(readings)
+        input_data = pd.DataFrame(
+            {
+                "Patient_ID": np.zeros(len(timestamps), dtype=np.int64),
+                "Timestamp": timestamps,
+                "Blood_Glucose": glucose,
+                "HbA1c": hba1c,
+            }
+        )
+        preprocessor = GlucoseDataPreprocessor(**preprocessor_config(a1c_forest))
+
+    # Preprocess the data
+    with stage("preprocess"):
+        processed_data = preprocessor.transform(input_data)
+    if processed_data.empty:
+        raise ValueError("Not enough readings to estimate HbA1c")
+    return processed_data[a1c_forest.feature_names].to_numpy()
+
+
+def predict_a1c(features, forest=None):
+    # The estimate is the mean prediction over every complete window
+    return float(np.mean((forest or models.get("a1c")).predict(features)))
+
+
+def estimate_a1c_many(requests, forest=None):
+    # HbA1c estimates for several independent payloads with a single preprocessing
+    # pass and a single model call. Returns one float per request, or a ValueError
+    # for requests that can't be estimated
+    import pandas as pd
+    from glucosePreprocessor import GlucoseDataPreprocessor
+
+    a1c_forest = forest or models.get("a1c")
+    results = [None] * len(requests)
+    owners, timestamps, glucose, hba1c = [], [], [], []
+    for i, payload in enumerate(requests):
+        try:
+            # Timestamps are parsed per request, so each request's format is
+            # detected on its own as in the single request path
+            columns = to_columns(payload)
+        except (ValueError, TypeError) as e:
+            results[i] = ValueError(str(e))
+            continue
+        owners.append(np.full(len(columns[0]), i))
+        timestamps.append(columns[0])
+        glucose.append(columns[1])
+        hba1c.append(columns[2])
+
+    if owners:
+        data = pd.DataFrame(
+            {
+                "Patient_ID": np.concatenate(owners),
+                "Timestamp": np.concatenate(timestamps),
+                "Blood_Glucose": np.concatenate(glucose),
+                "HbA1c": np.concatenate(hba1c),
+            }
+        )
+        preprocessor = GlucoseDataPreprocessor(**preprocessor_config(a1c_forest))
+        features = preprocessor.transform_by_patient(data)
+        predictions = a1c_forest.predict(features[a1c_forest.feature_names].to_numpy())
+        rows = features["Patient_ID"].to_numpy(dtype=np.int64)
+        totals = np.bincount(rows, predictions, minlength=len(requests))
+        counts = np.bincount(rows, minlength=len(requests))
+
+    for i in range(len(requests)):
+        if results[i] is not None:
+            continue
+        if counts[i] == 0:
+            results[i] = ValueError("Not enough readings to estimate HbA1c")
+        else:
+            results[i] = float(totals[i] / counts[i])
+    return results
+
+
+# Batches of more than A1C_SHARD_READINGS readings are split into shards of whole
+# patients, estimated in parallel on A1C_SHARD_WORKERS threads. Most of the work is
+# NumPy sorting and reductions, which release the GIL
+A1C_SHARD_READINGS = int(os.environ.get("A1C_SHARD_READINGS", "200000"))
+A1C_SHARD_WORKERS = int(os.environ.get("A1C_SHARD_WORKERS", str(os.cpu_count())))
+shard_executor = None
+
+
+def a1c_shards(requests, max_readings):
+    # Consecutive runs of requests with at most max_readings readings each, a
+    # request larger than that making up a shard on its own
+    shards, start, size = [], 0, 0
+    for i, payload in enumerate(requests):
+        length = payload_length(payload)
+        if size and size + length > max_readings:
+            shards.append((start, i))
+            start, size = i, 0
+        size += length
+    shards.append((start, len(requests)))
+    return shards
+
+
+def estimate_a1c_batch(requests, max_readings=None):
+    # estimate_a1c_many for a batch of any size, with the same per-request results
+    global shard_executor
+
+    a1c_forest = models.get("a1c")
+    shards = a1c_shards(requests, max_readings or A1C_SHARD_READINGS)
+    if len(shards) == 1 or A1C_SHARD_WORKERS <= 1:
+        return estimate_a1c_many(requests, a1c_forest)
+
+    if shard_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        shard_executor = ThreadPoolExecutor(A1C_SHARD_WORKERS)
+    results = shard_executor.map(
+        lambda shard: estimate_a1c_many(requests[shard[0] : shard[1]], a1c_forest),
+        shards,
+    )
+    return [result for shard_results in results for result in shard_results]
+
+
+def reload_model(name, bundle):
+    # Runs on the watcher thread. The new forest is loaded, its encoders compiled
+    # and a prediction run before it is installed, so requests never wait on a load;
+    # requests already holding the old forest finish with it
+    start = time.perf_counter()
+    path = bundle.file(BUNDLE_MODEL_FILE)
+    key = MODEL_FILES[name][1]
+    bundle_configs[path] = bundle.config
+    current = models.get(name)
+    forest = models.load(name, path, key)
+    if name == "diabetes":
+        X = questionnaire_encoder(forest).encode(WARMUP_QUESTIONNAIRE)
+        forest.predict(X)
+        if getattr(current, "fitted_encoders", None) is not None:
+            fitted_encoders(forest)
+    else:
+        forest.predict(a1c_features(WARMUP_READINGS, forest))
+    models.install(name, forest, key)
+    print(
+        f"Reloaded {name} from {bundle} in {(time.perf_counter() - start) * 1e3:.1f} ms"
+    )
+
+
+model_watcher = None
+
+
+def start_model_watcher():
+    # Started in each worker process: a thread started in the gunicorn master before
+    # forking would not run in the workers
+    global model_watcher
+    if not ARTIFACTS_DIR or MODEL_RELOAD_INTERVAL <= 0:
+        return None
+    if model_watcher is None or model_watcher.pid != os.getpid():
+        served = {
+            name: os.path.basename(os.path.dirname(models.sources[name][0]))
+            for name in MODEL_FILES
+        }
+        model_watcher = BundleWatcher(
+            ARTIFACTS_DIR, MODEL_FILES, reload_model, MODEL_RELOAD_INTERVAL, served
+        )
+        model_watcher.pid = os.getpid()
+        model_watcher.start()
+    return model_watcher
@@ -0,0 +1,508 @@
+import argparse
+import csv
+import http.client
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+import urllib.parse
+import urllib.request
+
+import numpy as np
+
+from inferenceService import WARMUP_QUESTIONNAIRE
+
+# Load generator for the service, standing in for the Node backend: request bodies
+# are built the way app/controllers/MLPredictionController.js builds them, from
+# questionnaires in Dataset/ and glucose histories from Dataset/ and the synthetic
+# generator. Two ways of driving load:
+#   closed loop (--concurrency): each client sends its next request as soon as the
+#   previous response arrives, so the offered load adapts to the server
+#   open loop (--rate): requests arrive as a Poisson process at a fixed rate
+#   whatever the server does, like users do. Latency is measured from each
+#   request's scheduled arrival, so time spent queued behind a slow server counts
+# Servers are started as subprocesses from this directory unless --url points at a
+# running one
+dir_path = os.path.dirname(os.path.realpath(__file__))
+dataset_path = os.path.join(dir_path, "../../Dataset")
+synthetic_path = os.path.join(dir_path, "../ML-Models/A1c-Estimation")
+
+SERVERS = {
+    # The production setup from the Procfile, with as many sync workers as asked
+    # for, or gthread workers when threads > 1
+    "flask": lambda port, workers, threads: [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "flaskApp:app",
+        "--preload",
+        "--workers",
+        str(workers),
+        "--threads",
+        str(threads),
+        "--bind",
+        f"127.0.0.1:{port}",
+    ],
+    "async": lambda port, workers, threads: [
+        sys.executable,
+        "asyncServer.py",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+    ],
+}
+
+# Glucose histories: the share of users on each kind of meter and its readings per
+# day, and how many days of readings the app sends, drawn from a log-normal (most
+# users send a few weeks, some several months)
+METERS = {"fingerstick": (0.7, 3), "cgm": (0.3, 96)}
+HISTORY_DAYS_MEDIAN = 30
+HISTORY_DAYS_SIGMA = 0.7
+HISTORY_DAYS_RANGE = (3, 180)
+# Patient categories of the synthetic generator: non, pre and diabetic
+CATEGORY_MIX = (0.2, 0.3, 0.5)
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def node_predict_body(form):
+    # predictDiabetes posts the form as it came from the app
+    return form
+
+
+def node_a1c_body(timestamps, glucose_values):
+    # estimateA1c turns the app's two arrays into readings for one patient
+    return {
+        "readings": [
+            {"timestamp": timestamp, "blood_glucose": value, "patient_id": 1}
+            for timestamp, value in zip(timestamps, glucose_values)
+        ]
+    }
+
+
+def js_timestamps(values):
+    # Date.prototype.toISOString, as the app serialises reading times
+    return [
+        f"{np.datetime_as_string(value, unit='ms')}Z"
+        for value in np.asarray(values, dtype="datetime64[ms]")
+    ]
+
+
+def questionnaire_forms():
+    # The app's form uses the dataset's questions in lower case, with the answers
+    # as the dataset spells them
+    with open(os.path.join(dataset_path, "balanced_diabetes_data.csv")) as file:
+        rows = list(csv.DictReader(file))
+    forms = []
+    for row in rows:
+        form = {key.lower(): value for key, value in row.items() if key != "class"}
+        form["age"] = int(form["age"])
+        forms.append(form)
+    return forms
+
+
+def dataset_histories():
+    # Readings per patient of the A1c dataset: 90 days of fingerstick readings
+    histories = {}
+    with open(os.path.join(dataset_path, "synthetic_diabetes_data_v6.csv")) as file:
+        for row in csv.DictReader(file):
+            timestamps, glucose = histories.setdefault(row["Patient_ID"], ([], []))
+            timestamps.append(np.datetime64(row["Timestamp"].replace(" ", "T")))
+            glucose.append(float(row["Blood_Glucose"]))
+    return list(histories.values())
+
+
+def synthetic_history(rng, days, readings_per_day):
+    # One patient from the generator behind the A1c dataset
+    sys.path.insert(0, synthetic_path)
+    from SyntheticDataset import generate_block
+
+    shard = generate_block(
+        int(rng.integers(2**32)), 0, 1, days, readings_per_day, CATEGORY_MIX
+    )
+    start = np.datetime64("2024-01-01T00:00:00") - np.timedelta64(days, "D")
+    step = np.timedelta64(86400 // readings_per_day, "s")
+    timestamps = start + step * np.arange(days * readings_per_day)
+    return timestamps, np.round(shard["Blood_Glucose"], 1).tolist()
+
+
+def history_lengths(rng, count):
+    meters = list(METERS)
+    shares = np.array([METERS[meter][0] for meter in meters])
+    chosen = rng.choice(len(meters), size=count, p=shares / shares.sum())
+    days = rng.lognormal(np.log(HISTORY_DAYS_MEDIAN), HISTORY_DAYS_SIGMA, count)
+    days = np.clip(np.round(days), *HISTORY_DAYS_RANGE).astype(int)
+    return [(meters[i], int(d)) for i, d in zip(chosen, days)]
+
+
+def a1c_bodies(rng, count):
+    # Fingerstick histories that fit in the dataset's 90 days are the latest days
+    # of one of its patients; CGM and longer histories come from the generator
+    histories = dataset_histories()
+    bodies = []
+    for meter, days in history_lengths(rng, count):
+        readings_per_day = METERS[meter][1]
+        if meter == "fingerstick" and days * readings_per_day <= len(histories[0][0]):
+            timestamps, glucose = histories[rng.integers(len(histories))]
+            timestamps = timestamps[-days * readings_per_day :]
+            glucose = glucose[-days * readings_per_day :]
+        else:
+            timestamps, glucose = synthetic_history(rng, days, readings_per_day)
+        bodies.append(node_a1c_body(js_timestamps(timestamps), glucose))
+    return bodies
+
+
+def predict_bodies(rng, count):
+    forms = questionnaire_forms()
+    return [node_predict_body(forms[i]) for i in rng.integers(len(forms), size=count)]
+
+
+ENDPOINTS = {
+    "predict": ("/predict", predict_bodies),
+    "estimate-a1c": ("/estimate-a1c", a1c_bodies),
+}
+
+
+def parse_mix(spec):
+    # "predict=0.8,estimate-a1c=0.2", or a single endpoint name
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {name!r}")
+        mix[name] = float(weight or 1)
+    total = sum(mix.values())
+    return {name: weight / total for name, weight in mix.items()}
+
+
+def build_schedule(mix, requests, payloads, seed=0):
+    # Endpoint and serialised body of every request, drawn from a pool of distinct
+    # payloads per endpoint so the bodies are ready before the clock starts
+    rng = np.random.default_rng(seed)
+    pools = {
+        name: [
+            json.dumps(body).encode()
+            for body in ENDPOINTS[name][1](rng, min(payloads, requests))
+        ]
+        for name in mix
+    }
+    names = list(mix)
+    chosen = rng.choice(len(names), size=requests, p=[mix[name] for name in names])
+    return [
+        (names[i], pools[names[i]][rng.integers(len(pools[names[i]]))]) for i in chosen
+    ]
+
+
+def run_load(url, schedule, concurrency, rate=None, keep_alive=True, seed=0):
+    # Sends every request of the schedule from `concurrency` client threads. With
+    # a rate, requests start at their Poisson arrival times and concurrency caps
+    # how many can be in flight; otherwise each client sends back to back. Returns
+    # (endpoint, status, seconds) per request, status 0 for connection errors
+    parsed = urllib.parse.urlparse(url)
+    headers = {"Content-Type": "application/json"}
+    arrivals = None
+    if rate:
+        rng = np.random.default_rng(seed)
+        arrivals = np.cumsum(rng.exponential(1 / rate, len(schedule)))
+    records = [None] * len(schedule)
+    next_request = itertools.count()
+
+    def client():
+        connection = None
+        while True:
+            # next() on a count is atomic, so clients share it without a lock
+            i = next(next_request)
+            if i >= len(schedule):
+                break
+            endpoint, body = schedule[i]
+            start = time.perf_counter()
+            if arrivals is not None:
+                scheduled = begin + arrivals[i]
+                if scheduled > start:
+                    time.sleep(scheduled - start)
+                start = scheduled
+            if connection is None:
+                connection = http.client.HTTPConnection(parsed.hostname, parsed.port)
+            try:
+                connection.request("POST", ENDPOINTS[endpoint][0], body, headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = 0
+                connection.close()
+                connection = None
+            records[i] = (endpoint, status, time.perf_counter() - start)
+            if not keep_alive and connection is not None:
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, time.perf_counter() - begin
+
+
+def summarize(records, seconds):
+    # Throughput, latency percentiles and errors, overall and per endpoint. Any
+    # status other than 200 counts as an error; 503s, requests turned away by the
+    # service's admission control, are also counted as shed
+    def stats(rows):
+        latencies = np.array([row[2] for row in rows]) * 1e3
+        statuses = np.array([row[1] for row in rows])
+        result = {
+            "requests": len(rows),
+            "throughput": len(rows) / seconds,
+            "errors": int(np.sum(statuses != 200)),
+            "error_rate": float(np.mean(statuses != 200)),
+            "shed_rate": float(np.mean(statuses == 503)),
+            "statuses": {
+                str(status): int(count)
+                for status, count in zip(*np.unique(statuses, return_counts=True))
+            },
+            "max_ms": float(latencies.max()),
+        }
+        for percentile in PERCENTILES:
+            result[f"p{percentile:g}_ms"] = float(np.percentile(latencies, percentile))
+        return result
+
+    summary = dict(stats(records), seconds=seconds)
+    endpoints = sorted({row[0] for row in records})
+    if len(endpoints) > 1:
+        summary["endpoints"] = {
+            endpoint: stats([row for row in records if row[0] == endpoint])
+            for endpoint in endpoints
+        }
+    return summary
+
+
+def start_server(name, port, workers, threads=1):
+    env = dict(os.environ, WARMUP="1")
+    process = subprocess.Popen(
+        SERVERS[name](port, workers, threads),
+        cwd=dir_path,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # Ready once a request gets any response
+    url = f"http://127.0.0.1:{port}/predict"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            request = urllib.request.Request(
+                url,
+                data=json.dumps(WARMUP_QUESTIONNAIRE).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+            urllib.request.urlopen(request, timeout=5).read()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"{name} server exited during startup")
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{name} server did not start within 60s")
+
+
+def format_row(label, load, result):
+    return (
+        f"{label:>24} {load:>18} {result['throughput']:>8.1f} "
+        + "".join(
+            f"{result[f'p{percentile:g}_ms']:>9.1f}" for percentile in PERCENTILES
+        )
+        + f" {result['error_rate']:>7.2%} {result['shed_rate']:>7.2%}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay realistic traffic against the Flask or async server"
+    )
+    parser.add_argument(
+        "--target", action="append", choices=list(SERVERS), help="Default: both"
+    )
+    parser.add_argument("--url", help="Test a running server instead of starting one")
+    parser.add_argument(
+        "--mix",
+        action="append",
+        help="Traffic mix such as predict=0.8,estimate-a1c=0.2, or one endpoint. "
+        "Default: each endpoint on its own",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 8, 32],
+        help="Closed-loop clients, or the most requests in flight with --rate",
+    )
+    parser.add_argument(
+        "--rate", type=float, nargs="+", help="Open-loop arrival rates, in req/s"
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--payloads", type=int, default=200, help="Distinct bodies per endpoint"
+    )
+    parser.add_argument(
+        "--no-keep-alive",
+        action="store_true",
+        help="New connection per request, like axios without a keep-alive agent",
+    )
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1], help="gunicorn workers"
+    )
+    parser.add_argument(
+        "--threads", type=int, nargs="+", default=[1], help="gunicorn threads"
+    )
+    parser.add_argument("--port", type=int, default=8701)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    mixes = {spec: parse_mix(spec) for spec in args.mix or list(ENDPOINTS)}
+    schedules = {
+        spec: build_schedule(mix, args.requests, args.payloads, args.seed)
+        for spec, mix in mixes.items()
+    }
+    if args.rate:
+        loads = [
+            (f"{rate:g}/s, max {concurrency}", concurrency, rate)
+            for rate in args.rate
+            for concurrency in args.concurrency[-1:]
+        ]
+    else:
+        loads = [
+            (f"{concurrency} clients", concurrency, None)
+            for concurrency in args.concurrency
+        ]
+
+    servers = [(args.url, None, None)] if args.url else []
+    for target in [] if args.url else args.target or list(SERVERS):
+        # The async server runs one process, so only the Flask setup is swept
+        sizes = itertools.product(args.workers, args.threads)
+        for workers, threads in sizes if target == "flask" else [(1, 1)]:
+            servers.append((target, workers, threads))
+
+    results = []
+    print(
+        f"{'target':>24} {'load':>18} {'req/s':>8} "
+        + "".join(f"{f'p{percentile:g} ms':>9}" for percentile in PERCENTILES)
+        + f" {'errors':>7} {'shed':>7}"
+    )
+    for target, workers, threads in servers:
+        process = None
+        url = target
+        label = target
+        if target in SERVERS:
+            process = start_server(target, args.port, workers, threads)
+            url = f"http://127.0.0.1:{args.port}"
+            if target == "flask":
+                label = f"flask {workers}w x {threads}t"
+        try:
+            for spec, schedule in schedules.items():
+                print(f"{label:>24} {spec}")
+                for load, concurrency, rate in loads:
+                    records, seconds = run_load(
+                        url,
+                        schedule,
+                        concurrency,
+                        rate,
+                        keep_alive=not args.no_keep_alive,
+                        seed=args.seed,
+                    )
+                    result = summarize(records, seconds)
+                    result.update(
+                        target=target,
+                        workers=workers,
+                        threads=threads,
+                        mix=mixes[spec],
+                        concurrency=concurrency,
+                        rate=rate,
+                    )
+                    results.append(result)
+                    print(format_row("", load, result))
+                    for endpoint, stats in result.get("endpoints", {}).items():
+                        print(format_row(endpoint, "", stats))
+            if target == "async":
+                with urllib.request.urlopen(f"{url}/batch-stats") as response:
+                    print(f"{'':>24} batches: {response.read().decode()}")
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+# TESTING
+class TestLoadTest(unittest.TestCase):
+    def test_payloads_are_valid_requests(self):
+        from glucosePayload import to_columns
+
+        rng = np.random.default_rng(0)
+        form = predict_bodies(rng, 1)[0]
+        self.assertEqual(set(form), set(WARMUP_QUESTIONNAIRE))
+
+        for body in a1c_bodies(rng, 20):
+            readings = body["readings"]
+            self.assertEqual(readings[0]["patient_id"], 1)
+            self.assertTrue(readings[0]["timestamp"].endswith(".000Z"))
+            timestamps, glucose, _ = to_columns(body)
+            self.assertTrue((np.diff(timestamps) > np.timedelta64(0)).all())
+            self.assertTrue(((glucose >= 50) & (glucose <= 260)).all())
+        lengths = history_lengths(rng, 1000)
+        days = np.array([d for _, d in lengths])
+        self.assertTrue(20 <= np.median(days) <= 40)
+
+        with self.assertRaises(ValueError):
+            parse_mix("predict=1,train=1")
+        self.assertEqual(
+            parse_mix("predict=3,estimate-a1c"), {"predict": 0.75, "estimate-a1c": 0.25}
+        )
+
+    def test_open_and_closed_loop_against_the_app(self):
+        import logging
+
+        from werkzeug.serving import make_server
+
+        import flaskApp
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, flaskApp.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+        try:
+            mix = parse_mix("predict=0.7,estimate-a1c=0.3")
+            schedule = build_schedule(mix, 40, payloads=5)
+            for concurrency, rate in [(4, None), (8, 200.0)]:
+                records, seconds = run_load(url, schedule, concurrency, rate)
+                result = summarize(records, seconds)
+                self.assertEqual(result["requests"], 40)
+                # The threaded test server runs requests at once, so admission
+                # control may turn some A1c requests away
+                self.assertLessEqual(set(result["statuses"]), {"200", "503"})
+                self.assertEqual(
+                    result["errors"],
+                    round(result["shed_rate"] * 40),
+                    result["statuses"],
+                )
+                self.assertEqual(set(result["endpoints"]), set(mix))
+                self.assertLessEqual(result["p50_ms"], result["p99.9_ms"])
+        finally:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
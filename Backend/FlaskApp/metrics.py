@@ -0,0 +1,312 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import unittest
+
+# Minimal Prometheus metrics for the service, rendered in the text exposition format
+# by the /metrics endpoint. Values are kept per worker process. METRICS=0 turns
+# recording off: stages become a shared no-op and the request hooks return early
+ENABLED = os.environ.get("METRICS", "1") != "0"
+
+# Fraction of requests written to the request log as one JSON line each
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Endpoint label for the stages timed while handling the current request
+current_endpoint = contextvars.ContextVar("current_endpoint", default="none")
+
+metrics = []
+
+logger = logging.getLogger("sugarcheck.requests")
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(_format_value(value))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self.children.items()):
+            lines.extend(self.render_child(values, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return _Value()
+
+    def render_child(self, values, child):
+        labels = _format_labels(self.labelnames, values)
+        return [f"{self.name}_total{labels} {_format_value(child.value)}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def render_child(self, values, child):
+        labels = _format_labels(self.labelnames, values)
+        return [f"{self.name}{labels} {_format_value(child.value)}"]
+
+
+class _Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return _Buckets(self.buckets)
+
+    def render_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames + ("le",), values + (bound,))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = Counter(
+    "sugarcheck_requests", "Requests by endpoint and status", ("endpoint", "status")
+)
+REQUEST_SECONDS = Histogram(
+    "sugarcheck_request_seconds", "Request latency by endpoint", ("endpoint",)
+)
+STAGE_SECONDS = Histogram(
+    "sugarcheck_stage_seconds",
+    "Time spent in each stage of a request",
+    ("endpoint", "stage"),
+)
+BATCH_RECORDS = Histogram(
+    "sugarcheck_batch_records",
+    "Records per /predict-batch request",
+    buckets=SIZE_BUCKETS,
+)
+A1C_READINGS = Histogram(
+    "sugarcheck_a1c_readings",
+    "Glucose readings per /estimate-a1c request",
+    ("mode",),
+    buckets=SIZE_BUCKETS,
+)
+PREDICT_CACHE_LOOKUPS = Counter(
+    "sugarcheck_predict_cache_lookups",
+    "/predict cache lookups by result",
+    ("result",),
+)
+MODEL_LOAD_SECONDS = Gauge(
+    "sugarcheck_model_load_seconds",
+    "Time taken to load each model in this worker",
+    ("model", "cached"),
+)
+SHED_REQUESTS = Counter(
+    "sugarcheck_shed_requests",
+    "Requests turned away by admission control, by endpoint and reason",
+    ("endpoint", "reason"),
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "sugarcheck_admission_wait_seconds",
+    "Time admitted requests waited for room",
+    ("endpoint",),
+)
+ADMISSION_REQUESTS = Gauge(
+    "sugarcheck_admission_requests",
+    "Requests running and waiting per endpoint, across all workers",
+    ("endpoint", "state"),
+)
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.labels(current_endpoint.get(), self.name).observe(
+            time.perf_counter() - self.start
+        )
+
+
+class _NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_stage = _NoStage()
+
+
+def stage(name):
+    # with stage("encode"): ... times the block under the current endpoint
+    return _Stage(name) if ENABLED else _no_stage
+
+
+def observe(histogram, value, *labels):
+    if ENABLED:
+        histogram.labels(*labels).observe(value)
+
+
+def log_request(**fields):
+    # Sampled so logging stays off the hot path under load
+    if LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE:
+        logger.info(json.dumps(fields, default=str))
+
+
+# TESTING
+class TestMetrics(unittest.TestCase):
+    def test_histogram_rendering(self):
+        histogram = Histogram(
+            "test_seconds", "Test histogram", ("endpoint",), buckets=(0.1, 1.0)
+        )
+        metrics.remove(histogram)
+        for value in (0.05, 0.5, 0.5, 3.0):
+            histogram.labels("predict").observe(value)
+        self.assertEqual(
+            histogram.render(),
+            [
+                "# HELP test_seconds Test histogram",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{endpoint="predict",le="0.1"} 1',
+                'test_seconds_bucket{endpoint="predict",le="1.0"} 3',
+                'test_seconds_bucket{endpoint="predict",le="+Inf"} 4',
+                'test_seconds_sum{endpoint="predict"} 4.05',
+                'test_seconds_count{endpoint="predict"} 4',
+            ],
+        )
+
+    def test_counter_and_label_escaping(self):
+        counter = Counter("test_requests", "Test counter", ("endpoint", "status"))
+        metrics.remove(counter)
+        counter.labels('a"b', 200).inc()
+        counter.labels('a"b', 200).inc(2)
+        self.assertEqual(
+            counter.render()[-1],
+            'test_requests_total{endpoint="a\\"b",status="200"} 3.0',
+        )
+
+    def test_stage_records_current_endpoint(self):
+        token = current_endpoint.set("test-endpoint")
+        try:
+            with stage("encode"):
+                pass
+        finally:
+            current_endpoint.reset(token)
+        if ENABLED:
+            child = STAGE_SECONDS.labels("test-endpoint", "encode")
+            self.assertEqual(sum(child.counts), 1)
+            self.assertIn('stage="encode"', render())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,447 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from predictionTable import file_hash
+
+# Versioned model bundles. A bundle is a directory <name>-<hash16> holding the files
+# that make up one model (the pickled estimator, and for the diabetes model the
+# encoders and scaler) and a manifest.json with their sha256s, the preprocessing
+# config and training metadata. The bundle hash covers the files and the config
+# only, so publishing the same model twice gives the same bundle. <name>.current
+# names the bundle being served and is replaced atomically on publish
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 1
+# Workers serve the bundle they loaded until their watcher polls, and load files
+# from it lazily meanwhile, so a bundle is only pruned once it was replaced this many
+# seconds ago, well over the services' MODEL_RELOAD_INTERVAL
+PRUNE_GRACE = 60.0
+
+
+def content_hash(name, file_hashes, config):
+    payload = {"name": name, "files": file_hashes, "config": config or {}}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    with os.fdopen(fd, "w") as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class Bundle:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as file:
+            self.manifest = json.load(file)
+        self.name = self.manifest["name"]
+        self.content_hash = self.manifest["content_hash"]
+        self.config = self.manifest.get("config", {})
+        self.metadata = self.manifest.get("metadata", {})
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def verify(self):
+        files = {name: file_hash(self.file(name)) for name in self.manifest["files"]}
+        if files != self.manifest["files"]:
+            raise ValueError(f"Bundle {self.path} does not match its manifest")
+        if content_hash(self.name, files, self.config) != self.content_hash:
+            raise ValueError(f"Bundle {self.path} has the wrong content hash")
+        return self
+
+    def __repr__(self):
+        return f"Bundle({self.name}, {self.content_hash[:16]})"
+
+
+def publish_bundle(
+    root, name, files, config=None, metadata=None, keep=3, grace=PRUNE_GRACE
+):
+    # files maps names inside the bundle to source paths. The bundle is assembled in
+    # a temporary directory and renamed into place before it becomes current, so a
+    # watcher never sees a partial bundle
+    file_hashes = {target: file_hash(source) for target, source in files.items()}
+    digest = content_hash(name, file_hashes, config)
+    bundle_dir = f"{name}-{digest[:16]}"
+    path = os.path.join(root, bundle_dir)
+    os.makedirs(root, exist_ok=True)
+
+    if not os.path.exists(os.path.join(path, MANIFEST_FILE)):
+        tmp_dir = tempfile.mkdtemp(dir=root, prefix=".tmp-")
+        for target, source in files.items():
+            shutil.copyfile(source, os.path.join(tmp_dir, target))
+        manifest = {
+            "format": FORMAT_VERSION,
+            "name": name,
+            "content_hash": digest,
+            "files": file_hashes,
+            "config": config or {},
+            "metadata": dict(
+                metadata or {},
+                published=datetime.datetime.now().isoformat(timespec="seconds"),
+            ),
+        }
+        _write_atomic(os.path.join(tmp_dir, MANIFEST_FILE), manifest)
+        try:
+            os.rename(tmp_dir, path)
+        except OSError:
+            # Published concurrently with the same content
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    previous = read_current(root, name)
+    if previous == bundle_dir:
+        previous = read_current(root, name, "previous")
+    elif previous is not None:
+        # A bundle's mtime is when it was last served, which pruning goes by
+        try:
+            os.utime(os.path.join(root, previous))
+        except FileNotFoundError:
+            previous = None
+    _write_atomic(
+        os.path.join(root, f"{name}.current"),
+        {"bundle": bundle_dir, "content_hash": digest, "previous": previous},
+    )
+    prune_bundles(root, name, keep, grace)
+    return Bundle(path)
+
+
+def prune_bundles(root, name, keep=3, grace=PRUNE_GRACE):
+    # Remove all but the newest `keep` bundles of a model. The current and previous
+    # bundles, and any replaced less than `grace` seconds ago, are always kept
+    served = {read_current(root, name), read_current(root, name, "previous")}
+    bundles = sorted(
+        (
+            entry
+            for entry in os.scandir(root)
+            if entry.is_dir() and entry.name.startswith(f"{name}-")
+        ),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    cutoff = time.time() - grace
+    for entry in bundles[keep:]:
+        if entry.name not in served and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def read_current(root, name, key="bundle"):
+    try:
+        with open(os.path.join(root, f"{name}.current")) as file:
+            return json.load(file)[key]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def current_bundle(root, name):
+    bundle_dir = read_current(root, name)
+    return None if bundle_dir is None else Bundle(os.path.join(root, bundle_dir))
+
+
+class BundleWatcher:
+    # Polls <name>.current for each model and calls on_change(name, bundle) from its
+    # own thread when a different bundle is published. A failing reload is reported
+    # and retried on the next publish; the old model keeps serving meanwhile
+    def __init__(self, root, names, on_change, interval=5.0, seen=None):
+        self.root = root
+        self.names = list(names)
+        self.on_change = on_change
+        self.interval = interval
+        # Bundle directory already served per model; defaults to the current ones
+        self.seen = seen or {name: read_current(root, name) for name in self.names}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name="bundle-watcher", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def poll(self):
+        changed = []
+        for name in self.names:
+            bundle_dir = read_current(self.root, name)
+            if bundle_dir is None or bundle_dir == self.seen[name]:
+                continue
+            self.seen[name] = bundle_dir
+            try:
+                bundle = Bundle(os.path.join(self.root, bundle_dir)).verify()
+                self.on_change(name, bundle)
+                changed.append(name)
+            except Exception as e:
+                print(f"Reloading {name} from {bundle_dir} failed: {e}")
+        return changed
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.poll()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish or list model bundles")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    publish = commands.add_parser("publish", help="Bundle model files and serve them")
+    publish.add_argument("--root", default="artifacts")
+    publish.add_argument("--name", required=True, help="e.g. diabetes or a1c")
+    publish.add_argument(
+        "--file",
+        action="append",
+        required=True,
+        metavar="TARGET=SOURCE",
+        help="e.g. model.pkl=final_predict_model.pkl",
+    )
+    publish.add_argument("--config", default="{}", help="Preprocessing config JSON")
+    publish.add_argument("--keep", type=int, default=3)
+    publish.add_argument(
+        "--grace",
+        type=float,
+        default=PRUNE_GRACE,
+        help="Seconds a replaced bundle is kept for workers still serving it",
+    )
+
+    listing = commands.add_parser("list", help="Show bundles and the current one")
+    listing.add_argument("--root", default="artifacts")
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        files = dict(spec.split("=", 1) for spec in args.file)
+        start = time.perf_counter()
+        bundle = publish_bundle(
+            args.root,
+            args.name,
+            files,
+            json.loads(args.config),
+            keep=args.keep,
+            grace=args.grace,
+        )
+        print(f"Published {bundle} in {time.perf_counter() - start:.2f}s")
+        return
+
+    for entry in sorted(os.scandir(args.root), key=lambda entry: entry.name):
+        if entry.is_dir() and not entry.name.startswith("."):
+            bundle = Bundle(entry.path)
+            marker = "*" if read_current(args.root, bundle.name) == entry.name else " "
+            print(f"{marker} {entry.name}  {bundle.metadata.get('published')}")
+
+
+# TESTING
+class TestModelArtifacts(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        shutil.rmtree(self.source, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.source, name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def test_publish_is_content_addressed(self):
+        model = self.write("model.pkl", "v1")
+        first = publish_bundle(self.root, "a1c", {"model.pkl": model}, {"window": 21})
+        again = publish_bundle(self.root, "a1c", {"model.pkl": model}, {"window": 21})
+        self.assertEqual(first.path, again.path)
+        other = publish_bundle(self.root, "a1c", {"model.pkl": model}, {"window": 14})
+        self.assertNotEqual(other.content_hash, first.content_hash)
+        self.assertEqual(current_bundle(self.root, "a1c").path, other.path)
+        self.assertEqual(other.verify().config, {"window": 14})
+
+        with open(other.file("model.pkl"), "w") as file:
+            file.write("tampered")
+        with self.assertRaises(ValueError):
+            other.verify()
+
+    def bundle_dirs(self):
+        return {
+            entry
+            for entry in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, entry))
+        }
+
+    def test_prune_keeps_current_and_previous(self):
+        for i in range(5):
+            model = self.write("model.pkl", f"v{i}")
+            publish_bundle(self.root, "diabetes", {"model.pkl": model}, keep=1, grace=0)
+        self.assertEqual(
+            self.bundle_dirs(),
+            {
+                read_current(self.root, "diabetes"),
+                read_current(self.root, "diabetes", "previous"),
+            },
+        )
+
+        # Bundles replaced within the grace period stay for workers serving them
+        for i in range(5, 8):
+            model = self.write("model.pkl", f"v{i}")
+            publish_bundle(self.root, "diabetes", {"model.pkl": model}, keep=1)
+        self.assertEqual(len(self.bundle_dirs()), 5)
+        prune_bundles(self.root, "diabetes", keep=1, grace=0)
+        self.assertEqual(len(self.bundle_dirs()), 2)
+
+    def test_watcher_reports_new_bundles(self):
+        publish_bundle(self.root, "a1c", {"model.pkl": self.write("model.pkl", "v1")})
+        changes = []
+        watcher = BundleWatcher(
+            self.root, ["a1c", "diabetes"], lambda name, bundle: changes.append(bundle)
+        )
+        self.assertEqual(watcher.poll(), [])
+        bundle = publish_bundle(
+            self.root, "a1c", {"model.pkl": self.write("model.pkl", "v2")}
+        )
+        self.assertEqual(watcher.poll(), ["a1c"])
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual([change.path for change in changes], [bundle.path])
+
+    def test_service_reloads_published_bundle(self):
+        import numpy as np
+
+        import inferenceService as service
+
+        old = service.models.get("diabetes")
+        X = service.questionnaire_encoder(old).encode(service.WARMUP_QUESTIONNAIRE)
+        expected = service.predict_questionnaires(X, old)
+        bundle = publish_bundle(
+            self.root,
+            "diabetes",
+            {
+                "model.pkl": "final_predict_model.pkl",
+                "encoders.pkl": "encoders.pkl",
+                "minmax.pkl": "minmax.pkl",
+            },
+        )
+        watcher = BundleWatcher(
+            self.root, ["diabetes"], service.reload_model, seen={"diabetes": None}
+        )
+        try:
+            self.assertEqual(watcher.poll(), ["diabetes"])
+            new = service.models.get("diabetes")
+            self.assertIsNot(new, old)
+            self.assertEqual(new.source, bundle.file("model.pkl"))
+            self.assertIsNotNone(new.questionnaire_encoder)
+            np.testing.assert_array_equal(
+                service.predict_questionnaires(X, new), expected
+            )
+            # A request still holding the old forest finishes with it
+            np.testing.assert_array_equal(
+                service.predict_questionnaires(X, old), expected
+            )
+        finally:
+            service.models.install("diabetes", old)
+
+    def test_worker_keeps_serving_replaced_bundle(self):
+        import numpy as np
+
+        import inferenceService as service
+
+        files = {
+            "model.pkl": "final_predict_model.pkl",
+            "encoders.pkl": "encoders.pkl",
+            "minmax.pkl": "minmax.pkl",
+        }
+        old = service.models.get("diabetes")
+        publish_bundle(self.root, "diabetes", files, {"version": 1}, keep=1)
+        watcher = BundleWatcher(
+            self.root, ["diabetes"], service.reload_model, seen={"diabetes": None}
+        )
+        try:
+            watcher.poll()
+            served = service.models.get("diabetes")
+            # Other publishes land before this worker's watcher polls again
+            for version in (2, 3):
+                publish_bundle(
+                    self.root, "diabetes", files, {"version": version}, keep=1
+                )
+            # Files the worker loads lazily are still in its bundle
+            self.assertTrue(os.path.exists(served.source))
+            encoders, minmax = service.fitted_encoders(served)
+            X = service.questionnaire_encoder(served).encode(
+                service.WARMUP_QUESTIONNAIRE
+            )
+            np.testing.assert_array_equal(
+                service.predict_questionnaires(X, served),
+                service.predict_questionnaires(X, old),
+            )
+            self.assertEqual(watcher.poll(), ["diabetes"])
+        finally:
+            service.models.install("diabetes", old)
+
+    def test_service_reloads_trained_a1c_bundle(self):
+        import pickle
+        import subprocess
+        import sys
+
+        import numpy as np
+
+        import inferenceService as service
+
+        # Train and publish with the real training script, on a small cohort
+        ml_models = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "../ML-Models"
+        )
+        sys.path.insert(0, os.path.join(ml_models, "A1c-Estimation"))
+        from SyntheticDataset import generate_dataset
+
+        data = os.path.join(self.source, "glucose.csv")
+        generate_dataset(data, num_patients=10, days=40)
+        output = os.path.join(self.source, "A1cModel.pkl")
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.join(ml_models, "A1c-Estimation/A1cEstimationv2.py"),
+                "--data",
+                data,
+                "--output",
+                output,
+            ],
+            env=dict(
+                os.environ,
+                MODEL_ARTIFACTS=self.root,
+                TRAIN_CACHE_DIR=os.path.join(self.source, "cache"),
+                PYTHONWARNINGS="ignore",
+            ),
+            check=True,
+            capture_output=True,
+        )
+        bundle = current_bundle(self.root, "a1c")
+        self.assertEqual(bundle.config, {"window": 21})
+
+        old = service.models.get("a1c")
+        watcher = BundleWatcher(
+            self.root, ["a1c"], service.reload_model, seen={"a1c": None}
+        )
+        try:
+            self.assertEqual(watcher.poll(), ["a1c"])
+            new = service.models.get("a1c")
+            self.assertEqual(new.source, bundle.file("model.pkl"))
+            with open(output, "rb") as file:
+                model = pickle.load(file)["model"]
+            features = service.a1c_features(service.WARMUP_READINGS, new)
+            self.assertEqual(
+                service.predict_a1c(features, new),
+                float(np.mean(model.predict(features))),
+            )
+        finally:
+            service.models.install("a1c", old)
+
+
+if __name__ == "__main__":
+    main()
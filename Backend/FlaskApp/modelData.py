@@ -0,0 +1,40 @@
+import os
+import sys
+
+# The train/test splits of the two training scripts, rebuilt for tools that need
+# the data a served model was fitted and evaluated on
+dir_path = os.path.dirname(os.path.realpath(__file__))
+ml_models_path = os.path.join(dir_path, "../ML-Models")
+dataset_path = os.path.join(dir_path, "../../Dataset")
+
+
+def diabetes_split():
+    # Same preparation as DiabetesPrediction.py
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import LabelEncoder, MinMaxScaler
+
+    sys.path.insert(0, ml_models_path)
+    from columnarDataset import read_dataset
+
+    df = read_dataset(os.path.join(dataset_path, "balanced_diabetes_data.csv"))
+    df.columns = map(str.lower, df.columns)
+    y = (df.pop("class") == "Positive").astype(int)
+    for col in df.select_dtypes(include="object").columns:
+        df[col] = LabelEncoder().fit_transform(df[col])
+    df[["age"]] = MinMaxScaler().fit_transform(df[["age"]])
+    return train_test_split(df, y, test_size=0.2, random_state=40)
+
+
+def a1c_split():
+    # Same preparation as A1cEstimationv2.py, using the serving preprocessor
+    from sklearn.model_selection import train_test_split
+
+    from glucosePreprocessor import GlucoseDataPreprocessor
+
+    sys.path.insert(0, ml_models_path)
+    from columnarDataset import read_dataset
+
+    data = read_dataset(os.path.join(dataset_path, "synthetic_diabetes_data_v6.csv"))
+    features = GlucoseDataPreprocessor().transform(data)
+    X = features[["rolling_mean", "rolling_median", "rolling_std"]]
+    return train_test_split(X, features["HbA1c"], test_size=0.2, random_state=42)
@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from featureEncoder import QuestionnaireEncoder, fitted_from_spec
+from forestCompiler import CompiledForest
+from modelRegistry import _unpickle, read_forest_cache, write_forest_cache
+from predictionTable import file_hash
+
+# Pickle-free export of the served models. A model directory holds the forest's
+# node arrays as .npy files and a meta.json, the same layout as the registry's
+# model cache, plus encoder.json for the diabetes model: the LabelEncoder classes
+# as JSON lists and the MinMaxScaler as a scale and an offset. Loading one needs
+# neither pickle nor sklearn, does not depend on the sklearn version the model was
+# trained with, and cannot run code from the files it reads
+ENCODER_FILE = "encoder.json"
+
+
+def is_exported(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "meta.json"))
+
+
+def export_model(model_path, out_dir, key=None, encoders_path=None, minmax_path=None):
+    # The only step that unpickles; run it where the pickles are trusted
+    model = _unpickle(model_path, key)
+    tmp_dir = os.path.join(
+        tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_dir)), prefix=".tmp-"),
+        "model",
+    )
+    write_forest_cache(model, tmp_dir, file_hash(model_path))
+    if encoders_path is not None:
+        encoder = QuestionnaireEncoder(
+            _unpickle(encoders_path), _unpickle(minmax_path), model.feature_names_in_
+        )
+        with open(os.path.join(tmp_dir, ENCODER_FILE), "w") as file:
+            json.dump(encoder.to_spec(), file, indent=2)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(os.path.dirname(tmp_dir), ignore_errors=True)
+    return out_dir
+
+
+def load_exported(path, mmap_mode="r", **forest_kwargs):
+    # Forests loaded this way have no sklearn fallback, so large batches are
+    # traversed by the compiled forest too
+    arrays, meta = read_forest_cache(path, mmap_mode)
+    forest = CompiledForest(arrays, meta, **forest_kwargs)
+    forest.source = path
+    forest.version = meta["source_sha256"]
+    return forest
+
+
+def read_encoder_spec(path):
+    with open(os.path.join(path, ENCODER_FILE)) as file:
+        return json.load(file)
+
+
+def load_exported_encoder(path):
+    return QuestionnaireEncoder.from_spec(read_encoder_spec(path))
+
+
+def load_exported_fitted(path):
+    return fitted_from_spec(read_encoder_spec(path))
+
+
+def directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+# Served models: name -> (pickle, key inside it, encoders, scaler)
+MODELS = {
+    "diabetes": ("final_predict_model.pkl", None, "encoders.pkl", "minmax.pkl"),
+    "a1c": ("A1cModel.pkl", "model", None, None),
+}
+
+
+def _time_load(format, path, key):
+    # Run in a fresh process, so the import of sklearn by pickle.load is counted
+    start = time.perf_counter()
+    if format == "pickle":
+        _unpickle(path, key or None)
+    else:
+        forest = load_exported(path)
+        # Touch every page, as the pickle load reads the whole file
+        for name in ["feature", "threshold", "left", "right", "value"]:
+            np.asarray(getattr(forest, name)).sum()
+    print(f"{(time.perf_counter() - start) * 1e3:.3f}")
+
+
+def fresh_load_ms(format, path, key=None, repeat=3):
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, __file__, "time-load", format, path, key or ""],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        times.append(float(output.split()[-1]))
+    return float(np.median(times))
+
+
+def report(out_root, repeat=3):
+    rows = []
+    for name, (model_path, key, encoders_path, minmax_path) in MODELS.items():
+        out_dir = os.path.join(out_root, name)
+        start = time.perf_counter()
+        export_model(model_path, out_dir, key, encoders_path, minmax_path)
+        export_s = time.perf_counter() - start
+
+        pickle_bytes = sum(
+            os.path.getsize(path)
+            for path in [model_path, encoders_path, minmax_path]
+            if path is not None
+        )
+        # Already imported sklearn in this process, so only the unpickling itself
+        warm = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            _unpickle(model_path, key)
+            warm.append((time.perf_counter() - start) * 1e3)
+        rows.append(
+            {
+                "model": name,
+                "pickle_mb": pickle_bytes / 1e6,
+                "export_mb": directory_size(out_dir) / 1e6,
+                "pickle_load_ms": fresh_load_ms("pickle", model_path, key, repeat),
+                "pickle_warm_ms": float(np.median(warm)),
+                "export_load_ms": fresh_load_ms("export", out_dir, None, repeat),
+                "export_s": export_s,
+            }
+        )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the served models without pickle and compare load costs"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Export the served models")
+    export.add_argument("--out", default="exported_models")
+    compare = commands.add_parser("report", help="Export and compare with pickles")
+    compare.add_argument("--out", default="exported_models")
+    compare.add_argument("--repeat", type=int, default=3)
+    time_load = commands.add_parser("time-load")
+    time_load.add_argument("format", choices=["pickle", "export"])
+    time_load.add_argument("path")
+    time_load.add_argument("key")
+    args = parser.parse_args()
+
+    if args.command == "time-load":
+        return _time_load(args.format, args.path, args.key)
+
+    if args.command == "export":
+        os.makedirs(args.out, exist_ok=True)
+        for name, (model_path, key, encoders_path, minmax_path) in MODELS.items():
+            out_dir = os.path.join(args.out, name)
+            export_model(model_path, out_dir, key, encoders_path, minmax_path)
+            print(f"Exported {name} to {out_dir}")
+        return
+
+    os.makedirs(args.out, exist_ok=True)
+    print(
+        f"{'model':<10}{'pickle MB':>11}{'export MB':>11}"
+        f"{'pickle load ms':>16}{'(sklearn loaded)':>18}{'export load ms':>16}"
+    )
+    for row in report(args.out, args.repeat):
+        print(
+            f"{row['model']:<10}{row['pickle_mb']:>11.2f}{row['export_mb']:>11.2f}"
+            f"{row['pickle_load_ms']:>16.1f}{row['pickle_warm_ms']:>18.1f}"
+            f"{row['export_load_ms']:>16.1f}"
+        )
+
+
+# TESTING
+class TestModelExport(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.out = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.dir_path, name)
+
+    def test_round_trip_without_pickle(self):
+        out_dir = export_model(
+            self.path("final_predict_model.pkl"),
+            os.path.join(self.out, "diabetes"),
+            encoders_path=self.path("encoders.pkl"),
+            minmax_path=self.path("minmax.pkl"),
+        )
+        self.assertTrue(is_exported(out_dir))
+        model = _unpickle(self.path("final_predict_model.pkl"))
+        forest = load_exported(out_dir)
+        self.assertEqual(
+            forest.version, file_hash(self.path("final_predict_model.pkl"))
+        )
+        self.assertIsNone(forest.fallback)
+
+        encoder = load_exported_encoder(out_dir)
+        record = {"age": 45, "gender": "Male", "polyuria": "Yes", "obesity": "No"}
+        record.update(
+            (col, "No") for col in encoder.feature_columns if col not in record
+        )
+        rng = np.random.default_rng(0)
+        X = np.vstack([encoder.encode(record), rng.integers(0, 2, (500, 16))])
+        np.testing.assert_array_equal(forest.predict(X), model.predict(X))
+
+        # Exporting again replaces the directory
+        export_model(self.path("A1cModel.pkl"), out_dir, key="model")
+        self.assertFalse(os.path.exists(os.path.join(out_dir, ENCODER_FILE)))
+        self.assertEqual(load_exported(out_dir).kind, "regressor")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from featureEncoder import QuestionnaireEncoder
+from forestCompiler import CompiledForest, export_forest
+from predictionTable import file_hash
+
+ARRAY_NAMES = ["feature", "threshold", "left", "right", "value", "roots"]
+
+
+def current_rss_mb():
+    # Resident set size right now; falls back to the peak where /proc is missing
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _unpickle(path, key=None):
+    with open(path, "rb") as file:
+        data = pickle.load(file)
+    return data[key] if key is not None else data
+
+
+def write_forest_cache(model, out_dir, source_sha256):
+    # Export the forest's node arrays to .npy files
+    arrays, meta = export_forest(model)
+    write_forest_arrays(arrays, dict(meta, source_sha256=source_sha256), out_dir)
+    return arrays, meta
+
+
+def write_forest_arrays(arrays, meta, out_dir):
+    # The files are written to a temporary directory and renamed into place, so
+    # workers racing to build the same cache never see a partial one
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), arrays[name])
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as file:
+        json.dump(meta, file, indent=2)
+    try:
+        os.rename(tmp_dir, out_dir)
+    except OSError:
+        # Another worker got there first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_forest_cache(path, mmap_mode="r"):
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+    # np.asarray drops the memmap subclass but keeps the mapping, so indexing the
+    # arrays costs the same as for in-memory ones
+    arrays = {
+        name: np.asarray(
+            np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+        )
+        for name in ARRAY_NAMES
+    }
+    return arrays, meta
+
+
+def load_questionnaire_encoder(cache_dir, encoders_path, minmax_path, feature_columns):
+    # The compiled encoder is cached as JSON next to the forests, so /predict can
+    # start without unpickling the LabelEncoders and MinMaxScaler, which would pull
+    # in sklearn
+    digest = hashlib.sha256()
+    for path in [encoders_path, minmax_path]:
+        digest.update(file_hash(path).encode())
+    digest.update(json.dumps(list(feature_columns)).encode())
+    cache_path = os.path.join(cache_dir, f"encoder-{digest.hexdigest()[:16]}.json")
+
+    if os.path.exists(cache_path):
+        with open(cache_path) as file:
+            return QuestionnaireEncoder.from_spec(json.load(file))
+
+    encoders = _unpickle(encoders_path)
+    minmax = _unpickle(minmax_path)
+    encoder = QuestionnaireEncoder(encoders, minmax, feature_columns)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+        with os.fdopen(fd, "w") as file:
+            json.dump(encoder.to_spec(), file, indent=2)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not write encoder cache {cache_path}: {e}")
+    return encoder
+
+
+class ModelRegistry:
+    # Serving forests by name, loaded on first use. Each forest is exported once to
+    # .npy files under cache_dir, keyed by the hash of its pickle, and memory-mapped
+    # read-only: worker processes share the same page cache pages instead of each
+    # holding an unpickled copy, and under gunicorn --preload models loaded in the
+    # master are inherited copy-on-write. The sklearn estimator itself is only
+    # unpickled when a large batch needs the fallback
+    def __init__(self, cache_dir="model_cache", mmap_mode="r", verbose=True):
+        self.cache_dir = cache_dir
+        self.mmap_mode = mmap_mode
+        self.verbose = verbose
+        self.sources = {}
+        self.forests = {}
+        self.estimators = {}
+        self.stats = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, path, key=None, **forest_kwargs):
+        # key selects the estimator inside a pickled dict, like "model" in A1cModel.pkl
+        self.sources[name] = (path, key, forest_kwargs)
+
+    def sklearn(self, name):
+        path, key, _ = self.sources[name]
+        return self._estimator(path, key)
+
+    def _estimator(self, path, key):
+        # Keyed by source, so a forest replaced by a reload keeps its own fallback
+        with self.lock:
+            if (path, key) not in self.estimators:
+                self.estimators[path, key] = _unpickle(path, key)
+            return self.estimators[path, key]
+
+    def get(self, name):
+        forest = self.forests.get(name)
+        if forest is None:
+            with self.lock:
+                if name not in self.forests:
+                    path, key, _ = self.sources[name]
+                    self.forests[name] = self.load(name, path, key)
+                forest = self.forests[name]
+        return forest
+
+    def load(self, name, path, key=None):
+        # Build the forest for a model file without serving it yet
+        forest_kwargs = self.sources[name][2]
+        rss_before = current_rss_mb()
+        start = time.perf_counter()
+
+        fallback_loader = lambda: self._estimator(path, key)
+        if os.path.isdir(path):
+            # A pickle-free export (see modelExport.py) is mapped as it is, and has
+            # no sklearn estimator to fall back on
+            arrays, meta = read_forest_cache(path, self.mmap_mode)
+            source_sha256 = meta["source_sha256"]
+            cached = True
+            fallback_loader = None
+        else:
+            source_sha256 = file_hash(path)
+            cache_path = os.path.join(self.cache_dir, f"{name}-{source_sha256[:16]}")
+            cached = os.path.exists(os.path.join(cache_path, "meta.json"))
+            if cached:
+                arrays, meta = read_forest_cache(cache_path, self.mmap_mode)
+            else:
+                model = self._estimator(path, key)
+                try:
+                    write_forest_cache(model, cache_path, source_sha256)
+                    arrays, meta = read_forest_cache(cache_path, self.mmap_mode)
+                except OSError as e:
+                    # Read-only filesystem: serve from an in-memory export instead
+                    print(f"Could not write model cache {cache_path}: {e}")
+                    arrays, meta = export_forest(model)
+
+        forest = CompiledForest(
+            arrays,
+            meta,
+            fallback_loader=fallback_loader,
+            **forest_kwargs,
+        )
+        forest.source = path
+        forest.version = source_sha256
+        self.stats[name] = {
+            "name": name,
+            "source": path,
+            "cached": cached,
+            "load_ms": (time.perf_counter() - start) * 1e3,
+            "mapped_mb": sum(array.nbytes for array in arrays.values()) / 1e6,
+            "rss_delta_mb": current_rss_mb() - rss_before,
+        }
+        if self.verbose:
+            print(self.format_stats(self.stats[name]))
+        return forest
+
+    def install(self, name, forest, key=None):
+        # Swap in a forest built by load(). Requests that already hold the old forest
+        # finish with it; its sklearn fallback stays cached until then
+        with self.lock:
+            old = self.forests.get(name)
+            self.sources[name] = (forest.source, key, self.sources[name][2])
+            self.forests[name] = forest
+            if old is not None and old.source != forest.source:
+                self.estimators.pop((old.source, key), None)
+
+    def version(self, name):
+        # sha256 of the pickle the loaded forest was built from
+        return self.get(name).version
+
+    @staticmethod
+    def format_stats(stats):
+        return (
+            f"Model {stats['name']} loaded from {stats['source']} in "
+            f"{stats['load_ms']:.1f} ms ({'cached' if stats['cached'] else 'exported'}"
+            f"), {stats['mapped_mb']:.1f} MB mapped, "
+            f"RSS {stats['rss_delta_mb']:+.1f} MB"
+        )
+
+    def preload(self):
+        # Load every registered model now, e.g. in the gunicorn master with --preload
+        for name in self.sources:
+            self.get(name)
+        return self.report()
+
+    def report(self):
+        return [self.stats[name] for name in self.sources if name in self.stats]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the memory-mapped model cache and report load costs"
+    )
+    parser.add_argument("--cache-dir", default="model_cache")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.cache_dir)
+    registry.register("diabetes", "final_predict_model.pkl")
+    registry.register("a1c", "A1cModel.pkl", key="model")
+    registry.preload()
+    print(f"Process RSS {current_rss_mb():.1f} MB")
+
+
+# TESTING
+class TestModelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def make_registry(self):
+        registry = ModelRegistry(self.cache_dir, verbose=False)
+        registry.register(
+            "a1c", os.path.join(self.dir_path, "A1cModel.pkl"), key="model"
+        )
+        return registry
+
+    def test_cached_forest_matches_sklearn(self):
+        rng = np.random.default_rng(0)
+        X = rng.uniform(0, 300, size=(1000, 3))
+
+        built = self.make_registry()
+        forest = built.get("a1c")
+        self.assertFalse(built.report()[0]["cached"])
+        expected = built.sklearn("a1c").predict(X)
+        np.testing.assert_array_equal(forest.predict(X[:100]), expected[:100])
+
+        # A second registry maps the cache without unpickling the model
+        registry = self.make_registry()
+        forest = registry.get("a1c")
+        self.assertTrue(registry.report()[0]["cached"])
+        self.assertEqual(registry.estimators, {})
+        np.testing.assert_array_equal(forest.predict(X[:100]), expected[:100])
+
+        # Large batches load the sklearn fallback on demand
+        np.testing.assert_array_equal(forest.predict(X), expected)
+        self.assertEqual(len(registry.estimators), 1)
+
+    def test_install_swaps_forest(self):
+        registry = self.make_registry()
+        old = registry.get("a1c")
+        copy = os.path.join(self.cache_dir, "A1cModel-copy.pkl")
+        with open(registry.sources["a1c"][0], "rb") as source:
+            data = pickle.load(source)
+        data["model"].set_params(n_jobs=2)
+        with open(copy, "wb") as file:
+            pickle.dump(data, file)
+
+        new = registry.load("a1c", copy, key="model")
+        # Built off to the side until installed
+        self.assertIs(registry.get("a1c"), old)
+        registry.install("a1c", new, key="model")
+        self.assertIs(registry.get("a1c"), new)
+        self.assertNotEqual(registry.version("a1c"), old.version)
+        self.assertEqual(registry.sklearn("a1c").n_jobs, 2)
+        self.assertEqual(old.fallback.n_jobs, None)
+
+
+if __name__ == "__main__":
+    main()
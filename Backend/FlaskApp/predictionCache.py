@@ -0,0 +1,345 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+# /predict results cached by questionnaire. The key is the encoded feature row, so
+# answers that only differ in key case, value case or the type of age ("45", 45,
+# 45.0) share an entry. Entries belong to the model version they were computed with
+# and are dropped as soon as the loaded model's hash changes
+
+
+class LRUStore:
+    # In-process store, private to each worker
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key, version):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, version, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, version):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteStore:
+    # Store in a local SQLite file shared by every worker on the machine. Rows are
+    # stamped with their last use; every max_size / 10 inserts a worker trims the
+    # table back to max_size, least recently used first. Lookups are plain reads:
+    # each worker collects the keys it hit and writes their new use time in one
+    # transaction every TOUCH_BATCH rows or TOUCH_INTERVAL seconds, so hits don't
+    # queue on the database's write lock
+    TOUCH_BATCH = 64
+    TOUCH_INTERVAL = 1.0
+    # Writers wait this long for the lock before the cache gives up on the write
+    BUSY_TIMEOUT = 0.1
+
+    def __init__(self, path, max_size=65536):
+        self.path = path
+        self.max_size = max_size
+        self.evictions = 0
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "key BLOB, version TEXT, value, used REAL, "
+                "PRIMARY KEY (key, version))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)"
+            )
+
+    def connection(self):
+        # One connection per thread, reopened in forked workers
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=self.BUSY_TIMEOUT, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+            self.local.inserts = 0
+            self.local.touched = {}
+            self.local.touched_since = time.monotonic()
+        return self.local.connection
+
+    def get(self, key, version):
+        connection = self.connection()
+        row = connection.execute(
+            "SELECT value FROM predictions WHERE key = ? AND version = ?",
+            (key, version),
+        ).fetchone()
+        if row is None:
+            return None
+        touched = self.local.touched
+        touched[key, version] = time.time()
+        if (
+            len(touched) >= self.TOUCH_BATCH
+            or time.monotonic() - self.local.touched_since >= self.TOUCH_INTERVAL
+        ):
+            self.flush_touches(connection)
+        return row[0]
+
+    def flush_touches(self, connection):
+        touched = self.local.touched
+        self.local.touched = {}
+        self.local.touched_since = time.monotonic()
+        if not touched:
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "UPDATE predictions SET used = ? WHERE key = ? AND version = ?",
+                [(used, key, version) for (key, version), used in touched.items()],
+            )
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+
+    def put(self, key, version, value):
+        connection = self.connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+            (key, version, value, time.time()),
+        )
+        # Counting rows on every insert would cost more than the lookup saves
+        self.local.inserts += 1
+        if self.local.inserts % max(1, self.max_size // 10) == 0:
+            self.evict(connection)
+
+    def evict(self, connection):
+        self.flush_touches(connection)
+        excess = len(self) - self.max_size
+        if excess > 0:
+            connection.execute(
+                "DELETE FROM predictions WHERE rowid IN "
+                "(SELECT rowid FROM predictions ORDER BY used LIMIT ?)",
+                (excess,),
+            )
+            self.evictions += excess
+
+    def discard(self, version):
+        # Only the old version's rows: other workers may already serve the new model
+        self.connection().execute(
+            "DELETE FROM predictions WHERE version = ?", (version,)
+        )
+
+    def __len__(self):
+        return (
+            self.connection().execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        )
+
+
+class PredictionCache:
+    # version is called on every lookup and returns the hash of the model currently
+    # serving predictions. Callers that already hold a model pass its version
+    # instead, so a result is never stored under a model that was reloaded meanwhile.
+    # The cache is best effort: a store error (a locked or broken SQLite file) is
+    # logged and counted, and the lookup counts as a miss so the model answers
+    ERROR_LOG_INTERVAL = 60.0
+
+    def __init__(self, store, version):
+        self.store = store
+        self.version = version
+        self.current = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.errors = 0
+        self.last_error_log = None
+        self.lock = threading.Lock()
+
+    def _store_error(self, operation, error):
+        # Called with the lock held; logs at most once per ERROR_LOG_INTERVAL
+        self.errors += 1
+        now = time.monotonic()
+        if (
+            self.last_error_log is None
+            or now - self.last_error_log >= self.ERROR_LOG_INTERVAL
+        ):
+            self.last_error_log = now
+            print(
+                f"Prediction cache {operation} failed ({self.errors} errors so far), "
+                f"serving from the model: {error}"
+            )
+
+    def _sync_version(self, version=None):
+        version = version or self.version()
+        if version != self.current:
+            if self.current is not None:
+                self.store.discard(self.current)
+                self.invalidations += 1
+            self.current = version
+        return version
+
+    def get(self, features, version=None):
+        with self.lock:
+            try:
+                version = self._sync_version(version)
+                value = self.store.get(features.tobytes(), version)
+            except sqlite3.Error as e:
+                self._store_error("lookup", e)
+                value = None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, features, value, version=None):
+        with self.lock:
+            try:
+                self.store.put(features.tobytes(), self._sync_version(version), value)
+            except sqlite3.Error as e:
+                self._store_error("insert", e)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            try:
+                size = len(self.store)
+            except sqlite3.Error as e:
+                self._store_error("count", e)
+                size = None
+            return {
+                "backend": type(self.store).__name__,
+                "pid": os.getpid(),
+                "model_version": self.current,
+                "size": size,
+                "max_size": self.store.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.store.evictions,
+                "invalidations": self.invalidations,
+                "errors": self.errors,
+            }
+
+
+def make_cache(version, max_size, path=None):
+    # SQLite when a path is given, so gunicorn workers share hits
+    store = SQLiteStore(path, max_size) if path else LRUStore(max_size)
+    return PredictionCache(store, version)
+
+
+# TESTING
+class TestPredictionCache(unittest.TestCase):
+    def setUp(self):
+        self.rows = [np.full((1, 16), float(i)) for i in range(5)]
+        self.version = "a"
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def caches(self):
+        path = os.path.join(self.dir, "cache.sqlite")
+        return [
+            make_cache(lambda: self.version, 3),
+            make_cache(lambda: self.version, 3, path),
+        ]
+
+    def test_hits_and_lru_eviction(self):
+        for cache in self.caches():
+            for i, row in enumerate(self.rows[:3]):
+                self.assertIsNone(cache.get(row))
+                cache.put(row, i)
+            self.assertEqual(cache.get(self.rows[0]), 0)
+            if isinstance(cache.store, SQLiteStore):
+                time.sleep(0.01)
+            cache.put(self.rows[3], 3)
+            if isinstance(cache.store, SQLiteStore):
+                cache.store.evict(cache.store.connection())
+            # rows[1] was the least recently used
+            self.assertIsNone(cache.get(self.rows[1]))
+            self.assertEqual(cache.get(self.rows[0]), 0)
+            self.assertEqual(cache.get(self.rows[3]), 3)
+            stats = cache.stats()
+            self.assertEqual((stats["hits"], stats["misses"]), (3, 4))
+            self.assertEqual(stats["size"], 3)
+
+    def test_invalidated_when_model_changes(self):
+        for cache in self.caches():
+            self.version = "a"
+            cache.put(self.rows[0], 1)
+            self.assertEqual(cache.get(self.rows[0]), 1)
+            self.version = "b"
+            self.assertIsNone(cache.get(self.rows[0]))
+            self.assertEqual(cache.stats()["invalidations"], 1)
+            self.assertEqual(cache.stats()["size"], 0)
+
+    def test_sqlite_hits_update_recency_in_batches(self):
+        path = os.path.join(self.dir, "touch.sqlite")
+        cache = make_cache(lambda: self.version, 10, path)
+        store = cache.store
+        store.TOUCH_BATCH = 3
+        for i, row in enumerate(self.rows[:3]):
+            cache.put(row, i)
+
+        def used():
+            query = "SELECT used FROM predictions ORDER BY value"
+            return [row[0] for row in store.connection().execute(query)]
+
+        before = used()
+        time.sleep(0.01)
+        self.assertEqual(cache.get(self.rows[0]), 0)
+        self.assertEqual(cache.get(self.rows[1]), 1)
+        self.assertEqual(used(), before)
+        # The third distinct hit writes all three use times at once
+        self.assertEqual(cache.get(self.rows[2]), 2)
+        self.assertTrue(all(now > then for now, then in zip(used(), before)))
+
+    def test_store_errors_fall_through(self):
+        path = os.path.join(self.dir, "broken.sqlite")
+        cache = make_cache(lambda: self.version, 10, path)
+        cache.put(self.rows[0], 1)
+        other = sqlite3.connect(path)
+        other.execute("DROP TABLE predictions")
+        other.close()
+
+        import contextlib
+        import io
+
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            self.assertIsNone(cache.get(self.rows[0]))
+            cache.put(self.rows[0], 1)
+            stats = cache.stats()
+        self.assertEqual(
+            (stats["misses"], stats["errors"], stats["size"]), (1, 3, None)
+        )
+        # Logged once, not once per failure
+        self.assertEqual(log.getvalue().count("Prediction cache"), 1)
+
+    def test_sqlite_shared_between_workers(self):
+        path = os.path.join(self.dir, "shared.sqlite")
+        first = make_cache(lambda: self.version, 10, path)
+        second = make_cache(lambda: self.version, 10, path)
+        first.put(self.rows[2], 1)
+        self.assertEqual(second.get(self.rows[2]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,381 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from featureEncoder import QuestionnaireEncoder
+
+# Integer ages covered by the table; anything else falls back to the model
+AGE_MIN = 0
+AGE_MAX = 120
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _categorical_columns(encoder):
+    # Every categorical column must be binary for the bit index to cover it
+    for _, col, lookup in encoder.lookups:
+        if len(lookup) != 2:
+            raise ValueError(f"Column '{col}' is not binary, cannot build a table")
+    return [index for index, _, _ in encoder.lookups]
+
+
+def _age_block(encoder, categorical, age):
+    # All 2^k answer combinations for one age, encoded exactly as /predict does
+    n_bits = len(categorical)
+    combos = np.arange(1 << n_bits, dtype=np.int64)
+    X = np.empty((1 << n_bits, encoder.n_features))
+    for bit, index in enumerate(categorical):
+        X[:, index] = (combos >> bit) & 1
+    X[:, encoder.age_index] = float(age) * encoder.age_scale + encoder.age_offset
+    return X
+
+
+def build_table(
+    model,
+    encoders,
+    minmax,
+    out_dir,
+    age_min=AGE_MIN,
+    age_max=AGE_MAX,
+    model_sha256=None,
+):
+    encoder = QuestionnaireEncoder(encoders, minmax, model.feature_names_in_)
+    categorical = _categorical_columns(encoder)
+    block = 1 << len(categorical)
+    n_cells = (age_max - age_min + 1) * block
+
+    predictions = np.empty(n_cells, dtype=np.uint8)
+    probabilities = np.empty(n_cells, dtype=np.uint8)
+    for age in range(age_min, age_max + 1):
+        start = (age - age_min) * block
+        proba = model.predict_proba(_age_block(encoder, categorical, age))
+        # Same rule as RandomForestClassifier.predict: argmax of the mean probability
+        predictions[start : start + block] = np.argmax(proba, axis=1)
+        probabilities[start : start + block] = np.rint(proba[:, 1] * 255)
+
+    # The files are written to a temporary directory and renamed into place, as for
+    # the forest caches, so a crash or a concurrent rebuild never leaves a partial
+    # table behind
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    meta = {
+        "age_min": age_min,
+        "age_max": age_max,
+        "n_cells": n_cells,
+        "feature_columns": encoder.feature_columns,
+        "classes": np.asarray(model.classes_).tolist(),
+        "model_sha256": model_sha256,
+    }
+    try:
+        np.save(os.path.join(tmp_dir, "predictions.npy"), np.packbits(predictions))
+        np.save(os.path.join(tmp_dir, "probabilities.npy"), probabilities)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as file:
+            json.dump(meta, file, indent=2)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # A directory can't be renamed over a non-empty one, so a stale table is moved
+    # aside first; until the rename, lookups find no table and use the model
+    old_dir = tempfile.mkdtemp(dir=parent, prefix=".old-")
+    try:
+        try:
+            os.rename(out_dir, os.path.join(old_dir, "table"))
+        except FileNotFoundError:
+            pass
+        os.rename(tmp_dir, out_dir)
+    except OSError:
+        # Another rebuild got there first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class PredictionTable:
+    # Precomputed predictions over the whole questionnaire answer space, memory-mapped
+    # from disk so a lookup is an index computation with no tree traversal
+    def __init__(self, path, encoder, mmap_mode="r"):
+        with open(os.path.join(path, "meta.json")) as file:
+            self.meta = json.load(file)
+        if self.meta["feature_columns"] != encoder.feature_columns:
+            raise ValueError("Prediction table was built for different features")
+
+        self.predictions = np.load(
+            os.path.join(path, "predictions.npy"), mmap_mode=mmap_mode
+        )
+        self.probabilities = np.load(
+            os.path.join(path, "probabilities.npy"), mmap_mode=mmap_mode
+        )
+        self.classes = np.asarray(self.meta["classes"])
+        self.age_min = self.meta["age_min"]
+        self.age_max = self.meta["age_max"]
+
+        self.encoder = encoder
+        self.age_index = encoder.age_index
+        self.age_scale = encoder.age_scale
+        self.age_offset = encoder.age_offset
+        self.categorical = np.array(_categorical_columns(encoder))
+        self.weights = 1 << np.arange(len(self.categorical), dtype=np.int64)
+        self.block = 1 << len(self.categorical)
+
+    def cell_index(self, X):
+        # Map encoded rows to table cells, -1 where the age is not a covered integer
+        X = np.asarray(X).reshape(-1, self.encoder.n_features)
+        scaled = X[:, self.age_index]
+        age = np.rint((scaled - self.age_offset) / self.age_scale)
+        covered = (
+            (age >= self.age_min)
+            & (age <= self.age_max)
+            & (age * self.age_scale + self.age_offset == scaled)
+        )
+        bits = X[:, self.categorical].astype(np.int64) @ self.weights
+        index = (age.astype(np.int64) - self.age_min) * self.block + bits
+        return np.where(covered, index, -1)
+
+    def predict_bits(self, index):
+        return (self.predictions[index >> 3] >> (7 - (index & 7))) & 1
+
+    def lookup(self, X):
+        # Returns (predictions, probabilities, hit mask); misses must go to the model
+        index = self.cell_index(X)
+        hit = index >= 0
+        safe = np.where(hit, index, 0)
+        predictions = self.classes[self.predict_bits(safe)]
+        probabilities = self.probabilities[safe] / 255.0
+        return predictions, probabilities, hit
+
+    def verify(self, model):
+        # Evaluate the model on every cell and count disagreements
+        mismatches = 0
+        max_proba_error = 0.0
+        for age in range(self.age_min, self.age_max + 1):
+            X = _age_block(self.encoder, self.categorical, age)
+            predictions, probabilities, hit = self.lookup(X)
+            if not hit.all():
+                raise AssertionError(f"Table does not cover age {age}")
+            mismatches += int(np.count_nonzero(predictions != model.predict(X)))
+            proba = model.predict_proba(X)[:, 1]
+            max_proba_error = max(
+                max_proba_error, float(np.abs(probabilities - proba).max())
+            )
+        return mismatches, max_proba_error
+
+
+def load_table(path, encoders, minmax, model_path, feature_columns, build=False):
+    # Load the table for the served model, optionally (re)building it when it is
+    # missing or was built from a different model file. The model is only
+    # unpickled for a rebuild
+    if os.path.isdir(model_path):
+        # A pickle-free export records the hash of the pickle it was exported from,
+        # but a rebuild needs the pickle itself
+        with open(os.path.join(model_path, "meta.json")) as file:
+            model_sha256 = json.load(file)["source_sha256"]
+        build = False
+    else:
+        model_sha256 = file_hash(model_path)
+    meta_path = os.path.join(path, "meta.json")
+    current = False
+    if os.path.exists(meta_path):
+        with open(meta_path) as file:
+            current = json.load(file).get("model_sha256") == model_sha256
+
+    if not current:
+        if not build:
+            print(f"Prediction table {path} is missing or stale, table mode disabled")
+            return None
+        with open(model_path, "rb") as file:
+            model = pickle.load(file)
+        build_table(model, encoders, minmax, path, model_sha256=model_sha256)
+
+    encoder = QuestionnaireEncoder(encoders, minmax, feature_columns)
+    return PredictionTable(path, encoder)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build or verify the diabetes prediction lookup table"
+    )
+    parser.add_argument("command", choices=["build", "verify"])
+    parser.add_argument("--model", default="final_predict_model.pkl")
+    parser.add_argument("--encoders", default="encoders.pkl")
+    parser.add_argument("--minmax", default="minmax.pkl")
+    parser.add_argument("--table", default="predict_table")
+    parser.add_argument("--age-min", type=int, default=AGE_MIN)
+    parser.add_argument("--age-max", type=int, default=AGE_MAX)
+    args = parser.parse_args()
+
+    with open(args.model, "rb") as file:
+        model = pickle.load(file)
+    with open(args.encoders, "rb") as file:
+        encoders = pickle.load(file)
+    with open(args.minmax, "rb") as file:
+        minmax = pickle.load(file)
+
+    start = time.perf_counter()
+    if args.command == "build":
+        build_table(
+            model,
+            encoders,
+            minmax,
+            args.table,
+            args.age_min,
+            args.age_max,
+            model_sha256=file_hash(args.model),
+        )
+        print(f"Table written to {args.table} in {time.perf_counter() - start:.1f}s")
+        return 0
+
+    encoder = QuestionnaireEncoder(encoders, minmax, model.feature_names_in_)
+    table = PredictionTable(args.table, encoder)
+    if table.meta["model_sha256"] not in (None, file_hash(args.model)):
+        print("Warning: table was built from a different model file")
+    mismatches, max_proba_error = table.verify(model)
+    print(
+        f"Checked {table.meta['n_cells']} cells in {time.perf_counter() - start:.1f}s: "
+        f"{mismatches} prediction mismatches, "
+        f"max probability error {max_proba_error:.4f}"
+    )
+    return 1 if mismatches else 0
+
+
+# TESTING
+class TestPredictionTable(unittest.TestCase):
+    AGES = (44, 46)
+
+    def setUp(self):
+        import tempfile
+
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.model_path = os.path.join(dir_path, "final_predict_model.pkl")
+        with open(self.model_path, "rb") as file:
+            self.model = pickle.load(file)
+        with open(os.path.join(dir_path, "encoders.pkl"), "rb") as file:
+            self.encoders = pickle.load(file)
+        with open(os.path.join(dir_path, "minmax.pkl"), "rb") as file:
+            self.minmax = pickle.load(file)
+        self.encoder = QuestionnaireEncoder(
+            self.encoders, self.minmax, self.model.feature_names_in_
+        )
+        self.directory = tempfile.mkdtemp()
+        self.table_path = os.path.join(self.directory, "table")
+        build_table(
+            self.model,
+            self.encoders,
+            self.minmax,
+            self.table_path,
+            *self.AGES,
+            model_sha256=file_hash(self.model_path),
+        )
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def load(self, build=False):
+        return load_table(
+            self.table_path,
+            self.encoders,
+            self.minmax,
+            self.model_path,
+            self.encoder.feature_columns,
+            build=build,
+        )
+
+    def test_parity_with_forest(self):
+        table = self.load()
+        mismatches, max_proba_error = table.verify(self.model)
+        self.assertEqual(mismatches, 0)
+        # Probabilities are stored in 1/255 steps
+        self.assertLessEqual(max_proba_error, 0.5 / 255 + 1e-9)
+
+        # Ages outside the table, or not whole years, are misses for the model
+        X = np.vstack([_age_block(self.encoder, table.categorical, 45)[:100]] * 3)
+        X[100:200, self.encoder.age_index] = self.encoder.age_offset
+        X[200:, self.encoder.age_index] += self.encoder.age_scale / 2
+        predictions, _, hit = table.lookup(X)
+        np.testing.assert_array_equal(hit, np.arange(300) < 100)
+        np.testing.assert_array_equal(predictions[:100], self.model.predict(X[:100]))
+
+    def test_failed_build_leaves_table_intact(self):
+        from unittest import mock
+
+        before = self.load().meta
+        with mock.patch.object(np, "save", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                build_table(
+                    self.model,
+                    self.encoders,
+                    self.minmax,
+                    self.table_path,
+                    *self.AGES,
+                    model_sha256="other",
+                )
+        self.assertEqual(self.load().meta, before)
+        self.assertEqual(os.listdir(self.directory), ["table"])
+
+        # A rebuild replaces the whole table and cleans up after itself
+        build_table(
+            self.model,
+            self.encoders,
+            self.minmax,
+            self.table_path,
+            *self.AGES,
+            model_sha256="other",
+        )
+        self.assertIsNone(self.load())
+        self.assertEqual(os.listdir(self.directory), ["table"])
+
+    def test_stale_table_falls_back_to_model(self):
+        import inferenceService
+
+        meta_path = os.path.join(self.table_path, "meta.json")
+        with open(meta_path) as file:
+            meta = json.load(file)
+        with open(meta_path, "w") as file:
+            json.dump(dict(meta, model_sha256="stale"), file)
+        self.assertIsNone(self.load())
+        self.assertEqual(
+            self.load(build=True).meta["model_sha256"], meta["model_sha256"]
+        )
+
+        # A table with every prediction flipped shows which path answered
+        table = self.load()
+        table.predictions = np.bitwise_not(table.predictions)
+        forest = inferenceService.models.get("diabetes")
+        X = _age_block(self.encoder, table.categorical, 45)[::64]
+        expected = forest.predict(X)
+        served = inferenceService.prediction_table
+        try:
+            inferenceService.prediction_table = table
+            table.meta["model_sha256"] = forest.version
+            self.assertTrue(
+                (inferenceService.predict_questionnaires(X, forest) != expected).all()
+            )
+            # Once the served model no longer matches, the table is bypassed
+            table.meta["model_sha256"] = "stale"
+            np.testing.assert_array_equal(
+                inferenceService.predict_questionnaires(X, forest), expected
+            )
+        finally:
+            inferenceService.prediction_table = served
+
+
+if __name__ == "__main__":
+    sys.exit(main())
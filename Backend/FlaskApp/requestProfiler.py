@@ -0,0 +1,296 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+import unittest
+from collections import Counter
+
+# On-demand profiling of single requests. With PROFILE_DIR set, a request sent with
+# an X-Profile header (equal to PROFILE_TOKEN when that is set), or picked at
+# PROFILE_SAMPLE_RATE, runs under cProfile and tracemalloc and leaves three files
+# in PROFILE_DIR, named after the id returned in the X-Profile-Id response header:
+#   <id>.prof       the cProfile stats, for pstats or snakeviz
+#   <id>.collapsed  collapsed stacks ("frame;frame;frame microseconds"), for
+#                   flamegraph.pl or speedscope
+#   <id>.json       request, time and peak traced memory, the top functions by
+#                   cumulative time and the top allocation sites still held at the end
+# Only the newest PROFILE_KEEP profiles are kept. Without PROFILE_DIR the service
+# never wraps its WSGI app, so requests don't pay for any of this
+PROFILE_HEADER = "HTTP_X_PROFILE"
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 15
+PROFILE_EXTENSIONS = (".prof", ".collapsed", ".json")
+MIN_STACK_SECONDS = 1e-6
+
+
+def _frame_name(func):
+    file_name, line, name = func
+    if file_name == "~":
+        return name  # Built-in, e.g. <built-in method numpy.array>
+    return f"{name} ({os.path.basename(file_name)}:{line})"
+
+
+def collapsed_stacks(stats):
+    # cProfile only records caller/callee pairs, so each function's time is split
+    # between the stacks that lead to it in proportion to the time each caller
+    # spent in it. Recursive calls are folded into the first frame of the function,
+    # and paths carrying under MIN_STACK_SECONDS are dropped, which would otherwise
+    # make the number of paths explode through pandas' call graph
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, edge_ct) in callers.items():
+            callees.setdefault(caller, []).append((func, edge_ct))
+
+    stacks = Counter()
+
+    def visit(func, stack, share):
+        _, _, tt, ct, _ = stats.stats[func]
+        stack = stack + [_frame_name(func)]
+        if tt * share > 0:
+            stacks[";".join(stack)] += tt * share
+        for callee, edge_ct in callees.get(func, []):
+            if callee == func or _frame_name(callee) in stack:
+                continue
+            callee_ct = stats.stats[callee][3]
+            if share * edge_ct >= MIN_STACK_SECONDS:
+                visit(callee, stack, share * edge_ct / callee_ct)
+
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            visit(func, [], 1.0)
+    return {stack: int(round(seconds * 1e6)) for stack, seconds in stacks.items()}
+
+
+def top_functions(stats, limit=TOP_FUNCTIONS):
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [
+        {
+            "function": _frame_name(func),
+            "calls": nc,
+            "self_ms": round(tt * 1e3, 3),
+            "cumulative_ms": round(ct * 1e3, 3),
+        }
+        for func, (_, nc, tt, ct, _) in rows[:limit]
+    ]
+
+
+def top_allocations(snapshot, limit=TOP_ALLOCATIONS):
+    return [
+        {
+            "site": f"{os.path.basename(stat.traceback[0].filename)}:"
+            f"{stat.traceback[0].lineno}",
+            "kb": round(stat.size / 1e3, 1),
+            "blocks": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+class RequestProfiler:
+    def __init__(self, directory, sample_rate=0.0, keep=20, token=None):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.token = token
+        # One profiled request at a time per process: tracemalloc traces every
+        # thread, so two at once would mix their allocations
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def triggered(self, environ):
+        header = environ.get(PROFILE_HEADER)
+        if header is not None:
+            return self.token is None or header == self.token
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def wrap(self, wsgi_app):
+        def profiled_app(environ, start_response):
+            if not self.triggered(environ) or not self.lock.acquire(blocking=False):
+                return wsgi_app(environ, start_response)
+            try:
+                return self.profile(wsgi_app, environ, start_response)
+            finally:
+                self.lock.release()
+
+        return profiled_app
+
+    def profile(self, wsgi_app, environ, start_response):
+        now = time.time()
+        profile_id = (
+            f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}."
+            f"{int(now % 1 * 1e6):06d}-{os.getpid()}"
+        )
+        status = []
+
+        def profiled_start_response(status_line, headers, *exc_info):
+            status.append(int(status_line.split()[0]))
+            return start_response(
+                status_line, headers + [("X-Profile-Id", profile_id)], *exc_info
+            )
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            # Most responses are already built here; streamed bodies are read
+            # into memory so their generation is profiled too
+            body = list(profiler.runcall(wsgi_app, environ, profiled_start_response))
+            return body
+        finally:
+            elapsed = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if not tracing:
+                tracemalloc.stop()
+            summary = {
+                "id": profile_id,
+                "method": environ.get("REQUEST_METHOD"),
+                "path": environ.get("PATH_INFO"),
+                "status": status[0] if status else None,
+                "ms": round(elapsed * 1e3, 3),
+                "peak_traced_kb": round(peak / 1e3, 1),
+                "retained_traced_kb": round(current / 1e3, 1),
+            }
+            self.write(profile_id, profiler, snapshot, summary)
+
+    def write(self, profile_id, profiler, snapshot, summary):
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        path = os.path.join(self.directory, profile_id)
+        stats.dump_stats(path + ".prof")
+        with open(path + ".collapsed", "w") as file:
+            for stack, us in sorted(collapsed_stacks(stats).items()):
+                if us > 0:
+                    file.write(f"{stack} {us}\n")
+        summary = dict(
+            summary,
+            top_functions=top_functions(stats),
+            top_allocations=top_allocations(snapshot),
+        )
+        # The summary is written last: its presence marks a complete profile
+        with open(path + ".json", "w") as file:
+            json.dump(summary, file, indent=2)
+        self.prune()
+
+    def prune(self):
+        # Profile ids start with a timestamp, so the oldest sort first
+        profiles = {}
+        for entry in os.scandir(self.directory):
+            profile_id, extension = os.path.splitext(entry.name)
+            if extension in PROFILE_EXTENSIONS:
+                profiles.setdefault(profile_id, []).append(entry.path)
+        for profile_id in sorted(profiles)[: max(len(profiles) - self.keep, 0)]:
+            for path in profiles[profile_id]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # Pruned by another worker
+
+
+def profiler_from_env():
+    if not os.environ.get("PROFILE_DIR"):
+        return None
+    return RequestProfiler(
+        os.environ["PROFILE_DIR"],
+        sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+        keep=int(os.environ.get("PROFILE_KEEP", "20")),
+        token=os.environ.get("PROFILE_TOKEN"),
+    )
+
+
+# TESTING
+class TestRequestProfiler(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def app(environ, start_response):
+        data = [sum(range(i)) for i in range(500)]
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [str(len(data)).encode()]
+
+    def call(self, app, headers=None):
+        responses = []
+        environ = {"REQUEST_METHOD": "POST", "PATH_INFO": "/estimate-a1c"}
+        environ.update(headers or {})
+        body = app(environ, lambda status, headers: responses.append(dict(headers)))
+        return b"".join(body), responses[0]
+
+    def test_profiles_triggered_requests(self):
+        profiler = RequestProfiler(self.directory, keep=2, token="secret")
+        app = profiler.wrap(self.app)
+
+        self.assertEqual(self.call(app), (b"500", {"Content-Type": "text/plain"}))
+        self.assertEqual(self.call(app, {PROFILE_HEADER: "wrong"})[0], b"500")
+        self.assertEqual(os.listdir(self.directory), [])
+
+        body, headers = self.call(app, {PROFILE_HEADER: "secret"})
+        self.assertEqual(body, b"500")
+        path = os.path.join(self.directory, headers["X-Profile-Id"])
+        with open(path + ".json") as file:
+            summary = json.load(file)
+        self.assertEqual((summary["path"], summary["status"]), ("/estimate-a1c", 200))
+        self.assertGreater(summary["peak_traced_kb"], 0)
+        self.assertTrue(
+            any(
+                "app (requestProfiler.py" in row["function"]
+                for row in summary["top_functions"]
+            )
+        )
+        with open(path + ".collapsed") as file:
+            lines = file.read().splitlines()
+        self.assertTrue(any("app (requestProfiler.py:" in line for line in lines))
+        self.assertTrue(all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines))
+        pstats.Stats(path + ".prof", stream=io.StringIO())
+        self.assertFalse(tracemalloc.is_tracing())
+
+        # Only the newest profiles are kept
+        for _ in range(3):
+            newest = self.call(app, {PROFILE_HEADER: "secret"})[1]["X-Profile-Id"]
+        self.assertEqual(len(os.listdir(self.directory)), 2 * len(PROFILE_EXTENSIONS))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, newest + ".json")))
+
+    def test_collapsed_stacks_split_shared_callees(self):
+        from types import SimpleNamespace
+
+        # root calls one and two, which spend 1 s and 3 s in the shared leaf
+        root, one, two = (
+            ("app.py", 1, "root"),
+            ("app.py", 5, "one"),
+            ("app.py", 9, "two"),
+        )
+        leaf = ("~", 0, "<built-in method builtins.sum>")
+        stats = SimpleNamespace(
+            stats={
+                root: (1, 1, 0.5, 4.5, {}),
+                one: (1, 1, 0.0, 1.0, {root: (1, 1, 0.0, 1.0)}),
+                two: (1, 1, 0.0, 3.0, {root: (1, 1, 0.0, 3.0)}),
+                leaf: (3, 3, 4.0, 4.0, {one: (1, 1, 1.0, 1.0), two: (2, 2, 3.0, 3.0)}),
+            }
+        )
+        self.assertEqual(
+            collapsed_stacks(stats),
+            {
+                "root (app.py:1)": 500000,
+                "root (app.py:1);one (app.py:5);<built-in method builtins.sum>": 1000000,
+                "root (app.py:1);two (app.py:9);<built-in method builtins.sum>": 3000000,
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+# Modules that only the training scripts need; importing flaskApp must never load them
+TRAINING_MODULES = [
+    "sklearn.model_selection",
+    "sklearn.ensemble",
+    "sklearn.metrics",
+    "keras",
+    "tensorflow",
+    "matplotlib",
+]
+# Heavy modules that the service only imports on first use of an endpoint
+DEFERRED_MODULES = ["pandas", "sklearn", "scipy"]
+
+
+def parse_importtime(output):
+    # Parse `python -X importtime` lines ("import time: self | cumulative | name")
+    # into (name, self_us, cumulative_us, depth) tuples, in completion order
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # Header line
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return modules
+
+
+def _loaded(modules, prefix):
+    return any(name == prefix or name.startswith(prefix + ".") for name, *_ in modules)
+
+
+def measure_startup(module="flaskApp", env=None, cwd=None):
+    # Import the module in a fresh interpreter and report per-module import costs
+    cwd = cwd or os.path.dirname(os.path.realpath(__file__))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        env=dict(os.environ, **(env or {})),
+        capture_output=True,
+        text=True,
+    )
+    wall_ms = (time.perf_counter() - start) * 1e3
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    modules = parse_importtime(result.stderr)
+    target = [entry for entry in modules if entry[0] == module]
+    return {
+        "module": module,
+        "env": env or {},
+        "wall_ms": wall_ms,
+        "import_ms": target[-1][2] / 1e3 if target else None,
+        "modules": modules,
+        "training_modules": [m for m in TRAINING_MODULES if _loaded(modules, m)],
+        "deferred_modules": [m for m in DEFERRED_MODULES if _loaded(modules, m)],
+    }
+
+
+def print_report(result, top=15):
+    label = " ".join(f"{key}={value}" for key, value in result["env"].items())
+    print(
+        f"import {result['module']} {label}".rstrip()
+        + f": {result['import_ms']:.1f} ms, "
+        f"process wall time {result['wall_ms']:.1f} ms"
+    )
+    # Top-level imports of the module, by cumulative time
+    direct = [entry for entry in result["modules"] if entry[3] == 1]
+    for name, _, cumulative, _ in sorted(direct, key=lambda e: -e[2])[:top]:
+        print(f"  {cumulative / 1e3:9.1f} ms  {name}")
+    if result["deferred_modules"]:
+        print(f"  loaded at import: {', '.join(result['deferred_modules'])}")
+    if result["training_modules"]:
+        print(f"  TRAINING MODULES IMPORTED: {', '.join(result['training_modules'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the Flask service's cold start, module by module"
+    )
+    parser.add_argument("--module", default="flaskApp")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--budget-ms", type=float, help="Fail if the slim import takes longer"
+    )
+    parser.add_argument(
+        "--warmup", action="store_true", help="Also measure a start with WARMUP=1"
+    )
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    configurations = [{}]
+    if args.warmup:
+        configurations.append({"WARMUP": "1"})
+
+    results = []
+    for env in configurations:
+        runs = [measure_startup(args.module, env) for _ in range(args.repeat)]
+        best = min(runs, key=lambda run: run["import_ms"])
+        print_report(best, args.top)
+        results.append(best)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    slim = results[0]
+    failed = bool(slim["training_modules"])
+    if args.budget_ms is not None and slim["import_ms"] > args.budget_ms:
+        print(f"Import time over budget of {args.budget_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+# TESTING
+class TestStartupBench(unittest.TestCase):
+    def test_parse_importtime(self):
+        output = "\n".join(
+            [
+                "import time: self [us] | cumulative | imported package",
+                "import time:       120 |        120 |     _io",
+                "import time:       300 |        420 |   numpy",
+                "import time:        50 |        470 | flaskApp",
+            ]
+        )
+        self.assertEqual(
+            parse_importtime(output),
+            [("_io", 120, 120, 2), ("numpy", 300, 420, 1), ("flaskApp", 50, 470, 0)],
+        )
+
+    def test_slim_import_graph(self):
+        result = measure_startup("flaskApp")
+        self.assertEqual(result["training_modules"], [])
+        self.assertEqual(result["deferred_modules"], [])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,75 +1,59 @@
 import pandas as pd
-import numpy as np
-from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.model_selection import train_test_split, KFold, GridSearchCV
+from sklearn.model_selection import train_test_split, KFold
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_squared_error, r2_score, mean_absolute_error
+import argparse
 import os
 import pickle
+import sys
 
+dir_path = os.path.dirname(os.path.realpath(__file__))
 
-class GlucoseDataPreprocessor(BaseEstimator, TransformerMixin):
-    def __init__(self, window=21):
-        self.window = (
-            window // 3
-        )  # Calculate rolling windows based on 3 readings per day
-
-    def fit(self, X, y=None):
-        return self  # Fitting does nothing as no parameters to learn for preprocessing
-
-    def transform(self, data):
-        data["Timestamp"] = pd.to_datetime(data["Timestamp"])
-        data["Date"] = data["Timestamp"].dt.date
-        grouped = data.groupby(["Patient_ID", "Date"])
-        daily_data = (
-            grouped["Blood_Glucose"]
-            .agg(["mean", "median", "std", "max", "min"])
-            .reset_index()
-        )
-        daily_data["HbA1c"] = grouped["HbA1c"].first().values
-
-        # Rolling features calculated for each glucose statistic
-        for feature in ["mean", "median", "std", "max", "min"]:
-            daily_data[f"{feature}_rolling_mean"] = daily_data.groupby("Patient_ID")[
-                feature
-            ].transform(lambda x: x.rolling(self.window, min_periods=1).mean())
-            daily_data[f"{feature}_rolling_std"] = daily_data.groupby("Patient_ID")[
-                feature
-            ].transform(lambda x: x.rolling(self.window, min_periods=1).std())
-
-        # Calculate summary statistics
-        daily_data["rolling_mean"] = daily_data[
-            [
-                f"{feature}_rolling_mean"
-                for feature in ["mean", "median", "std", "max", "min"]
-            ]
-        ].mean(axis=1)
-        daily_data["rolling_median"] = daily_data[
-            [
-                f"{feature}_rolling_mean"
-                for feature in ["mean", "median", "std", "max", "min"]
-            ]
-        ].median(axis=1)
-        daily_data["rolling_std"] = daily_data[
-            [
-                f"{feature}_rolling_std"
-                for feature in ["mean", "median", "std", "max", "min"]
-            ]
-        ].std(axis=1)
-
-        return daily_data.dropna()[
-            ["rolling_mean", "rolling_median", "rolling_std", "HbA1c"]
-        ]
-
+parser = argparse.ArgumentParser(description="Train the A1c estimation model")
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="Read the glucose CSV in chunks instead of loading it into memory",
+)
+parser.add_argument("--chunksize", type=int, default=500_000)
+parser.add_argument(
+    "--data",
+    default=os.path.join(dir_path, "../../../Dataset/synthetic_diabetes_data_v6.csv"),
+)
+parser.add_argument(
+    "--output", default=os.path.join(dir_path, "../Models/A1cModel.pkl")
+)
+args = parser.parse_args()
+# Resolved before the chdir below, so relative paths are taken from the caller's
+# directory
+data_path = os.path.abspath(args.data)
+output_path = os.path.abspath(args.output)
 
 # Path and data loading
-dir_path = os.path.dirname(os.path.realpath(__file__))
 os.chdir(dir_path)
-diabetes_data = pd.read_csv("../../../Dataset/synthetic_diabetes_data_v6.csv")
+sys.path.insert(0, os.path.join(dir_path, ".."))
+# The preprocessor is the service's own class, so the pickled model unpickles in
+# the Flask app
+sys.path.insert(0, os.path.join(dir_path, "../../FlaskApp"))
+from columnarDataset import read_dataset
+from trainingDriver import ForestSearch
+from glucosePreprocessor import GlucoseDataPreprocessor
 
-# Initialize preprocessor and process data
-preprocessor = GlucoseDataPreprocessor()
-features_data = preprocessor.transform(diabetes_data)
+# Initialize preprocessor and process data. The config is published with the model
+# so the service preprocesses readings the same way
+preprocessor_config = {"window": 21}
+preprocessor = GlucoseDataPreprocessor(**preprocessor_config)
+if args.stream:
+    # Only the daily feature rows are kept in memory, not the raw readings
+    from glucoseStream import peak_rss_mb, stream_features
+
+    features_data = pd.concat(
+        stream_features(data_path, chunksize=args.chunksize, **preprocessor_config)
+    )
+    print(f"Streamed features, peak RSS {peak_rss_mb():.0f} MB")
+else:
+    diabetes_data = read_dataset(data_path)
+    features_data = preprocessor.transform(diabetes_data)
 
 # Model training setup
 X = features_data[["rolling_mean", "rolling_median", "rolling_std"]]
@@ -81,12 +65,12 @@ X_train, X_test, y_train, y_test = train_test_split(
 # Optimize model parameters
 kfold = KFold(n_splits=5, shuffle=True, random_state=42)
 param_grid = {"n_estimators": [50, 100, 200], "max_depth": [None, 10, 20, 30]}
-grid_search = GridSearchCV(
+grid_search = ForestSearch(
     RandomForestRegressor(random_state=42), param_grid, cv=kfold, scoring="r2"
 )
 grid_search.fit(X_train, y_train)
+# Already refit on the training set by the search
 best_rf_model = grid_search.best_estimator_
-best_rf_model.fit(X_train, y_train)
 
 # Evaluate the model
 y_pred = best_rf_model.predict(X_test)
@@ -97,5 +81,23 @@ r2 = r2_score(y_test, y_pred)
 print(f"Mean Squared Error: {mse}, \nMean Absolute Error: {mae}, \nR-squared: {r2}")
 
 # Save the model and preprocessor
-with open("../Models/A1cModel.pkl", "wb") as file:
+with open(output_path, "wb") as file:
     pickle.dump({"preprocessor": preprocessor, "model": best_rf_model}, file)
+
+# Optionally publish the model as a versioned bundle the Flask app hot-reloads
+if os.environ.get("MODEL_ARTIFACTS"):
+    from modelArtifacts import publish_bundle
+
+    bundle = publish_bundle(
+        os.environ["MODEL_ARTIFACTS"],
+        "a1c",
+        {"model.pkl": output_path},
+        preprocessor_config,
+        metadata={
+            "params": grid_search.best_params_,
+            "mse": mse,
+            "mae": mae,
+            "r2": r2,
+        },
+    )
+    print("Published", bundle)
@@ -1,142 +1,411 @@
 # Import necessary libraries
-import numpy as np
-import pandas as pd
+import argparse
 import datetime
+import json
+import os
+import sys
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
 
-# Define simulation parameters
-num_patients = 49
-days = 90  # 3 months
-readings_per_day = 3  # Morning, Afternoon, Evening
-
-# Set a random seed for reproducibility
-np.random.seed(42)
-
-# Patient demographics
-patient_ids = np.arange(1, num_patients + 1)
-ages = np.random.randint(18, 82, num_patients)
-genders = np.random.choice(["Female", "Male"], num_patients)
-bmis = np.round(np.random.uniform(18.5, 40, num_patients), 2)
+import numpy as np
+import pandas as pd
 
-# Generate timestamps for glucose readings
-start_date = datetime.date.today() - datetime.timedelta(days=days)
-timestamps = pd.date_range(start=start_date, periods=days * readings_per_day, freq="8H")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from columnarDataset import SCHEMA_FILE, SCHEMA_VERSION, load_columnar
 
+# Patient categories and their glucose parameters, indexed by category code
+CATEGORIES = ["non_diabetic", "pre_diabetic", "diabetic"]
+BASE_MEAN = np.array([70.0, 110.0, 135.0])
+BASE_STD = np.array([10.0, 18.0, 24.0])
+MEAL_MEAN = np.array([10.0, 18.0, 18.0])
+MEAL_STD = np.array([5.0, 10.0, 10.0])
+MAX_THRESHOLDS = np.array([140.0, 200.0, 260.0])
 
-# Function to simulate glucose readings
-def simulate_glucose_readings(num_days, readings_per_day, category, bmi, age, gender):
-    # Calculate a BMI factor based on a quadratic relationship with glucose levels
-    bmi_factor = ((bmi - 25) ** 2) * 0.01
+# Patients generated from each seed. Shards are whole blocks, so every patient's
+# data is the same whatever the shard size
+SEED_BLOCK = 250
 
-    # Interaction with age and gender
-    if gender == "Female":
-        bmi_factor *= 1.1
-    bmi_factor *= 1 + 0.01 * (age - 50)
+COLUMNS = ["Patient_ID", "Timestamp", "Age", "Gender", "BMI", "Blood_Glucose", "HbA1c"]
+GENDERS = np.array(["Female", "Male"], dtype=object)
 
-    # Initialize glucose readings list
-    glucose_readings = []
 
-    # Define max thresholds for each category
-    max_thresholds = {"non_diabetic": 140, "pre_diabetic": 200, "diabetic": 260}
+# Simulate glucose readings for a group of patients at once, shape
+# (patients, days * readings)
+def simulate_glucose_readings(rng, categories, bmi_factors, num_days, readings_per_day):
+    shape = (len(categories), num_days, readings_per_day)
+    per_patient = (slice(None), np.newaxis, np.newaxis)
 
-    # Loop over each day and reading
-    for day in range(num_days):
-        for reading in range(readings_per_day):
-            # Set base glucose levels for different categories
-            if category == "non_diabetic":
-                base = np.random.normal(70, 10)
-            elif category == "pre_diabetic":
-                base = np.random.normal(110, 18)
-            else:  # diabetic
-                base = np.random.normal(135, 24)
+    # Set base glucose levels for different categories
+    base = rng.normal(
+        BASE_MEAN[categories][per_patient], BASE_STD[categories][per_patient], shape
+    )
 
-            # Simulate glucose reading variation due to BMI only for the first reading of the day
-            if reading == 0:
-                base += bmi_factor
+    # Simulate glucose reading variation due to BMI only for the first reading of
+    # the day
+    base[:, :, 0] += bmi_factors[:, np.newaxis]
 
-            # Simulate random daily variability
-            daily_variation = np.random.normal(0, 5)
+    # Simulate random daily variability
+    daily_variation = rng.normal(0, 5, shape)
 
-            # Simulate meal responses
-            if reading > 0:  # Assume first reading is fasting
-                meal_response = (
-                    np.random.normal(18, 10)
-                    if category != "non_diabetic"
-                    else np.random.normal(10, 5)
-                )
-                base += meal_response
+    # Simulate meal responses, assuming the first reading is fasting
+    base[:, :, 1:] += rng.normal(
+        MEAL_MEAN[categories][per_patient],
+        MEAL_STD[categories][per_patient],
+        (len(categories), num_days, readings_per_day - 1),
+    )
 
-            # Adjust for medication or exercise
-            medication_effect = -5 if np.random.rand() < 0.4 else 0  # 40% chance
-            exercise_effect = -5 if np.random.rand() < 0.2 else 0  # 20% chance
+    # Adjust for medication (40% chance) or exercise (20% chance)
+    medication_effect = np.where(rng.random(shape) < 0.4, -5.0, 0.0)
+    exercise_effect = np.where(rng.random(shape) < 0.2, -5.0, 0.0)
 
-            # Combine all effects
-            reading_value = base + daily_variation + medication_effect + exercise_effect
+    # Combine all effects and keep readings within a realistic range
+    readings = base + daily_variation + medication_effect + exercise_effect
+    readings = np.clip(readings, 50, MAX_THRESHOLDS[categories][per_patient])
+    return readings.reshape(len(categories), -1)
 
-            # Ensure glucose readings are within a realistic range
-            reading_value = max(min(reading_value, max_thresholds[category]), 50)
 
-            glucose_readings.append(reading_value)
+# Simulate HbA1c from each patient's mean glucose, with biological variability
+def simulate_hba1c_from_glucose(rng, glucose_readings):
+    mean_glucose = glucose_readings.mean(axis=1)
+    hba1c = (46.7 + mean_glucose) / 28.7
+    hba1c += rng.normal(0, 0.2, len(mean_glucose))
+    return np.round(hba1c, 1)
 
-    return np.array(glucose_readings)
 
+def generate_block(seed, first_id, num_patients, days, readings_per_day, category_mix):
+    # Generate one block of patients from its own seed
+    rng = np.random.Generator(np.random.PCG64(seed))
 
-# Function to simulate HbA1c from glucose readings
-def simulate_hba1c_from_glucose(glucose_readings):
-    # Calculate the mean glucose level
-    mean_glucose = np.mean(glucose_readings)
+    # Patient demographics
+    patient_ids = np.arange(first_id, first_id + num_patients, dtype=np.int32)
+    ages = rng.integers(18, 82, num_patients, dtype=np.int32)
+    genders = rng.integers(0, 2, num_patients, dtype=np.uint8)
+    bmis = np.round(rng.uniform(18.5, 40, num_patients), 2)
+    categories = rng.choice(len(CATEGORIES), size=num_patients, p=category_mix)
 
-    # Simulate HbA1c level based on the mean glucose
-    hba1c = (46.7 + mean_glucose) / 28.7
+    # Calculate a BMI factor based on a quadratic relationship with glucose levels,
+    # with interactions for age and gender
+    bmi_factors = ((bmis - 25) ** 2) * 0.01
+    bmi_factors = np.where(genders == 0, bmi_factors * 1.1, bmi_factors)
+    bmi_factors *= 1 + 0.01 * (ages - 50)
 
-    # Add some random biological variability
-    hba1c += np.random.normal(0, 0.2)
+    glucose = simulate_glucose_readings(
+        rng, categories, bmi_factors, days, readings_per_day
+    )
+    hba1c = simulate_hba1c_from_glucose(rng, glucose)
+
+    per_patient = days * readings_per_day
+    return {
+        "Patient_ID": np.repeat(patient_ids, per_patient),
+        "Age": np.repeat(ages, per_patient),
+        "Gender": np.repeat(genders, per_patient),
+        "BMI": np.repeat(bmis, per_patient),
+        "Blood_Glucose": glucose.reshape(-1),
+        "HbA1c": np.repeat(hba1c, per_patient),
+    }
+
+
+def generate_shard(args):
+    # Generate a shard as consecutive SEED_BLOCK blocks of patients, each from its
+    # own seed, so output depends neither on the shard size nor on how shards are
+    # spread over worker processes
+    seeds, first_id, num_patients, days, readings_per_day, category_mix = args
+    blocks = [
+        generate_block(
+            seed,
+            first_id + i * SEED_BLOCK,
+            min(SEED_BLOCK, num_patients - i * SEED_BLOCK),
+            days,
+            readings_per_day,
+            category_mix,
+        )
+        for i, seed in enumerate(seeds)
+    ]
+    if len(blocks) == 1:
+        return blocks[0]
+    return {
+        name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]
+    }
+
+
+def reading_timestamps(days, readings_per_day):
+    # Every patient shares the same reading times, evenly spaced through the day
+    start_date = datetime.date.today() - datetime.timedelta(days=days)
+    return pd.date_range(
+        start=start_date,
+        periods=days * readings_per_day,
+        freq=pd.Timedelta(days=1) / readings_per_day,
+    )
 
-    return np.round(hba1c, 1)
 
+def render_csv(shard, timestamps):
+    # CSV text for one shard, rendered in the worker so formatting runs in parallel.
+    # Only the timestamp and glucose change within a patient, so the other fields
+    # are formatted once per patient instead of going through DataFrame.to_csv
+    per_patient = len(timestamps)
+    first = slice(None, None, per_patient)
+    lines = []
+    for patient_id, age, gender, bmi, hba1c, glucose in zip(
+        shard["Patient_ID"][first].tolist(),
+        shard["Age"][first].tolist(),
+        shard["Gender"][first].tolist(),
+        shard["BMI"][first].tolist(),
+        shard["HbA1c"][first].tolist(),
+        shard["Blood_Glucose"].reshape(-1, per_patient).tolist(),
+    ):
+        middle = f",{age},{GENDERS[gender]},{bmi:.2f},"
+        suffix = f",{hba1c:.2f}\n"
+        lines.append(
+            "".join(
+                [
+                    f"{patient_id},{timestamp}{middle}{value:.2f}{suffix}"
+                    for timestamp, value in zip(timestamps, glucose)
+                ]
+            )
+        )
+    return "".join(lines)
+
+
+def build_shard(task):
+    shard = generate_shard(task[:-1])
+    if task[-1] != "csv":
+        return shard
+    _, _, _, days, readings_per_day, _, _ = task
+    # Timestamps are formatted once per shard and repeated for every patient
+    timestamps = reading_timestamps(days, readings_per_day)
+    return render_csv(shard, list(timestamps.strftime("%Y-%m-%d %H:%M:%S")))
+
+
+class CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="")
+        self.file.write(",".join(COLUMNS) + "\n")
+
+    def write(self, text):
+        self.file.write(text)
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarWriter:
+    # Writes straight into preallocated memory-mapped columns in the columnar
+    # dataset layout, so the cohort is never held in memory
+    KINDS = {
+        "Patient_ID": ("int", np.int32),
+        "Timestamp": ("timestamp", np.int64),
+        "Age": ("int", np.int32),
+        "Gender": ("categorical", np.uint8),
+        "BMI": ("float", np.float64),
+        "Blood_Glucose": ("float", np.float64),
+        "HbA1c": ("float", np.float64),
+    }
+
+    def __init__(self, path, timestamps, n_rows):
+        self.path = path
+        # Whole seconds, as the CSV writes them
+        timestamps = timestamps.floor("s")
+        self.timestamps = timestamps.to_numpy("datetime64[ns]").view(np.int64)
+        self.n_rows = n_rows
+        self.position = 0
+        os.makedirs(path, exist_ok=True)
+        self.columns = {
+            name: np.lib.format.open_memmap(
+                os.path.join(path, f"{i:03d}.npy"),
+                mode="w+",
+                dtype=self.KINDS[name][1],
+                shape=(n_rows,),
+            )
+            for i, name in enumerate(COLUMNS)
+        }
+
+    def write(self, shard):
+        n = len(shard["Patient_ID"])
+        rows = slice(self.position, self.position + n)
+        for name, column in self.columns.items():
+            if name == "Timestamp":
+                column[rows] = np.tile(self.timestamps, n // len(self.timestamps))
+            elif self.KINDS[name][0] == "float":
+                # Two decimals, the precision the CSV is written with
+                column[rows] = np.round(shard[name], 2)
+            else:
+                column[rows] = shard[name]
+        self.position += n
+
+    def close(self):
+        for column in self.columns.values():
+            column.flush()
+        schema = {
+            "version": SCHEMA_VERSION,
+            "n_rows": self.n_rows,
+            "source": None,
+            "columns": [
+                {
+                    "name": name,
+                    "kind": self.KINDS[name][0],
+                    "dtype": np.dtype(self.KINDS[name][1]).str,
+                    "file": f"{i:03d}.npy",
+                }
+                for i, name in enumerate(COLUMNS)
+            ],
+        }
+        schema["columns"][COLUMNS.index("Gender")]["categories"] = list(GENDERS)
+        with open(os.path.join(self.path, SCHEMA_FILE), "w") as file:
+            json.dump(schema, file, indent=2)
+
+
+def generate_dataset(
+    output,
+    num_patients=49,
+    days=90,
+    readings_per_day=3,
+    category_mix=(0.2, 0.3, 0.5),
+    seed=42,
+    shard_size=1000,
+    workers=1,
+    output_format="csv",
+):
+    # Generate the cohort in shards of patients with deterministic per-block seeds
+    # and write each shard as soon as it is ready. Shards are rounded up to whole
+    # seed blocks
+    blocks_per_shard = max(1, -(-shard_size // SEED_BLOCK))
+    shard_size = blocks_per_shard * SEED_BLOCK
+    seeds = np.random.SeedSequence(seed).spawn(-(-num_patients // SEED_BLOCK))
+    n_shards = -(-num_patients // shard_size)
+    tasks = [
+        (
+            seeds[i * blocks_per_shard : (i + 1) * blocks_per_shard],
+            1 + i * shard_size,
+            min(shard_size, num_patients - i * shard_size),
+            days,
+            readings_per_day,
+            category_mix,
+            output_format,
+        )
+        for i in range(n_shards)
+    ]
+
+    timestamps = reading_timestamps(days, readings_per_day)
+    if output_format == "cols":
+        writer = ColumnarWriter(output, timestamps, num_patients * len(timestamps))
+    else:
+        writer = CsvWriter(output)
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            for shard in pool.map(build_shard, tasks):
+                writer.write(shard)
+    else:
+        for task in tasks:
+            writer.write(build_shard(task))
+    writer.close()
+
+
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic glucose cohort")
+    parser.add_argument("--patients", type=positive_int, default=49)
+    parser.add_argument("--days", type=positive_int, default=90)  # 3 months
+    parser.add_argument(
+        "--readings-per-day",
+        type=positive_int,
+        default=3,  # Morning, Afternoon, Evening
+    )
+    parser.add_argument(
+        "--mix",
+        type=float,
+        nargs=3,
+        default=[0.2, 0.3, 0.5],
+        metavar=("NON", "PRE", "DIABETIC"),
+        help="Share of non-diabetic, pre-diabetic and diabetic patients",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--shard-size", type=positive_int, default=1000)
+    parser.add_argument("--workers", type=positive_int, default=1)
+    parser.add_argument("--format", choices=["csv", "cols"], default="csv")
+    parser.add_argument("--output", default="Dataset/synthetic_diabetes_data_v6.csv")
+    args = parser.parse_args()
+
+    mix = np.array(args.mix) / np.sum(args.mix)
+    start = time.perf_counter()
+    generate_dataset(
+        args.output,
+        num_patients=args.patients,
+        days=args.days,
+        readings_per_day=args.readings_per_day,
+        category_mix=mix,
+        seed=args.seed,
+        shard_size=args.shard_size,
+        workers=args.workers,
+        output_format=args.format,
+    )
+    elapsed = time.perf_counter() - start
 
-# Generate synthetic dataset
-df_list = []
-for patient_id in patient_ids:
-    # Randomly assign each patient to a category
-    category = np.random.choice(
-        ["non_diabetic", "pre_diabetic", "diabetic"], p=[0.2, 0.3, 0.5]
+    n_readings = args.patients * args.days * args.readings_per_day
+    print(
+        f"\nDataset generated and saved to {args.output}: {n_readings} readings "
+        f"in {elapsed:.1f}s ({n_readings / elapsed:,.0f} readings/s)\n"
     )
 
-    # Retrieve the BMI, age and gender for the patient
-    bmi = bmis[patient_id - 1]
-    age = ages[patient_id - 1]
-    gender = genders[patient_id - 1]
 
-    # Simulate glucose readings and HbA1c levels
-    glucose_readings = simulate_glucose_readings(
-        days, readings_per_day, category, bmi, age, gender
-    )
-    hba1c = simulate_hba1c_from_glucose(glucose_readings)
-
-    # Compile patient data into the dataframe list
-    for i in range(days * readings_per_day):
-        df_list.append(
-            [
-                patient_id,
-                timestamps[i % (days * readings_per_day)].strftime("%Y-%m-%d %H:%M:%S"),
-                ages[patient_id - 1],
-                genders[patient_id - 1],
-                bmi,
-                glucose_readings[i],
-                hba1c,
-            ]
+# TESTING
+class TestSyntheticDataset(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def generate(self, name, **kwargs):
+        path = os.path.join(self.directory, name)
+        generate_dataset(path, **dict({"num_patients": 600, "days": 5}, **kwargs))
+        return path
+
+    def test_output_independent_of_workers_and_shards(self):
+        outputs = []
+        for shard_size, workers in [(1000, 1), (100, 2), (SEED_BLOCK, 3)]:
+            path = self.generate(
+                f"{shard_size}-{workers}.csv", shard_size=shard_size, workers=workers
+            )
+            with open(path, "rb") as file:
+                outputs.append(file.read())
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[2], outputs[0])
+
+    def test_csv_and_columnar_match(self):
+        # Seven readings a day don't fall on whole seconds
+        options = {"readings_per_day": 7, "shard_size": 100, "workers": 2}
+        csv = pd.read_csv(self.generate("cohort.csv", **options))
+        csv["Timestamp"] = pd.to_datetime(csv["Timestamp"])
+        columns = load_columnar(
+            self.generate("cohort.cols", output_format="cols", **options),
+            mmap_mode=None,
         )
+        pd.testing.assert_frame_equal(columns, csv, check_dtype=False, check_exact=True)
 
-# Define dataframe columns
-columns = ["Patient_ID", "Timestamp", "Age", "Gender", "BMI", "Blood_Glucose", "HbA1c"]
-
-# Create dataframe
-dummy_data = pd.DataFrame(df_list, columns=columns)
+    def test_arguments_must_be_positive(self):
+        import contextlib
+        import io
+        from unittest import mock
 
-print("\nDataset generated and saved\n")
+        for argv in (["--days", "0"], ["--patients", "-3"], ["--workers", "0"]):
+            with mock.patch.object(sys, "argv", ["SyntheticDataset.py"] + argv):
+                with self.assertRaises(SystemExit), contextlib.redirect_stderr(
+                    io.StringIO()
+                ):
+                    main()
 
 
-# Save the dataframe to a CSV file
-dummy_data.to_csv(
-    "Dataset/synthetic_diabetes_data_v6.csv", index=False, float_format="%.2f"
-)
+if __name__ == "__main__":
+    main()
@@ -1,104 +1,236 @@
-import pandas as pd
-import numpy as np
+import argparse
 import os
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
 
-# Get the absolute path of the directory where the script is located
-dir_path = os.path.dirname(os.path.realpath(__file__))
-
-# Change the current working directory to the directory where the script is located
-os.chdir(dir_path)
-
-# Load the original dataset
-df = pd.read_csv("../../Dataset/diabetes_data_upload.csv")
-
-# Determine the current counts for each gender and class combination
-current_counts = df.groupby(["Gender", "class"]).size().reset_index(name="counts")
-
-# Generate random target counts for each combination
-np.random.seed(0)  # for reproducibility
-total_target = np.random.randint(850, 1040)  # random total target count
-targets = np.random.multinomial(
-    total_target, [0.25, 0.25, 0.25, 0.25]
-)  # random split among groups
-
-# Identify the shortfall to reach the target counts
-shortfalls = {}
-for i, (gender, diabetes_class) in enumerate(
-    [
-        ("Male", "Positive"),
-        ("Male", "Negative"),
-        ("Female", "Positive"),
-        ("Female", "Negative"),
-    ]
+from columnarDataset import read_dataset
+
+GROUP_COLUMNS = ("Gender", "class")
+GROUPS = [
+    ("Male", "Positive"),
+    ("Male", "Negative"),
+    ("Female", "Positive"),
+    ("Female", "Negative"),
+]
+
+
+def random_targets(seed=0, low=850, high=1040, groups=GROUPS, shares=None):
+    # Random total target count, split at random among the groups. Same draws as
+    # the original script for the default arguments
+    random_state = np.random.RandomState(seed)
+    total_target = random_state.randint(low, high)
+    if shares is None:
+        shares = [1 / len(groups)] * len(groups)
+    counts = random_state.multinomial(total_target, shares)
+    return dict(zip(groups, counts.tolist()))
+
+
+def shortfalls(df, targets, group_columns=GROUP_COLUMNS):
+    # Records missing from each group to reach its target count
+    current_counts = df.groupby(list(group_columns)).size()
+    index = pd.MultiIndex.from_tuples(list(targets), names=list(group_columns))
+    current = current_counts.reindex(index, fill_value=0).to_numpy()
+    missing = np.maximum(0, np.fromiter(targets.values(), dtype=np.int64) - current)
+    return dict(zip(targets, missing.tolist()))
+
+
+class ConditionalSampler:
+    # Per-condition column statistics, computed once from the source data. Float
+    # columns are drawn from a normal distribution with the condition's mean and
+    # std; every other column, integers like Age included, is drawn from the
+    # values seen under that condition with their observed frequencies
+    def __init__(self, df, condition_on=("class",), exclude=GROUP_COLUMNS):
+        self.condition_on = list(condition_on)
+        self.columns = [column for column in df.columns if column not in exclude]
+        self.numeric = [
+            column for column in self.columns if pd.api.types.is_float_dtype(df[column])
+        ]
+        self.categorical = [
+            column for column in self.columns if column not in self.numeric
+        ]
+
+        by_condition = df.groupby(self.condition_on, sort=True)
+        codes = by_condition.ngroup().to_numpy()
+        self.conditions = [
+            key if isinstance(key, tuple) else (key,)
+            for key in by_condition.groups.keys()
+        ]
+        self.condition_index = {key: i for i, key in enumerate(self.conditions)}
+
+        grouped = df[self.numeric].groupby(codes)
+        self.means = grouped.mean().reindex(range(len(self.conditions))).to_numpy()
+        self.stds = grouped.std().reindex(range(len(self.conditions))).to_numpy()
+
+        # Cumulative probabilities per condition, offset by the condition index so
+        # one searchsorted over the flattened table samples every row at once
+        self.values = {}
+        self.tables = {}
+        n_conditions = len(self.conditions)
+        for column in self.categorical:
+            value_codes, values = pd.factorize(df[column], sort=True)
+            counts = np.bincount(
+                codes * len(values) + value_codes,
+                minlength=n_conditions * len(values),
+            ).reshape(n_conditions, len(values))
+            cdf = np.cumsum(counts, axis=1, dtype=float)
+            cdf /= cdf[:, -1:]
+            cdf[:, -1] = 1.0
+            self.values[column] = np.asarray(values)
+            self.tables[column] = (
+                cdf + np.arange(len(self.conditions))[:, np.newaxis]
+            ).ravel()
+
+    def sample(self, rng, groups, counts, group_columns=GROUP_COLUMNS):
+        # Draw every synthetic row for all groups in one pass
+        counts = np.asarray(counts, dtype=np.int64)
+        group_rows = np.repeat(np.arange(len(groups)), counts)
+        conditions = []
+        for group in groups:
+            labels = dict(zip(group_columns, group))
+            key = tuple(labels[column] for column in self.condition_on)
+            if key not in self.condition_index:
+                raise ValueError(f"No source records for condition {key}")
+            conditions.append(self.condition_index[key])
+        rows = np.asarray(conditions, dtype=np.int64)[group_rows]
+
+        data = {}
+        for column in self.columns:
+            if column in self.numeric:
+                j = self.numeric.index(column)
+                data[column] = rng.normal(self.means[rows, j], self.stds[rows, j])
+            else:
+                n_values = len(self.values[column])
+                draws = rng.random(len(rows)) + rows
+                codes = np.searchsorted(self.tables[column], draws, side="right")
+                codes -= rows * n_values
+                data[column] = self.values[column][np.minimum(codes, n_values - 1)]
+
+        for i, column in enumerate(group_columns):
+            data[column] = np.asarray([group[i] for group in groups])[group_rows]
+        return pd.DataFrame(data)
+
+
+def balance_dataset(
+    df, targets, seed=0, condition_on=("class",), group_columns=GROUP_COLUMNS
 ):
-    current_count = current_counts[
-        (current_counts["Gender"] == gender)
-        & (current_counts["class"] == diabetes_class)
-    ]["counts"].sum()
-    shortfall = max(0, targets[i] - current_count)
-    shortfalls[(gender, diabetes_class)] = shortfall
-
-
-# Adjusted function to generate synthetic data considering class-specific distributions
-def generate_synthetic_data_for_class(df, gender, diabetes_class, num_records):
-    synthetic_df = pd.DataFrame()
-    for column in df.columns:
-        if column in ["Gender", "class"]:
-            continue
-        if df[column].dtype == np.number:
-            mean, std = (
-                df[df["class"] == diabetes_class][column].mean(),
-                df[df["class"] == diabetes_class][column].std(),
-            )
-            synthetic_df[column] = np.random.normal(mean, std, num_records)
-        else:
-            # For categorical columns, replicate the distribution seen in the specific class
-            values, counts = np.unique(
-                df[df["class"] == diabetes_class][column], return_counts=True
-            )
-            probs = counts / counts.sum()
-            synthetic_df[column] = np.random.choice(values, p=probs, size=num_records)
-    synthetic_df["Gender"] = gender
-    synthetic_df["class"] = diabetes_class
-    return synthetic_df
-
-
-# Generate the required synthetic data for each group
-synthetic_dfs = []
-for (gender, diabetes_class), shortfall in shortfalls.items():
-    if shortfall > 0:
-        synthetic_df = generate_synthetic_data_for_class(
-            df, gender, diabetes_class, shortfall
+    # Top up every group in targets ({group values: count}) with synthetic records
+    missing = shortfalls(df, targets, group_columns)
+    groups = [group for group, count in missing.items() if count > 0]
+    if not groups:
+        return df.copy()
+
+    sampler = ConditionalSampler(df, condition_on, exclude=group_columns)
+    synthetic_data = sampler.sample(
+        np.random.default_rng(seed),
+        groups,
+        [missing[group] for group in groups],
+        group_columns,
+    )
+    return pd.concat([df, synthetic_data[df.columns]], ignore_index=True)
+
+
+def main():
+    # Get the absolute path of the directory where the script is located
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser(description="Balance the diabetes dataset")
+    parser.add_argument(
+        "--source",
+        default=os.path.join(dir_path, "../../Dataset/diabetes_data_upload.csv"),
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join(dir_path, "../../Dataset/balanced_diabetes_data.csv"),
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--condition-on",
+        nargs="+",
+        default=["class"],
+        choices=list(GROUP_COLUMNS),
+        help="Columns the synthetic feature distributions are conditioned on",
+    )
+    args = parser.parse_args()
+    # Paths given on the command line are relative to the caller's directory
+    args.source = os.path.abspath(args.source)
+    args.output = os.path.abspath(args.output)
+
+    # Change the current working directory to the directory where the script is located
+    os.chdir(dir_path)
+
+    # Load the original dataset
+    df = read_dataset(args.source)
+
+    start = time.perf_counter()
+    balanced_df = balance_dataset(
+        df,
+        random_targets(args.seed),
+        seed=args.seed,
+        condition_on=args.condition_on,
+    )
+    elapsed = time.perf_counter() - start
+
+    # Save the balanced dataset to a new CSV file
+    balanced_df.to_csv(args.output, index=False)
+
+    print(
+        f"Dataset balancing complete in {elapsed * 1e3:.1f} ms. "
+        "The balanced dataset has been saved."
+    )
+
+    # Evaluate new dataset and its class distribution
+
+    df = read_dataset(args.output)
+
+    # Basic statistics for each feature
+    print(df.describe(include="all"))
+
+    # Class distribution
+    print(df["class"].value_counts())
+
+    # Gender distribution
+    print(df["Gender"].value_counts())
+
+    # Class distribution with respect to gender
+    print(df.groupby("Gender")["class"].value_counts())
+
+
+# TESTING
+class TestDatasetBalancing(unittest.TestCase):
+    def setUp(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.df = pd.read_csv(
+            os.path.join(dir_path, "../../Dataset/diabetes_data_upload.csv")
         )
-        synthetic_dfs.append(synthetic_df)
-
-# Combine the synthetic data with the original dataset
-if synthetic_dfs:
-    synthetic_data = pd.concat(synthetic_dfs, ignore_index=True)
-    balanced_df = pd.concat([df, synthetic_data], ignore_index=True)
-else:
-    balanced_df = df.copy()
 
-# Save the balanced dataset to a new CSV file
-balanced_df.to_csv(
-    "../../Dataset/balanced_diabetes_data.csv",
-    index=False,
-)
-
-print("Dataset balancing complete. The balanced dataset has been saved.")
-
-# Evaluate new dataset and its class distribution
-
-df = pd.read_csv("../../Dataset/balanced_diabetes_data.csv")
-
-# Basic statistics for each feature
-print(df.describe(include="all"))
-
-# Class distribution
-print(df["class"].value_counts())
-
-# Gender distribution
-print(df["Gender"].value_counts())
-
-# Class distribution with respect to gender
-print(df.groupby("Gender")["class"].value_counts())
+    def test_groups_reach_targets(self):
+        targets = {group: 400 for group in GROUPS}
+        balanced = balance_dataset(self.df, targets)
+        counts = balanced.groupby(list(GROUP_COLUMNS)).size()
+        for group, target in targets.items():
+            self.assertEqual(
+                counts[group],
+                max(target, self.df.groupby(list(GROUP_COLUMNS)).size()[group]),
+            )
+        self.assertEqual(list(balanced.columns), list(self.df.columns))
+        pd.testing.assert_frame_equal(balanced.head(len(self.df)), self.df)
+
+    def test_samples_follow_class_distribution(self):
+        sampler = ConditionalSampler(self.df)
+        rng = np.random.default_rng(1)
+        synthetic = sampler.sample(rng, [("Male", "Positive")], [200_000])
+        source = self.df[self.df["class"] == "Positive"]
+        for column in ["Polyuria", "Age"]:
+            expected = source[column].value_counts(normalize=True)
+            observed = synthetic[column].value_counts(normalize=True)
+            observed = observed.reindex(expected.index, fill_value=0)
+            np.testing.assert_allclose(observed, expected, atol=0.01)
+        self.assertTrue(set(synthetic["Age"]) <= set(source["Age"]))
+        self.assertTrue((synthetic["Gender"] == "Male").all())
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import numpy as np
 import pickle
 from sklearn import preprocessing
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import MinMaxScaler
 import unittest
 from sklearn.metrics import (
@@ -15,6 +15,9 @@ from sklearn.metrics import (
     mean_squared_error,
 )
 import os
+import sys
+from columnarDataset import read_dataset
+from trainingDriver import ForestSearch
 
 # Get the absolute path of the directory where the script is located
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -23,7 +26,7 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 os.chdir(dir_path)
 
 # Load dataset
-df = pd.read_csv("../../Dataset/balanced_diabetes_data.csv")
+df = read_dataset("../../Dataset/balanced_diabetes_data.csv")
 df.columns = map(str.lower, df.columns)
 df["class"] = df["class"].replace({"Positive": 1, "Negative": 0})
 
@@ -53,8 +56,8 @@ param_grid = {
     "max_depth": [10, 20, 30],
 }
 rf = RandomForestClassifier(random_state=0)
-grid_search = GridSearchCV(
-    estimator=rf, param_grid=param_grid, cv=5, n_jobs=-1, scoring="accuracy"
+grid_search = ForestSearch(
+    estimator=rf, param_grid=param_grid, cv=5, scoring="accuracy"
 )
 grid_search.fit(X_train, y_train)
 
@@ -64,9 +67,8 @@ best_score = grid_search.best_score_
 print("Best Parameters:", best_parameters)
 print("Best Score:", best_score)
 
-# Train the final model
-final_rf = RandomForestClassifier(**best_parameters, random_state=0)
-final_rf.fit(X_train, y_train)
+# The search has already refit the best configuration on the training set
+final_rf = grid_search.best_estimator_
 
 # Evaluation Metrics
 y_pred_rf = final_rf.predict(X_test)
@@ -131,6 +133,41 @@ with open(
 ) as file:
     pickle.dump(minmax, file)
 
+# Optionally precompute the lookup table served by the Flask app's table mode
+if os.environ.get("BUILD_PREDICT_TABLE") == "1":
+    sys.path.insert(0, os.path.join(dir_path, "../FlaskApp"))
+    from predictionTable import build_table, file_hash
+
+    build_table(
+        final_rf,
+        encoders,
+        minmax,
+        "Models/predict_table",
+        model_sha256=file_hash("Models/model.pkl"),
+    )
+
+# Optionally publish the model as a versioned bundle the Flask app hot-reloads
+if os.environ.get("MODEL_ARTIFACTS"):
+    sys.path.insert(0, os.path.join(dir_path, "../FlaskApp"))
+    from modelArtifacts import publish_bundle
+
+    bundle = publish_bundle(
+        os.environ["MODEL_ARTIFACTS"],
+        "diabetes",
+        {
+            "model.pkl": "Models/model.pkl",
+            "encoders.pkl": "Models/encoders.pkl",
+            "minmax.pkl": "Models/minmax.pkl",
+        },
+        metadata={
+            "params": best_parameters,
+            "cv_accuracy": best_score,
+            "accuracy": rf_acc,
+            "f1": rf_f1,
+        },
+    )
+    print("Published", bundle)
+
 
 # TESTING
 class TestPredictDiabetes(unittest.TestCase):
@@ -0,0 +1,354 @@
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import unittest
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Columnar layout: <name>.cols/ holds schema.json plus one .npy file per column, so
+# every column can be memory-mapped with np.load(mmap_mode="r") and nothing is
+# re-parsed on load. Timestamps are int64 nanoseconds of wall-clock time, with the
+# UTC offset kept in the schema for timestamps that had one, integers int32 (or
+# int64 if needed), floats float64 like read_csv gives them, booleans uint8 and
+# strings uint8 category codes.
+SCHEMA_VERSION = 2
+SCHEMA_FILE = "schema.json"
+
+
+def columnar_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".cols"
+
+
+def _source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return {
+        "path": os.path.basename(csv_path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+def parse_timestamps(values):
+    # The parsed column if every value is an ISO 8601 timestamp, else None.
+    # Timestamps with mixed UTC offsets don't parse to one dtype and stay text
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            timestamps = pd.to_datetime(values, format="ISO8601")
+    except (ValueError, TypeError):
+        return None
+    if not pd.api.types.is_datetime64_any_dtype(timestamps):
+        return None
+    return timestamps
+
+
+def _encode_column(series):
+    # Returns (kind, array, extra) for one CSV column, extra being the categories
+    # of a categorical column or the UTC offset in seconds of a timestamp column
+    if pd.api.types.is_integer_dtype(series):
+        fits_int32 = series.min() >= np.iinfo(np.int32).min and (
+            series.max() <= np.iinfo(np.int32).max
+        )
+        return "int", series.to_numpy(np.int32 if fits_int32 else np.int64), None
+    if pd.api.types.is_float_dtype(series):
+        return "float", series.to_numpy(np.float64), None
+    if pd.api.types.is_bool_dtype(series):
+        return "bool", series.to_numpy(np.uint8), None
+
+    values = series.astype(object)
+    if values.isna().any():
+        raise ValueError(f"Column '{series.name}' has missing text values")
+
+    # Text columns are either timestamps or categories like "Yes"/"No"
+    timestamps = parse_timestamps(values)
+    if timestamps is not None:
+        offset = None
+        if timestamps.dt.tz is not None:
+            offset = timestamps.iloc[0].utcoffset().total_seconds()
+            timestamps = timestamps.dt.tz_localize(None)
+        array = timestamps.to_numpy("datetime64[ns]").view(np.int64)
+        return "timestamp", array, offset
+
+    codes, categories = pd.factorize(values, sort=True)
+    if len(categories) > 255:
+        raise ValueError(f"Column '{series.name}' has too many categories")
+    return "categorical", codes.astype(np.uint8), [str(c) for c in categories]
+
+
+def convert_csv(csv_path, out_dir=None):
+    out_dir = out_dir or columnar_path(csv_path)
+    df = pd.read_csv(csv_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        kind, array, extra = _encode_column(df[name])
+        file_name = f"{i:03d}.npy"
+        np.save(os.path.join(out_dir, file_name), array)
+        column = {
+            "name": name,
+            "kind": kind,
+            "dtype": array.dtype.str,
+            "file": file_name,
+        }
+        if kind == "categorical":
+            column["categories"] = extra
+        elif extra is not None:
+            column["utc_offset"] = extra
+        columns.append(column)
+
+    schema = {
+        "version": SCHEMA_VERSION,
+        "n_rows": len(df),
+        "source": _source_stamp(csv_path),
+        "columns": columns,
+    }
+    # The schema is written last, so a partial conversion is never picked up
+    with open(os.path.join(out_dir, SCHEMA_FILE), "w") as file:
+        json.dump(schema, file, indent=2)
+    return out_dir
+
+
+def load_columnar(path, mmap_mode="r", decode=True):
+    # Load a converted dataset as a DataFrame. With decode=True categories come
+    # back as strings, exactly like the CSV; otherwise as pandas Categoricals
+    with open(os.path.join(path, SCHEMA_FILE)) as file:
+        schema = json.load(file)
+    if schema["version"] != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported columnar schema version {schema['version']}")
+
+    data = {}
+    for column in schema["columns"]:
+        array = np.load(os.path.join(path, column["file"]), mmap_mode=mmap_mode)
+        if column["kind"] == "timestamp":
+            array = array.view("datetime64[ns]")
+            if column.get("utc_offset") is not None:
+                offset = datetime.timedelta(seconds=column["utc_offset"])
+                array = pd.DatetimeIndex(array).tz_localize(datetime.timezone(offset))
+        elif column["kind"] == "bool":
+            array = array.view(np.bool_)
+        elif column["kind"] == "categorical":
+            if decode:
+                array = np.asarray(column["categories"], dtype=object)[array]
+            else:
+                array = pd.Categorical.from_codes(array, column["categories"])
+        data[column["name"]] = array
+    return pd.DataFrame(data, copy=False)
+
+
+def is_current(csv_path, path=None):
+    # A columnar copy is only used while it matches the CSV it was converted from
+    schema_path = os.path.join(path or columnar_path(csv_path), SCHEMA_FILE)
+    if not os.path.exists(schema_path):
+        return False
+    if not os.path.exists(csv_path):
+        return True
+    with open(schema_path) as file:
+        schema = json.load(file)
+    # Copies in an older layout are ignored until they are converted again
+    if schema["version"] != SCHEMA_VERSION:
+        return False
+    source = schema["source"]
+    # Datasets generated straight to columnar form have no source CSV
+    if source is None:
+        return False
+    stamp = _source_stamp(csv_path)
+    return source["size"] == stamp["size"] and source["mtime"] == stamp["mtime"]
+
+
+def read_dataset(csv_path, mmap_mode=None, **kwargs):
+    # Loads a dataset for the training scripts from the columnar copy next to the
+    # CSV when there is an up to date one, else with pd.read_csv. The frame is the
+    # one pd.read_csv gives, except that timestamp columns come back already parsed
+    # by pd.to_datetime. Columns are read into memory by default since the scripts
+    # modify the frames they load
+    if is_current(csv_path):
+        return load_columnar(columnar_path(csv_path), mmap_mode=mmap_mode, **kwargs)
+    df = pd.read_csv(csv_path)
+    for name in df.columns:
+        if df[name].dtype == object and not df[name].isna().any():
+            timestamps = parse_timestamps(df[name])
+            if timestamps is not None:
+                df[name] = timestamps
+    return df
+
+
+def _measure(mode, csv_path):
+    # Run in a fresh process so resident memory reflects only this loader
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == "csv":
+        df = pd.read_csv(csv_path)
+        # The scripts re-parse timestamps after every CSV load
+        for name in df.columns:
+            if "time" in name.lower():
+                df[name] = pd.to_datetime(df[name])
+    else:
+        mmap_mode = "r" if mode == "cols-mmap" else None
+        df = load_columnar(columnar_path(csv_path), mmap_mode=mmap_mode)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    print(
+        json.dumps(
+            {
+                "mode": mode,
+                "rows": len(df),
+                "seconds": elapsed,
+                "rss_mb": (peak - baseline) / scale,
+            }
+        )
+    )
+
+
+def benchmark(csv_path, repeat=3):
+    if not is_current(csv_path):
+        convert_csv(csv_path)
+
+    results = []
+    # cols-mmap pages columns in lazily, so its memory grows only as data is touched
+    for mode in ["csv", "cols", "cols-mmap"]:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run(
+                [sys.executable, __file__, "_measure", mode, csv_path],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        best = min(runs, key=lambda run: run["seconds"])
+        results.append(best)
+        print(
+            f"{mode:>9}: {best['rows']} rows in {best['seconds'] * 1e3:8.1f} ms, "
+            f"+{best['rss_mb']:.1f} MB RSS"
+        )
+
+    csv_size = os.path.getsize(csv_path)
+    cols_size = sum(
+        entry.stat().st_size for entry in os.scandir(columnar_path(csv_path))
+    )
+    print(f"On disk: CSV {csv_size / 1e6:.1f} MB, columnar {cols_size / 1e6:.1f} MB")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert CSV datasets to the columnar format and benchmark loading"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser("convert", help="Convert CSV files")
+    convert.add_argument("csv", nargs="+")
+    bench = subparsers.add_parser("bench", help="Compare CSV and columnar loading")
+    bench.add_argument("csv", nargs="+")
+    bench.add_argument("--repeat", type=int, default=3)
+    measure = subparsers.add_parser("_measure")
+    measure.add_argument("mode")
+    measure.add_argument("csv")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        for csv_path in args.csv:
+            print(f"{csv_path} -> {convert_csv(csv_path)}")
+    elif args.command == "bench":
+        for csv_path in args.csv:
+            print(csv_path)
+            benchmark(csv_path, args.repeat)
+    else:
+        _measure(args.mode, args.csv)
+
+
+# TESTING
+class TestColumnarDataset(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def expected(self, csv_path):
+        # What the training scripts had before: read_csv, then pd.to_datetime on
+        # the timestamp columns
+        df = pd.read_csv(csv_path)
+        for name in df.columns:
+            if "time" in name.lower():
+                df[name] = pd.to_datetime(df[name])
+        return df
+
+    def assert_matches_csv(self, df, csv_path):
+        expected = self.expected(csv_path)
+        # Integers may come back narrower, every other column exactly as expected
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False, check_exact=True)
+        for name in expected.columns:
+            if not pd.api.types.is_integer_dtype(expected[name]):
+                self.assertEqual(df[name].dtype, expected[name].dtype, name)
+
+    def test_round_trip_matches_read_csv(self):
+        rng = np.random.default_rng(0)
+        n = 200
+        timestamps = pd.date_range("2024-03-30", periods=n, freq="37min")
+        csv_path = os.path.join(self.directory, "readings.csv")
+        pd.DataFrame(
+            {
+                "Patient_ID": np.arange(n) // 20,
+                "Big": np.arange(n, dtype=np.int64) * 10**10,
+                "Timestamp": timestamps.strftime("%Y-%m-%d %H:%M:%S"),
+                "Local_Time": timestamps.strftime("%Y-%m-%dT%H:%M:%S+02:00"),
+                "Utc_Time": timestamps.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "Blood_Glucose": rng.uniform(50, 250, n),
+                "HbA1c": np.round(rng.uniform(4, 12, n), 1),
+                "Gender": rng.choice(["Female", "Male"], n),
+                "Flag": rng.random(n) < 0.5,
+            }
+        ).to_csv(csv_path, index=False)
+
+        self.assert_matches_csv(read_dataset(csv_path), csv_path)
+        convert_csv(csv_path)
+        self.assertTrue(is_current(csv_path))
+        self.assert_matches_csv(read_dataset(csv_path), csv_path)
+        # Memory-mapped columns are np.memmap, which the frame comparison rejects
+        self.assert_matches_csv(read_dataset(csv_path, "r").copy(), csv_path)
+
+    def test_mixed_offsets_stay_text(self):
+        csv_path = os.path.join(self.directory, "mixed.csv")
+        with open(csv_path, "w") as file:
+            file.write("Time,Value\n")
+            file.write("2024-01-01T08:00:00+01:00,1.5\n")
+            file.write("2024-06-01T08:00:00+02:00,2.5\n")
+        convert_csv(csv_path)
+        df = read_dataset(csv_path)
+        pd.testing.assert_frame_equal(df, pd.read_csv(csv_path))
+
+    def test_synthetic_dataset_round_trip(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        csv_path = os.path.join(
+            dir_path, "../../Dataset/synthetic_diabetes_data_v6.csv"
+        )
+        out_dir = convert_csv(csv_path, os.path.join(self.directory, "synthetic.cols"))
+        self.assert_matches_csv(load_columnar(out_dir, mmap_mode=None), csv_path)
+
+    def test_older_copies_are_ignored(self):
+        csv_path = os.path.join(self.directory, "old.csv")
+        pd.DataFrame({"Value": [1.25, 2.5]}).to_csv(csv_path, index=False)
+        schema_path = os.path.join(convert_csv(csv_path), SCHEMA_FILE)
+        with open(schema_path) as file:
+            schema = json.load(file)
+        with open(schema_path, "w") as file:
+            json.dump(dict(schema, version=SCHEMA_VERSION - 1), file)
+        self.assertFalse(is_current(csv_path))
+        pd.testing.assert_frame_equal(read_dataset(csv_path), pd.read_csv(csv_path))
+
+
+if __name__ == "__main__":
+    main()
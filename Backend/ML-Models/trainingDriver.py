@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import sklearn
+from sklearn.base import clone, is_classifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterGrid, check_cv
+from sklearn.utils import _safe_indexing
+
+# Grid search over random forests shared by the training scripts. Configurations
+# that only differ in n_estimators are fitted as one forest per fold, grown with
+# warm_start through the sorted n_estimators values and scored at each size. Forest
+# seeds are drawn tree by tree, so a forest grown from 50 to 100 trees is the same
+# forest a fresh 100-tree fit would give, and the scores match GridSearchCV. Fold
+# tasks run in a process pool, and their scores are cached on disk by data, fold,
+# estimator and parameters so a rerun only fits what changed
+TRAIN_CACHE_DIR = os.environ.get(
+    "TRAIN_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "train_cache"),
+)
+
+# Estimator parameters that do not change the fitted model
+IGNORED_PARAMS = {"n_jobs", "verbose", "warm_start"}
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            digest.update(f"{part.dtype}{part.shape}".encode())
+            digest.update(part.tobytes())
+        else:
+            digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def data_hash(X, y):
+    columns = [str(col) for col in getattr(X, "columns", [])]
+    return _hash(columns, np.asarray(X), np.asarray(y))
+
+
+_worker_data = {}
+
+
+def _init_worker(X, y):
+    _worker_data["X"] = X
+    _worker_data["y"] = y
+
+
+def fit_fold(task):
+    # Grow one forest on a training fold and score it at every n_estimators value
+    estimator, params, n_estimators, train, test, scoring = task
+    X, y = _worker_data["X"], _worker_data["y"]
+    X_train, y_train = _safe_indexing(X, train), _safe_indexing(y, train)
+    X_test, y_test = _safe_indexing(X, test), _safe_indexing(y, test)
+    scorer = check_scoring(estimator, scoring=scoring)
+
+    forest = clone(estimator).set_params(**params, warm_start=True, n_jobs=1)
+    scores = {}
+    start = time.perf_counter()
+    for n in n_estimators:
+        forest.set_params(n_estimators=n)
+        forest.fit(X_train, y_train)
+        scores[str(n)] = float(scorer(forest, X_test, y_test))
+    return {"scores": scores, "fit_s": time.perf_counter() - start}
+
+
+class ForestSearch:
+    # Drop-in for GridSearchCV(estimator, param_grid, cv=..., scoring=...) on forests,
+    # with best_params_, best_score_, best_estimator_ and a cv_results_ summary.
+    # The best configuration is refit once on the full training set
+    def __init__(
+        self,
+        estimator,
+        param_grid,
+        cv=5,
+        scoring=None,
+        workers=None,
+        cache_dir=TRAIN_CACHE_DIR,
+        verbose=True,
+    ):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.workers = workers or os.cpu_count()
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+
+    def _task_key(self, data_key, params, test):
+        estimator_params = {
+            key: value
+            for key, value in self.estimator.get_params().items()
+            if key not in IGNORED_PARAMS and key != "n_estimators"
+        }
+        # Fits from another sklearn release may differ, so it is part of the key
+        return _hash(
+            sklearn.__version__,
+            type(self.estimator).__name__,
+            estimator_params,
+            params,
+            self.scoring,
+            data_key,
+            np.asarray(test),
+        )
+
+    def _read_cache(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, f"{key}.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, key, result):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Written under a temporary name so an interrupted run leaves no partial file
+        path = os.path.join(self.cache_dir, f"{key}.json")
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_dir, suffix=".tmp", delete=False
+        ) as file:
+            json.dump(result, file)
+        os.replace(file.name, path)
+
+    def fit(self, X, y):
+        start = time.perf_counter()
+        candidates = list(ParameterGrid(self.param_grid))
+        n_values = sorted({params["n_estimators"] for params in candidates})
+        groups = []
+        for params in candidates:
+            base = {k: v for k, v in params.items() if k != "n_estimators"}
+            if base not in groups:
+                groups.append(base)
+
+        cv = check_cv(self.cv, y, classifier=is_classifier(self.estimator))
+        folds = list(cv.split(X, y))
+        data_key = data_hash(X, y)
+
+        # Scores per (group, fold), from the cache or from a new fold task
+        scores = {}
+        tasks = {}
+        for g, base in enumerate(groups):
+            for f, (train, test) in enumerate(folds):
+                key = self._task_key(data_key, base, test)
+                cached = self._read_cache(key)
+                if cached and all(str(n) in cached["scores"] for n in n_values):
+                    scores[g, f] = cached["scores"]
+                else:
+                    task = (self.estimator, base, n_values, train, test, self.scoring)
+                    tasks[g, f] = (key, cached, task)
+
+        workers = min(self.workers, len(tasks))
+        if workers > 1:
+            with ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(X, y)
+            ) as pool:
+                results = pool.map(fit_fold, [task for _, _, task in tasks.values()])
+                results = list(results)
+        else:
+            _init_worker(X, y)
+            results = [fit_fold(task) for _, _, task in tasks.values()]
+            _worker_data.clear()
+
+        for (g, f), (key, cached, _), result in zip(tasks, tasks.values(), results):
+            if cached:
+                result["scores"] = dict(cached["scores"], **result["scores"])
+            self._write_cache(key, result)
+            scores[g, f] = result["scores"]
+
+        # Candidates keep ParameterGrid order, so ties resolve like GridSearchCV
+        self.cv_results_ = []
+        for params in candidates:
+            base = {k: v for k, v in params.items() if k != "n_estimators"}
+            g = groups.index(base)
+            fold_scores = [
+                scores[g, f][str(params["n_estimators"])] for f in range(len(folds))
+            ]
+            self.cv_results_.append(
+                {
+                    "params": params,
+                    "mean_test_score": float(np.mean(fold_scores)),
+                    "std_test_score": float(np.std(fold_scores)),
+                }
+            )
+        means = [result["mean_test_score"] for result in self.cv_results_]
+        self.best_index_ = int(np.argmax(means))
+        self.best_params_ = self.cv_results_[self.best_index_]["params"]
+        self.best_score_ = means[self.best_index_]
+        search_s = time.perf_counter() - start
+
+        refit_start = time.perf_counter()
+        # The refit uses every core, then the estimator gets the caller's n_jobs back
+        # so the pickled model doesn't carry n_jobs=-1 into serving
+        self.best_estimator_ = clone(self.estimator).set_params(
+            **self.best_params_, n_jobs=-1
+        )
+        self.best_estimator_.fit(X, y)
+        self.best_estimator_.set_params(n_jobs=self.estimator.get_params()["n_jobs"])
+        self.stats_ = {
+            "candidates": len(candidates),
+            "fold_tasks": len(groups) * len(folds),
+            "cached_tasks": len(groups) * len(folds) - len(tasks),
+            "workers": max(workers, 1),
+            "search_s": search_s,
+            "refit_s": time.perf_counter() - refit_start,
+        }
+        if self.verbose:
+            print(
+                f"Searched {self.stats_['candidates']} configurations with "
+                f"{len(tasks)} fold fits ({self.stats_['cached_tasks']} cached) on "
+                f"{self.stats_['workers']} workers in {search_s:.1f}s, "
+                f"refit in {self.stats_['refit_s']:.1f}s"
+            )
+        return self
+
+
+# TESTING
+class TestForestSearch(unittest.TestCase):
+    def setUp(self):
+        from sklearn.datasets import make_classification, make_regression
+
+        self.classification = make_classification(300, 8, random_state=0)
+        self.regression = make_regression(300, 5, noise=5.0, random_state=0)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_matches_grid_search(self):
+        from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+        from sklearn.model_selection import GridSearchCV, KFold
+
+        cases = [
+            (
+                RandomForestClassifier(random_state=0),
+                {"n_estimators": [5, 10, 20], "max_depth": [3, None]},
+                5,
+                "accuracy",
+                self.classification,
+            ),
+            (
+                RandomForestRegressor(random_state=42),
+                {"n_estimators": [5, 15], "max_depth": [None, 4]},
+                KFold(n_splits=3, shuffle=True, random_state=42),
+                "r2",
+                self.regression,
+            ),
+        ]
+        for estimator, grid, cv, scoring, (X, y) in cases:
+            expected = GridSearchCV(estimator, grid, cv=cv, scoring=scoring).fit(X, y)
+            search = ForestSearch(
+                estimator,
+                grid,
+                cv=cv,
+                scoring=scoring,
+                workers=2,
+                cache_dir=self.cache_dir,
+                verbose=False,
+            ).fit(X, y)
+            np.testing.assert_allclose(
+                [result["mean_test_score"] for result in search.cv_results_],
+                expected.cv_results_["mean_test_score"],
+            )
+            self.assertEqual(search.best_params_, expected.best_params_)
+            np.testing.assert_array_equal(
+                search.best_estimator_.predict(X),
+                expected.best_estimator_.predict(X),
+            )
+            self.assertEqual(
+                search.best_estimator_.get_params(),
+                expected.best_estimator_.get_params(),
+            )
+
+    def test_rerun_uses_cache(self):
+        from sklearn.ensemble import RandomForestClassifier
+
+        X, y = self.classification
+        grid = {"n_estimators": [5, 10], "max_depth": [3, None]}
+
+        def search(grid):
+            return ForestSearch(
+                RandomForestClassifier(random_state=0),
+                grid,
+                cache_dir=self.cache_dir,
+                verbose=False,
+            ).fit(X, y)
+
+        first = search(grid)
+        self.assertEqual(first.stats_["cached_tasks"], 0)
+        second = search(grid)
+        self.assertEqual(second.stats_["cached_tasks"], second.stats_["fold_tasks"])
+        self.assertEqual(second.cv_results_, first.cv_results_)
+        # A new n_estimators value refits the folds; other data is a different key
+        self.assertEqual(
+            search(dict(grid, n_estimators=[5, 20])).stats_["cached_tasks"], 0
+        )
+        # A different sklearn release doesn't reuse the cached scores
+        from unittest import mock
+
+        with mock.patch.object(sklearn, "__version__", "0.0"):
+            self.assertEqual(search(grid).stats_["cached_tasks"], 0)
+        moved = ForestSearch(
+            RandomForestClassifier(random_state=0),
+            grid,
+            cache_dir=self.cache_dir,
+            verbose=False,
+        ).fit(X + 1, y)
+        self.assertEqual(moved.stats_["cached_tasks"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()